@@ -0,0 +1,270 @@
+"""Offline benchmark of the pipeline stages on synthetic data.
+
+Generates a synthetic dataset per scale, runs each selected stage in its own
+subprocess (so peak memory is per stage), and saves the results to
+benchmarks/results/<scale>/. Each run is compared with the previous result for
+the same scale and settings (or --baseline); a stage whose wall time or peak
+memory grew by more than --threshold is reported as a regression and the
+script exits with status 1.
+
+    python benchmarks/run.py --scales 10000 100000 --stages label extract train predict
+"""
+import os
+import sys
+import glob
+import json
+import shutil
+import argparse
+import platform
+import resource
+import subprocess
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+SRC_DIR = os.path.join(REPO_DIR, 'src')
+sys.path.insert(0, SRC_DIR)
+
+import instrumentation
+from instrumentation import log as _log
+from config import load_config
+
+STAGES = ('segment', 'label', 'extract', 'train', 'predict')
+# Metrics compared against the baseline, with the smallest change worth reporting
+COMPARED_METRICS = {'wall_seconds': 0.5, 'peak_rss_mb': 25.0}
+
+def _paths(work_dir):
+    return os.path.join(work_dir, 'outputs'), os.path.join(work_dir, 'data')
+
+def benchmark_config(args):
+    """The test config, pointed at the synthetic dataset and sized for benchmarking."""
+    config = load_config(args.config)
+    n_months = args.months
+    config['labels_file'] = 'synthetic_labels.gpkg'
+    config['labels_field_name'] = 'klass'
+    config['study_period'] = {'start_date': '2020-01-01', 'end_date': f"2020-{n_months:02d}-28"}
+    config['segmentation_composite_uses_full_study_period'] = True
+    config['segmentation_params'] = {**config['segmentation_params'], 'bands': list(range(1, args.bands + 1)), 'num_workers': args.workers}
+    config['feature_params'] = {**config.get('feature_params', {}), 'num_workers': args.workers}
+    config['modeling_params'] = {**config['modeling_params'], 'engine': args.engine, 'predict_n_jobs': args.workers}
+    config['instrumentation_params'] = {'trace': False}
+    return config
+
+def _stage_outputs(stage, config, output_dir):
+    """Files and directories a stage writes, removed before it is timed."""
+    modeling = config['modeling_params']
+    modeling_dir = os.path.join(output_dir, 'modeling')
+    from processing import feature_store, mapping
+    return {
+        'segment': [os.path.join(os.path.dirname(output_dir), 'segment_run')],
+        'label': [os.path.join(output_dir, 'labeling')],
+        'extract': [feature_store.store_path(output_dir, config), os.path.join(output_dir, 'feature_cache')],
+        'train': [os.path.join(modeling_dir, modeling['output_model_name']),
+                  os.path.join(modeling_dir, 'tpot_checkpoint.pkl'), os.path.join(modeling_dir, 'tpot_cache'),
+                  feature_store.model_features_path(os.path.join(modeling_dir, modeling['output_model_name']))],
+        'predict': [os.path.join(modeling_dir, modeling['output_prediction_name'])] + mapping.map_output_paths(config, output_dir),
+    }[stage]
+
+def _remove(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+def _run_stage(stage, config, output_dir, data_dir):
+    if stage == 'segment':
+        from processing import segmentation
+        from main import build_image_list
+        composite_path = build_image_list(config, output_dir)[0]['path']
+        segmentation.run_segmentation(config['segmentation_params'], composite_path,
+                                      os.path.join(os.path.dirname(output_dir), 'segment_run'), config['output_names'])
+    elif stage == 'label':
+        from processing import labeling
+        labeling.generate_label_map(output_dir, data_dir, config)
+    elif stage == 'extract':
+        from processing import feature_extraction
+        from main import build_image_list
+        feature_extraction.extract_features(output_dir, config, build_image_list(config, output_dir))
+    elif stage == 'train':
+        from processing import modeling
+        modeling.train_model(config, output_dir)
+    elif stage == 'predict':
+        from processing import mapping
+        mapping.generate_map(config, output_dir)
+
+def stage_worker(args):
+    """Runs one stage in this (fresh) process and writes its measurements to --result-file."""
+    config = benchmark_config(args)
+    output_dir, data_dir = _paths(args.work_dir)
+    instrumentation.start_trace(os.path.join(args.work_dir, 'traces', args.stage_worker))
+    try:
+        with instrumentation.span(args.stage_worker, 'stage') as span:
+            _run_stage(args.stage_worker, config, output_dir, data_dir)
+        record = span.record
+    finally:
+        instrumentation.stop_trace()
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    unit = 1 if platform.system() == 'Darwin' else 1024
+    own_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit / (1024 * 1024)
+    children_peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit / (1024 * 1024)
+    result = {
+        'wall_seconds': record['wall_seconds'],
+        'cpu_seconds': record['cpu_seconds'] + record['children_cpu_seconds'],
+        # Workers run side by side, so their summed sampled RSS can exceed any single process's peak
+        'peak_rss_mb': max(own_peak, children_peak, record['total_peak_rss_mb']),
+        'read_bytes': (record['read_bytes'] or 0) + (record['children_read_bytes'] or 0),
+        'write_bytes': (record['write_bytes'] or 0) + (record['children_write_bytes'] or 0),
+    }
+    with open(args.result_file, 'w') as f:
+        json.dump(result, f)
+
+def _stage_command(args, stage, result_file):
+    return [sys.executable, os.path.abspath(__file__), '--stage-worker', stage, '--work-dir', args.work_dir,
+            '--result-file', result_file, '--config', args.config, '--engine', args.engine,
+            '--workers', str(args.workers), '--bands', str(args.bands), '--months', str(args.months)]
+
+def _run_in_subprocess(args, stage):
+    result_file = os.path.join(args.work_dir, f"{stage}.result.json")
+    if os.path.exists(result_file):
+        os.remove(result_file)
+    log_path = os.path.join(args.work_dir, f"{stage}.log")
+    with open(log_path, 'w') as log_file:
+        completed = subprocess.run(_stage_command(args, stage, result_file), stdout=log_file, stderr=subprocess.STDOUT, cwd=REPO_DIR)
+    if completed.returncode != 0 or not os.path.exists(result_file):
+        raise RuntimeError(f"Stage '{stage}' failed (exit code {completed.returncode}). See {log_path}")
+    with open(result_file) as f:
+        return json.load(f)
+
+def _prerequisite_done(stage, config, output_dir):
+    """True if the output a later stage reads from `stage` already exists."""
+    from processing import feature_store
+    return {
+        'segment': True,
+        'label': os.path.exists(os.path.join(output_dir, 'labeling', 'segment_label_map.csv')),
+        'extract': os.path.exists(feature_store.store_path(output_dir, config)),
+        'train': os.path.exists(os.path.join(output_dir, 'modeling', config['modeling_params']['output_model_name'])),
+        'predict': True,
+    }[stage]
+
+def _git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip()
+        return f"{commit}-dirty" if dirty else commit
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def _settings(args, scale):
+    """Settings that must match for two results to be comparable."""
+    return {
+        'scale': scale, 'segment_size': args.segment_size, 'bands': args.bands, 'months': args.months,
+        'engine': args.engine, 'workers': args.workers, 'host': platform.node(), 'cpu_count': os.cpu_count(),
+    }
+
+def _previous_result(results_dir, settings):
+    for path in sorted(glob.glob(os.path.join(results_dir, '*.json')), reverse=True):
+        with open(path) as f:
+            result = json.load(f)
+        if result.get('settings') == settings:
+            return path, result
+    return None, None
+
+def compare(result, baseline, threshold):
+    """Returns [(stage, metric, baseline value, new value)] for metrics that grew beyond the threshold."""
+    regressions = []
+    for stage, metrics in result['stages'].items():
+        old = baseline.get('stages', {}).get(stage)
+        if old is None:
+            continue
+        for metric, min_delta in COMPARED_METRICS.items():
+            if metric in old and metrics[metric] > old[metric] * (1 + threshold) and metrics[metric] - old[metric] > min_delta:
+                regressions.append((stage, metric, old[metric], metrics[metric]))
+    return regressions
+
+def run_scale(args, scale):
+    """Benchmarks the selected stages at one scale. Returns (result, result path, regressions)."""
+    import synthetic
+    args.work_dir = os.path.abspath(os.path.join(args.data_root, f"scale_{scale}"))
+    config = benchmark_config(args)
+    output_dir, data_dir = _paths(args.work_dir)
+    dataset = synthetic.generate(config, output_dir, data_dir, scale, segment_size=args.segment_size, seed=args.seed)
+
+    stages = {}
+    last = max(STAGES.index(s) for s in args.stages)
+    for stage in STAGES[:last + 1]:
+        if stage in args.stages:
+            _remove(_stage_outputs(stage, config, output_dir))
+            _log(f"- [{scale}] Running stage '{stage}'...")
+            stages[stage] = _run_in_subprocess(args, stage)
+            _log(f"  - {stage}: {stages[stage]['wall_seconds']:.2f} s, peak {stages[stage]['peak_rss_mb']:.0f} MB")
+        elif not _prerequisite_done(stage, config, output_dir):
+            _log(f"- [{scale}] Running prerequisite stage '{stage}' (not timed)...")
+            _run_in_subprocess(args, stage)
+
+    settings = _settings(args, scale)
+    result = {
+        'commit': _git_commit(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'settings': settings,
+        'dataset': dataset,
+        'stages': stages,
+    }
+    results_dir = os.path.join(args.results_dir, str(scale))
+    os.makedirs(results_dir, exist_ok=True)
+    if args.baseline:
+        baseline_path = args.baseline
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+    else:
+        baseline_path, baseline = _previous_result(results_dir, settings)
+    result_path = os.path.join(results_dir, f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{result['commit']}.json")
+    with open(result_path, 'w') as f:
+        json.dump(result, f, indent=2)
+
+    regressions = compare(result, baseline, args.threshold) if baseline else []
+    if baseline:
+        _log(f"- [{scale}] Compared with {os.path.basename(baseline_path)} (commit {baseline.get('commit')}).")
+    else:
+        _log(f"- [{scale}] No earlier result with the same settings; this run is the new baseline.")
+    return result, result_path, regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="GeoCrop Analysis offline benchmarks")
+    parser.add_argument('--scales', type=int, nargs='+', default=[10000], help='Numbers of segments to benchmark (e.g. 10000 1000000 10000000)')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES), help='Stages to time')
+    parser.add_argument('--config', default='config.test.yaml', help='Base configuration file')
+    parser.add_argument('--engine', default='hist_gbm', choices=['hist_gbm', 'tpot'], help='Modeling engine for the train stage')
+    parser.add_argument('--workers', type=int, default=4, help='Worker processes for segmentation, extraction and inference')
+    parser.add_argument('--segment-size', type=int, default=8, help='Side of the synthetic square segments, in pixels')
+    parser.add_argument('--bands', type=int, default=13, help='Bands of the segmentation composite')
+    parser.add_argument('--months', type=int, default=2, choices=range(1, 13), metavar='1-12', help='Monthly optical and radar mosaics to extract features from')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-root', default=os.path.join(REPO_DIR, '..', 'benchmark_data'), help='Where synthetic datasets are generated and kept')
+    parser.add_argument('--results-dir', default=os.path.join(BENCH_DIR, 'results'), help='Where results are saved')
+    parser.add_argument('--baseline', help='Result file to compare with instead of the previous result')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Relative increase in wall time or peak memory reported as a regression')
+    parser.add_argument('--stage-worker', choices=STAGES, help=argparse.SUPPRESS)
+    parser.add_argument('--work-dir', help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.stage_worker:
+        stage_worker(args)
+        return
+
+    all_regressions = []
+    for scale in args.scales:
+        result, result_path, regressions = run_scale(args, scale)
+        print(f"\n--- Scale {scale} ({result['dataset']['n_segments']} segments), commit {result['commit']} ---")
+        for stage, m in result['stages'].items():
+            print(f"  {stage:<8} {m['wall_seconds']:>9.2f} s  cpu {m['cpu_seconds']:>9.2f} s  peak {m['peak_rss_mb']:>8.0f} MB")
+        for stage, metric, old, new in regressions:
+            print(f"  REGRESSION {stage} {metric}: {old:.2f} -> {new:.2f} ({(new / old - 1) * 100:+.0f}%)")
+        print(f"  Saved to {result_path}")
+        all_regressions.extend(regressions)
+    if all_regressions:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+import os
+import sys
+import json
+import math
+import numpy as np
+import geopandas as gpd
+import rasterio
+import rasterio.windows
+import shapely
+from rasterio.transform import from_origin
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+from main import build_image_list
+from processing import vector_io
+from instrumentation import log as _log
+
+CRS = 'EPSG:32612'
+PIXEL_SIZE = 30.0
+ORIGIN = (500000.0, 3100000.0)
+BLOCKSIZE = 512
+# Rows of pixels generated and written at a time
+STRIP_ROWS = 2048
+
+def grid_shape(n_segments, segment_size):
+    """(segment rows, segment columns, raster height, raster width) for about `n_segments` square segments."""
+    n_cols = math.ceil(math.sqrt(n_segments))
+    n_rows = math.ceil(n_segments / n_cols)
+    return n_rows, n_cols, n_rows * segment_size, n_cols * segment_size
+
+def _segment_ids(row_off, n_rows, width, segment_size, n_cols):
+    """Segment IDs (1-based) of a strip of pixel rows."""
+    rows = np.arange(row_off, row_off + n_rows) // segment_size
+    cols = np.arange(width) // segment_size
+    return (rows[:, None] * n_cols + cols[None, :] + 1).astype(np.uint32)
+
+def _profile(width, height, count, dtype):
+    return {
+        'driver': 'GTiff', 'width': width, 'height': height, 'count': count, 'dtype': dtype,
+        'crs': CRS, 'transform': from_origin(ORIGIN[0], ORIGIN[1], PIXEL_SIZE, PIXEL_SIZE),
+        'tiled': True, 'blockxsize': BLOCKSIZE, 'blockysize': BLOCKSIZE, 'compress': 'LZW', 'BIGTIFF': 'IF_SAFER',
+    }
+
+def _write_clumps(path, n_cols, height, width, segment_size):
+    with rasterio.open(path, 'w', **_profile(width, height, 1, 'uint32')) as dst:
+        for row_off in range(0, height, STRIP_ROWS):
+            n = min(STRIP_ROWS, height - row_off)
+            window = rasterio.windows.Window(0, row_off, width, n)
+            dst.write(_segment_ids(row_off, n, width, segment_size, n_cols), 1, window=window)
+
+def _write_image(path, n_bands, classes, offsets, n_cols, height, width, segment_size, rng):
+    """Writes a float32 image whose per-segment means depend on the segment's class, plus pixel noise."""
+    n_classes = int(classes.max()) + 1
+    class_means = rng.uniform(0.05, 0.5, size=(n_classes, n_bands)).astype(np.float32)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with rasterio.open(path, 'w', **_profile(width, height, n_bands, 'float32')) as dst:
+        for row_off in range(0, height, STRIP_ROWS):
+            n = min(STRIP_ROWS, height - row_off)
+            ids = _segment_ids(row_off, n, width, segment_size, n_cols)
+            base = offsets[ids]
+            window = rasterio.windows.Window(0, row_off, width, n)
+            for b in range(n_bands):
+                data = class_means[classes[ids], b] + base + rng.normal(0, 0.01, size=ids.shape).astype(np.float32)
+                dst.write(data, b + 1, window=window)
+
+def _segment_boxes(ids, n_cols, segment_size, inset=0.0):
+    """Map-coordinate boxes of segments, optionally shrunk by `inset` pixels on each side."""
+    rows, cols = (ids - 1) // n_cols, (ids - 1) % n_cols
+    size = segment_size * PIXEL_SIZE
+    xmin = ORIGIN[0] + cols * size + inset * PIXEL_SIZE
+    ymax = ORIGIN[1] - rows * size - inset * PIXEL_SIZE
+    return shapely.box(xmin, ymax - size + 2 * inset * PIXEL_SIZE, xmin + size - 2 * inset * PIXEL_SIZE, ymax)
+
+def _write_polygons(path, n_segments_grid, n_cols, segment_size, chunk_size=500000):
+    writer = vector_io.VectorBatchWriter(path, CRS)
+    for start in range(1, n_segments_grid + 1, chunk_size):
+        ids = np.arange(start, min(start + chunk_size, n_segments_grid + 1), dtype=np.int64)
+        writer.write(gpd.GeoDataFrame({'raster_val': ids}, geometry=_segment_boxes(ids, n_cols, segment_size), crs=CRS))
+    writer.close()
+
+def _write_labels(path, label_field, classes, n_segments_grid, n_cols, segment_size, label_fraction, rng, chunk_size=500000):
+    """Label polygons inside a random subset of segments, carrying the segment's class."""
+    n_labels = max(1, int(n_segments_grid * label_fraction))
+    ids = np.sort(rng.choice(n_segments_grid, size=n_labels, replace=False) + 1)
+    inset = 1.0 if segment_size > 2 else 0.25
+    writer = vector_io.VectorBatchWriter(path, CRS)
+    for start in range(0, n_labels, chunk_size):
+        chunk = ids[start:start + chunk_size]
+        names = np.char.add('class_', classes[chunk].astype(str))
+        writer.write(gpd.GeoDataFrame({label_field: names}, geometry=_segment_boxes(chunk, n_cols, segment_size, inset), crs=CRS))
+    writer.close()
+    return n_labels
+
+def generate(config, output_dir, data_dir, n_segments, segment_size=8, n_classes=5, label_fraction=0.05, seed=0):
+    """Writes a synthetic dataset laid out like a pipeline run for `config`.
+
+    Produces the segmentation composite and the monthly optical and radar
+    mosaics (at the paths `build_image_list` expects), a clumps raster and
+    GeoParquet polygons of a grid of square segments, and label polygons for
+    `label_fraction` of the segments. Generation is skipped when a dataset with
+    the same parameters already exists.
+    """
+    n_rows, n_cols, height, width = grid_shape(n_segments, segment_size)
+    n_segments_grid = n_rows * n_cols
+    params = {
+        'n_segments': n_segments_grid, 'segment_size': segment_size, 'n_classes': n_classes,
+        'label_fraction': label_fraction, 'seed': seed, 'width': width, 'height': height,
+        'bands': len(config['segmentation_params']['bands']),
+        'study_period': config['study_period'],
+    }
+    marker_path = os.path.join(output_dir, 'synthetic.json')
+    if os.path.exists(marker_path):
+        with open(marker_path) as f:
+            if json.load(f) == params:
+                _log(f"- Synthetic dataset already exists in {output_dir}. Skipping generation.")
+                return params
+        os.remove(marker_path)
+
+    _log(f"- Generating {n_segments_grid} segments on a {width}x{height} grid in {output_dir}")
+    rng = np.random.default_rng(seed)
+    classes = rng.integers(0, n_classes, size=n_segments_grid + 1).astype(np.uint8)
+    offsets = rng.normal(0, 0.02, size=n_segments_grid + 1).astype(np.float32)
+
+    segmentation_dir = os.path.join(output_dir, 'segmentation')
+    os.makedirs(segmentation_dir, exist_ok=True)
+    names = config['output_names']
+    _write_clumps(os.path.join(segmentation_dir, names['segmented_clumps'].replace('.kea', '.tif')), n_cols, height, width, segment_size)
+    _write_polygons(os.path.join(segmentation_dir, names['segmented_polygons']), n_segments_grid, n_cols, segment_size)
+
+    for image in build_image_list(config, output_dir):
+        n_bands = params['bands'] if image['prefix'] == 'gm_' else (2 if image['prefix'].startswith('sar_') else 6)
+        _log(f"  - Writing {os.path.basename(image['path'])} ({n_bands} bands)")
+        _write_image(image['path'], n_bands, classes, offsets, n_cols, height, width, segment_size, rng)
+
+    labels_dir = os.path.join(data_dir, 'labels')
+    os.makedirs(labels_dir, exist_ok=True)
+    labels_path = os.path.join(labels_dir, config['labels_file'])
+    if os.path.exists(labels_path):
+        os.remove(labels_path)
+    params['n_labels'] = _write_labels(labels_path, config['labels_field_name'], classes, n_segments_grid, n_cols, segment_size, label_fraction, rng)
+
+    with open(marker_path, 'w') as f:
+        json.dump({k: v for k, v in params.items() if k != 'n_labels'}, f, indent=2)
+    return params
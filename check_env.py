@@ -21,8 +21,12 @@ def main():
         ("Earth Engine API", "ee"),
         ("PyShepSeg", "pyshepseg"),
         ("ExactExtract", "exactextract"),
+        ("Pyogrio", "pyogrio"),
+        ("PyArrow", "pyarrow"),
         ("Scikit-Image", "skimage"),
-        ("Scikit-Learn", "sklearn")
+        ("Scikit-Learn", "sklearn"),
+        ("Dask Distributed", "distributed"),
+        ("Dask-ML", "dask_ml")
     ]
     
     success_count = 0
@@ -0,0 +1,145 @@
+import os
+import json
+import time
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+
+from config import load_config
+import main as pipeline
+from instrumentation import log as _log
+
+# Job keys that control scheduling; every other key overrides the job's config
+JOB_KEYS = ('name', 'config', 'phase', 'prediction_year')
+
+def _normalize_job(job, index, default_config_path):
+    prediction_year = job.get('prediction_year')
+    config_path = job.get('config', default_config_path)
+    overrides = {k: v for k, v in job.items() if k not in JOB_KEYS}
+    aoi_file = overrides.get('aoi_file') or load_config(config_path)['aoi_file']
+    return {
+        'name': job.get('name') or f"{os.path.splitext(aoi_file)[0]}_{prediction_year or 'reference'}",
+        'index': index,
+        'config': config_path,
+        'phase': job.get('phase') or ('predict_full_run' if prediction_year is not None else 'full_run'),
+        'prediction_year': prediction_year,
+        'aoi_file': aoi_file,
+        'overrides': overrides,
+        # Prediction jobs use the model trained by the reference job of the same AOI and config
+        'reference_key': (config_path, aoi_file),
+    }
+
+def _job_config(job):
+    """Loads the job's config and applies its overrides (sections are merged one level deep)."""
+    config = load_config(job['config'])
+    for key, value in job['overrides'].items():
+        if isinstance(value, dict) and isinstance(config.get(key), dict):
+            config[key] = {**config[key], **value}
+        else:
+            config[key] = value
+    return config
+
+def _init_worker(semaphores):
+    pipeline.set_phase_semaphores(semaphores)
+
+def _run_job(job):
+    """Runs one job in a worker process and reports its outcome instead of raising."""
+    start = time.time()
+    result = {
+        'name': job['name'],
+        'aoi_file': job['aoi_file'],
+        'prediction_year': job['prediction_year'],
+        'phase': job['phase'],
+        'status': 'ok',
+        'error': None,
+        'phases': {},
+    }
+    try:
+        phases = pipeline.run_pipeline(_job_config(job), job['phase'], prediction_year=job['prediction_year'], config_path=job['config'])
+        if phases is None:
+            result.update(status='failed', error='Pipeline stopped on an error; see the job log.')
+        else:
+            result['phases'] = phases
+    except Exception as e:
+        result.update(status='failed', error=f"{type(e).__name__}: {e}", traceback=traceback.format_exc())
+    result['duration_seconds'] = time.time() - start
+    return result
+
+def run_batch(batch_path, default_config_path='config.yaml'):
+    """Runs a list of (AOI, year) jobs over a process pool and writes a JSON summary.
+
+    The batch file lists `jobs`; each job may set `config`, `phase`,
+    `prediction_year`, `name`, and any config key to override (e.g.
+    `aoi_file`, `labels_file`). `max_workers` sizes the pool and
+    `phase_limits` caps how many jobs run a phase at once (e.g. one `train`,
+    two `download`). Worker processes are reused across jobs, so imports,
+    the HTTP session and the Earth Engine client are shared by the jobs a
+    worker runs. A loaded model is only shared when `predict_n_jobs` is 1;
+    with more, each job's prediction pool loads the model again. Prediction
+    jobs start once the reference job of their AOI (if it is in the batch) has
+    finished, and are skipped if it failed.
+    """
+    spec = load_config(batch_path)
+    jobs = [_normalize_job(job, i, spec.get('config', default_config_path)) for i, job in enumerate(spec['jobs'])]
+    # Results and the summary are keyed by job name, so a repeated name would silently drop a job
+    seen = set()
+    duplicates = sorted({job['name'] for job in jobs if job['name'] in seen or seen.add(job['name'])})
+    if duplicates:
+        raise ValueError(f"Duplicate batch job names: {duplicates}. Give each job a unique 'name'.")
+    max_workers = spec.get('max_workers') or min(len(jobs), os.cpu_count() or 1)
+    phase_limits = spec.get('phase_limits') or {}
+    summary_path = spec.get('summary_file') or os.path.join(
+        load_config(spec.get('config', default_config_path))['output_dir'],
+        f"batch_summary_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    _log(f"--- Batch: {len(jobs)} jobs, {max_workers} workers, phase limits: {phase_limits} ---")
+
+    reference_jobs = {job['reference_key']: job['name'] for job in jobs if job['prediction_year'] is None}
+    results = {}
+    batch_start = time.time()
+    with multiprocessing.Manager() as manager:
+        semaphores = {phase: manager.Semaphore(limit) for phase, limit in phase_limits.items()}
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(semaphores,)) as executor:
+            pending = list(jobs)
+            running = {}
+            while pending or running:
+                for job in list(pending):
+                    reference = reference_jobs.get(job['reference_key']) if job['prediction_year'] is not None else None
+                    if reference is not None and reference not in results:
+                        continue
+                    pending.remove(job)
+                    if reference is not None and results[reference]['status'] != 'ok':
+                        _log(f"Skipping job '{job['name']}': its reference job '{reference}' failed.")
+                        results[job['name']] = {
+                            'name': job['name'], 'aoi_file': job['aoi_file'], 'prediction_year': job['prediction_year'],
+                            'phase': job['phase'], 'status': 'skipped', 'error': f"Reference job '{reference}' failed.",
+                            'phases': {}, 'duration_seconds': 0.0,
+                        }
+                        continue
+                    _log(f"Starting job '{job['name']}' ({job['phase']})")
+                    running[executor.submit(_run_job, job)] = job
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    result = future.result()
+                    results[job['name']] = result
+                    _log(f"Job '{job['name']}' {result['status']} in {result['duration_seconds']:.1f} seconds.")
+
+    ordered = [results[job['name']] for job in jobs]
+    summary = {
+        'batch_file': batch_path,
+        'total_duration_seconds': time.time() - batch_start,
+        'jobs_ok': sum(r['status'] == 'ok' for r in ordered),
+        'jobs_failed': sum(r['status'] == 'failed' for r in ordered),
+        'jobs_skipped': sum(r['status'] == 'skipped' for r in ordered),
+        'jobs': ordered,
+    }
+    os.makedirs(os.path.dirname(summary_path) or '.', exist_ok=True)
+    part_path = f"{summary_path}.part"
+    with open(part_path, 'w') as f:
+        json.dump(summary, f, indent=2)
+    os.replace(part_path, summary_path)
+    _log(f"--- Batch finished: {summary['jobs_ok']} ok, {summary['jobs_failed']} failed, {summary['jobs_skipped']} skipped. Summary: {summary_path} ---")
+    return summary
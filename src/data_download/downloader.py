@@ -0,0 +1,201 @@
+import os
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import instrumentation
+from instrumentation import log as _log
+
+# Responses that mean "slow down"; these and any 5xx are retried, other errors are not.
+THROTTLE_STATUS = {429, 503}
+
+def _is_retryable(status_code):
+    return status_code == 429 or status_code >= 500
+
+class _RetryableStatus(Exception):
+    """Raised for HTTP responses that should be retried after a backoff."""
+    def __init__(self, status_code, retry_after=None):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+class _IncompleteDownload(Exception):
+    """Raised when a response body is shorter than its Content-Length."""
+
+class _AdaptiveLimiter:
+    """Caps the number of in-flight downloads.
+
+    The cap is halved whenever the server throttles us (HTTP 429/503) and is
+    raised by one again after a run of successful downloads.
+    """
+    def __init__(self, max_workers):
+        self._max = max(1, max_workers)
+        self._limit = self._max
+        self._active = 0
+        self._successes = 0
+        self._cond = threading.Condition()
+
+    @property
+    def limit(self):
+        return self._limit
+
+    def acquire(self):
+        with self._cond:
+            while self._active >= self._limit:
+                self._cond.wait()
+            self._active += 1
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    def throttle(self):
+        with self._cond:
+            new_limit = max(1, self._limit // 2)
+            if new_limit < self._limit:
+                _log(f"    - Server is throttling. Lowering concurrency to {new_limit}.")
+            self._limit = new_limit
+            self._successes = 0
+
+    def success(self):
+        with self._cond:
+            self._successes += 1
+            if self._limit < self._max and self._successes >= self._limit:
+                self._limit += 1
+                self._successes = 0
+                self._cond.notify_all()
+
+def create_session(pool_size=8):
+    """Creates a requests.Session whose connection pool fits `pool_size` workers."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+# Sessions reused by every download in this process, keyed by pool size
+_shared_sessions = {}
+
+def shared_session(pool_size=8):
+    """A process-wide session, so connections are reused across composites and batch jobs."""
+    if pool_size not in _shared_sessions:
+        _shared_sessions[pool_size] = create_session(pool_size)
+    return _shared_sessions[pool_size]
+
+def _backoff_delay(attempt, base, cap, retry_after=None):
+    """Exponential backoff with full jitter, honouring a server Retry-After if given."""
+    if retry_after is not None:
+        return min(cap, retry_after)
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+def _parse_retry_after(response):
+    value = response.headers.get('Retry-After')
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+def _fetch(session, source, file_path, timeout, limiter):
+    """Performs one download attempt, writing to a temporary file and renaming it into place."""
+    url = source() if callable(source) else source
+    part_path = f"{file_path}.part"
+    start = time.time()
+    with session.get(url, stream=True, timeout=timeout) as response:
+        if _is_retryable(response.status_code):
+            if response.status_code in THROTTLE_STATUS:
+                limiter.throttle()
+            raise _RetryableStatus(response.status_code, _parse_retry_after(response))
+        response.raise_for_status()
+        n_bytes = 0
+        with open(part_path, 'wb') as out_file:
+            for chunk in response.iter_content(chunk_size=1024 * 1024):
+                out_file.write(chunk)
+                n_bytes += len(chunk)
+        expected = response.headers.get('Content-Length')
+        if expected is not None and 'Content-Encoding' not in response.headers and n_bytes < int(expected):
+            raise _IncompleteDownload(f"received {n_bytes} of {expected} bytes")
+    os.replace(part_path, file_path)
+    return n_bytes, time.time() - start
+
+def _download_one(session, source, file_path, limiter, max_retries, backoff_base, backoff_max, timeout, retry_exceptions, parent_span=None):
+    name = os.path.basename(file_path)
+    with instrumentation.span(name, 'tile', parent=parent_span) as span:
+        return _download_with_retries(session, source, file_path, limiter, max_retries, backoff_base, backoff_max, timeout, retry_exceptions, span)
+
+def _download_with_retries(session, source, file_path, limiter, max_retries, backoff_base, backoff_max, timeout, retry_exceptions, span):
+    name = os.path.basename(file_path)
+    for attempt in range(max_retries):
+        retry_after = None
+        limiter.acquire()
+        try:
+            n_bytes, elapsed = _fetch(session, source, file_path, timeout, limiter)
+            limiter.success()
+            span.count('bytes_downloaded', n_bytes)
+            span.count('attempts', attempt + 1)
+            mb = n_bytes / (1024 * 1024)
+            _log(f"  - Downloaded {name}: {mb:.2f} MB in {elapsed:.1f} s ({mb / max(elapsed, 1e-6):.2f} MB/s).")
+            return True
+        except _RetryableStatus as e:
+            retry_after = e.retry_after
+            _log(f"    - {name}: attempt {attempt + 1} failed: {e}")
+        except requests.exceptions.HTTPError as e:
+            # Any other HTTP error (e.g. 400, 403, 404) will not go away by asking again
+            _log(f"  - FAILED (not retrying): {name}: {e}")
+            span.count('attempts', attempt + 1)
+            span.attrs['failed'] = True
+            return False
+        except (requests.exceptions.RequestException, OSError, _IncompleteDownload) + tuple(retry_exceptions) as e:
+            _log(f"    - {name}: attempt {attempt + 1} failed: {e}")
+        finally:
+            limiter.release()
+        if os.path.exists(f"{file_path}.part"):
+            os.remove(f"{file_path}.part")
+        if attempt + 1 < max_retries:
+            time.sleep(_backoff_delay(attempt, backoff_base, backoff_max, retry_after))
+    _log(f"  - FAILED after {max_retries} attempts: {name}")
+    span.count('attempts', max_retries)
+    span.attrs['failed'] = True
+    return False
+
+def download_tiles(tasks, max_workers=8, max_retries=5, backoff_base=2.0, backoff_max=120.0,
+                   timeout=600, session=None, retry_exceptions=(), on_tile_complete=None):
+    """Downloads tiles concurrently over a shared HTTP session.
+
+    `tasks` is a list of `(source, file_path)` pairs, where `source` is either a
+    URL or a callable returning one (so that URL generation is retried and runs
+    in the worker too). Exceptions listed in `retry_exceptions` are retried in
+    addition to network errors. `on_tile_complete(file_path)` is called from the
+    calling thread as soon as a tile is on disk.
+
+    Returns a dict mapping each file path to True (downloaded) or False (failed).
+    """
+    if not tasks:
+        return {}
+    own_session = session is None
+    if own_session:
+        session = create_session(max_workers)
+    limiter = _AdaptiveLimiter(max_workers)
+    results = {}
+    start = time.time()
+    try:
+        with instrumentation.span('download_tiles', 'batch') as span, ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(_download_one, session, source, file_path, limiter, max_retries,
+                                backoff_base, backoff_max, timeout, retry_exceptions, span): file_path
+                for source, file_path in tasks
+            }
+            for future in as_completed(futures):
+                file_path = futures[future]
+                results[file_path] = future.result()
+                span.count('tiles' if results[file_path] else 'tiles_failed')
+                if results[file_path] and on_tile_complete is not None:
+                    on_tile_complete(file_path)
+    finally:
+        if own_session:
+            session.close()
+    n_ok = sum(results.values())
+    _log(f"- Downloaded {n_ok}/{len(tasks)} tiles in {time.time() - start:.1f} s (final concurrency: {limiter.limit}).")
+    return results
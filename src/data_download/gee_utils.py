@@ -1,14 +1,20 @@
 import ee
 import math
 
+_initialized = False
+
 def initialize_gee():
-    """Authenticates and initializes the Earth Engine API."""
+    """Authenticates and initializes the Earth Engine API (once per process)."""
+    global _initialized
+    if _initialized:
+        return
     try:
         ee.Initialize()
     except Exception:
         print("Earth Engine not initialized. Running authentication.")
         ee.Authenticate()
         ee.Initialize()
+    _initialized = True
 
 def hls_mask(image):
     """Masks clouds, shadows, and snow from HLS imagery."""
@@ -87,11 +93,33 @@ def scale_bands(image):
     derived = image.select(['NDVI','EVI','GCVI','MSAVI2','LSWI','NDSVI','NDTI'])
     return scaled_base.addBands(derived)
 
-def split_geometry(geometry, max_dim=0.2):
-    """Splits a larger geometry into a grid of smaller rectangles."""
+def geometry_bounds(geometry):
+    """Returns the (minX, minY, maxX, maxY) bounds of an ee.Geometry."""
     bounds = geometry.bounds().getInfo()['coordinates'][0]
     minX, minY = bounds[0]
     maxX, maxY = bounds[2]
+    return minX, minY, maxX, maxY
+
+def geojson_bounds(geojson):
+    """Computes the (minX, minY, maxX, maxY) bounds of a GeoJSON geometry locally."""
+    xs, ys = [], []
+    def _walk(coords):
+        if isinstance(coords[0], (int, float)):
+            xs.append(coords[0])
+            ys.append(coords[1])
+        else:
+            for c in coords:
+                _walk(c)
+    if geojson['type'] == 'GeometryCollection':
+        for geometry in geojson['geometries']:
+            _walk(geometry['coordinates'])
+    else:
+        _walk(geojson['coordinates'])
+    return min(xs), min(ys), max(xs), max(ys)
+
+def split_bounds(bounds, max_dim=0.2):
+    """Splits a (minX, minY, maxX, maxY) box into a grid of smaller boxes."""
+    minX, minY, maxX, maxY = bounds
     width = maxX - minX
     height = maxY - minY
 
@@ -101,13 +129,20 @@ def split_geometry(geometry, max_dim=0.2):
     x_step_size = width / x_steps
     y_step_size = height / y_steps
 
-    regions = []
+    tiles = []
     for i in range(x_steps):
         for j in range(y_steps):
-            region = ee.Geometry.Rectangle(
-                [minX + i * x_step_size,
-                 minY + j * y_step_size,
-                 minX + (i + 1) * x_step_size,
-                 minY + (j + 1) * y_step_size])
-            regions.append(region)
-    return regions
+            tiles.append((minX + i * x_step_size,
+                          minY + j * y_step_size,
+                          minX + (i + 1) * x_step_size,
+                          minY + (j + 1) * y_step_size))
+    return tiles
+
+def bounds_to_coords(bounds):
+    """Returns the GeoJSON polygon coordinates of a (minX, minY, maxX, maxY) box."""
+    minX, minY, maxX, maxY = bounds
+    return [[[minX, minY], [maxX, minY], [maxX, maxY], [minX, maxY], [minX, minY]]]
+
+def split_geometry(geometry, max_dim=0.2):
+    """Splits a larger geometry into a grid of smaller rectangles."""
+    return [ee.Geometry.Rectangle(list(tile)) for tile in split_bounds(geometry_bounds(geometry), max_dim)]
@@ -0,0 +1,49 @@
+import ee
+import os
+import json
+import hashlib
+from instrumentation import log as _log
+
+def cache_key(aoi_geojson, date_ranges):
+    """Builds a stable key from the AOI geometry and the requested date ranges."""
+    payload = json.dumps({'aoi': aoi_geojson, 'date_ranges': date_ranges}, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def _load_cache(cache_path):
+    if not os.path.exists(cache_path):
+        return {}
+    try:
+        with open(cache_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        _log(f"- WARNING: Ignoring unreadable metadata cache: {cache_path}")
+        return {}
+
+def _save_cache(cache_path, cache):
+    os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+    part_path = f"{cache_path}.part"
+    with open(part_path, 'w') as f:
+        json.dump(cache, f, indent=2)
+    os.replace(part_path, cache_path)
+
+def get_collection_sizes(collections, cache_path, key):
+    """Returns {name: image count} for a dict of ee.ImageCollections.
+
+    Uncached sizes are evaluated in a single batched ee.Dictionary round trip
+    and stored in an on-disk cache under `key`, so later runs skip the request.
+    Zero counts are not cached: images for a recent or current month may
+    still be ingested, so empty collections are asked again on the next run.
+    """
+    cache = _load_cache(cache_path)
+    cached = cache.get(key, {})
+    missing = {name: collection for name, collection in collections.items() if name not in cached}
+    if not missing:
+        _log(f"- Using cached collection sizes from {os.path.basename(cache_path)}.")
+        return {name: cached[name] for name in collections}
+
+    _log(f"- Querying image counts for {len(missing)} collections in one batched request...")
+    sizes = ee.Dictionary({name: collection.size() for name, collection in missing.items()}).getInfo()
+    cached.update({name: size for name, size in sizes.items() if size > 0})
+    cache[key] = cached
+    _save_cache(cache_path, cache)
+    return {name: cached.get(name, sizes.get(name, 0)) for name in collections}
@@ -1,15 +1,7 @@
 import ee
 import os
-import requests
-import shutil
-import time
-from . import gee_utils
-
-def _log(message):
-    """Prints a message with a timestamp."""
-    # This is a local log function to avoid circular dependencies if main's log is moved
-    from datetime import datetime
-    print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {message}")
+from . import gee_utils, downloader
+from instrumentation import log as _log
 
 def get_hls_collection(start_date, end_date, study_area):
     """Gets and merges HLS Landsat and Sentinel collections for a given period."""
@@ -32,37 +24,30 @@ def get_geometric_median(collection):
     num_bands = scaled_collection.first().bandNames().length()
     return scaled_collection.reduce(ee.Reducer.geometricMedian(num_bands)).toInt16()
 
-def _download_tile(image, region_coords, scale, file_path):
-    """Internal function to download a single tile, with retries."""
-    _log(f"  - Downloading: {os.path.basename(file_path)}")
-    url = image.getDownloadURL({
-        'region': region_coords,
-        'scale': scale,
-        'format': 'GEO_TIFF',
-        'crs': 'EPSG:4326'
-    })
+def _tile_url(image, region_coords, scale):
+    """Returns a callable that asks Earth Engine for the download URL of one tile."""
+    def _get_url():
+        return image.getDownloadURL({
+            'region': region_coords,
+            'scale': scale,
+            'format': 'GEO_TIFF',
+            'crs': 'EPSG:4326'
+        })
+    return _get_url
 
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            response = requests.get(url, stream=True, timeout=600) # Increased timeout
-            response.raise_for_status()
-            with open(file_path, 'wb') as out_file:
-                shutil.copyfileobj(response.raw, out_file)
-            _log(f"    - Success.")
-            return True
-        except (requests.exceptions.RequestException, ee.EEException) as e:
-            _log(f"    - Attempt {attempt + 1} failed: {e}")
-            time.sleep(5)
-    _log(f"  - FAILED after {max_retries} attempts: {os.path.basename(file_path)}")
-    return False
+def download_composite(image, study_area, output_path, max_dim=0.2, scale=30, download_params=None, sink=None, aoi_bounds=None):
+    """Downloads a composite image, splitting it into tiles fetched concurrently.
 
-def download_composite(image, study_area, output_path, max_dim=0.2, scale=30):
-    """Downloads a composite image, splitting it into individually validated tiles."""
+    If a `sink` (e.g. a StreamingMosaicWriter) is given, it is told the tile
+    footprints up front and receives each tile as soon as it is on disk.
+    Passing `aoi_bounds` (computed locally) avoids asking Earth Engine for them.
+    """
     if os.path.exists(output_path):
         _log(f"- Final composite already exists: {os.path.basename(output_path)}. Skipping download.")
         return True
 
+    download_params = download_params or {}
+
     # Create a dedicated directory for the tiles of this specific composite
     output_dir = os.path.dirname(output_path)
     composite_name = os.path.splitext(os.path.basename(output_path))[0]
@@ -70,22 +55,41 @@ def download_composite(image, study_area, output_path, max_dim=0.2, scale=30):
     os.makedirs(tile_dir, exist_ok=True)
     _log(f"- Using temporary tile directory: {tile_dir}")
 
-    regions = gee_utils.split_geometry(study_area, max_dim)
-    _log(f"- Splitting AOI into {len(regions)} tiles for download.")
+    if aoi_bounds is None:
+        aoi_bounds = gee_utils.geometry_bounds(study_area)
+    tile_bounds = gee_utils.split_bounds(aoi_bounds, max_dim)
+    _log(f"- Splitting AOI into {len(tile_bounds)} tiles for download.")
+    if sink is not None:
+        sink.start(tile_bounds, tile_dir)
 
-    all_tiles_present = True
     tile_paths = []
-    for i, region in enumerate(regions):
+    tasks = []
+    for i, bounds in enumerate(tile_bounds):
         tile_path = os.path.join(tile_dir, f"tile_{i}.tif")
         tile_paths.append(tile_path)
-        if not os.path.exists(tile_path):
-            if not _download_tile(image, region.getInfo()['coordinates'], scale, tile_path):
-                all_tiles_present = False # Mark that at least one tile failed
-        else:
+        if sink is not None and sink.is_merged(tile_path):
+            _log(f"  - Tile already merged: {os.path.basename(tile_path)}")
+        elif os.path.exists(tile_path):
             _log(f"  - Tile already exists: {os.path.basename(tile_path)}")
+            if sink is not None:
+                sink.add_tile(tile_path)
+        else:
+            tasks.append((_tile_url(image, gee_utils.bounds_to_coords(bounds), scale), tile_path))
+
+    results = downloader.download_tiles(
+        tasks,
+        max_workers=download_params.get('max_workers', 8),
+        max_retries=download_params.get('max_retries', 5),
+        backoff_base=download_params.get('backoff_base', 2.0),
+        backoff_max=download_params.get('backoff_max', 120.0),
+        timeout=download_params.get('timeout', 600),
+        session=downloader.shared_session(download_params.get('max_workers', 8)),
+        retry_exceptions=(ee.EEException,),
+        on_tile_complete=sink.add_tile if sink is not None else None
+    )
 
-    if not all_tiles_present:
+    if not all(results.values()):
         _log("- Download failed for one or more tiles. Cannot merge. Please check errors above.")
         return False
     
-    return tile_paths # Return the list of paths for the main script to merge
\ No newline at end of file
+    return tile_paths # Return the list of tile paths (already handed to the sink, if any)
\ No newline at end of file
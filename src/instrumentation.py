@@ -0,0 +1,319 @@
+import os
+import json
+import time
+import threading
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+def log(message):
+    """Prints a message with a timestamp."""
+    print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {message}")
+
+# --- Process counters ---
+# Read from /proc on Linux; elsewhere RSS falls back to the process's peak so
+# far and I/O counters are not available. Worker processes (feature
+# extraction, polygonize, inference, tiled segmentation) are measured
+# separately: their RSS is summed over the live descendants listed in /proc,
+# and their I/O comes from getrusage for the workers that exited.
+
+# What each span field measures, written with every record
+FIELD_SCOPES = {
+    'peak_rss_mb': 'this process, sampled',
+    'children_peak_rss_mb': 'sum over live worker processes, sampled (None where /proc lists no children)',
+    'total_peak_rss_mb': 'this process plus live worker processes, sampled together',
+    'read_bytes': 'this process, storage layer (/proc/self/io)',
+    'write_bytes': 'this process, storage layer (/proc/self/io)',
+    'children_read_bytes': 'worker processes that exited during the span (getrusage blocks)',
+    'children_write_bytes': 'worker processes that exited during the span (getrusage blocks)',
+    'cpu_seconds': 'this process',
+    'children_cpu_seconds': 'worker processes that exited during the span',
+}
+
+def _rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        return peak if os.uname().sysname == 'Darwin' else peak * 1024
+    return 0
+
+def _has_proc_children():
+    pid = os.getpid()
+    return os.path.exists(f"/proc/{pid}/task/{pid}/children")
+
+_PROC_CHILDREN = _has_proc_children()
+
+def _descendant_pids():
+    pids, stack = [], [os.getpid()]
+    while stack:
+        pid = stack.pop()
+        try:
+            for task in os.listdir(f"/proc/{pid}/task"):
+                with open(f"/proc/{pid}/task/{task}/children") as f:
+                    children = [int(c) for c in f.read().split()]
+                pids.extend(children)
+                stack.extend(children)
+        except (OSError, ValueError):
+            continue
+    return pids
+
+def _children_rss_bytes():
+    """Summed RSS of the live descendant processes, or None where /proc does not list them."""
+    if not _PROC_CHILDREN:
+        return None
+    total = 0
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    for pid in _descendant_pids():
+        try:
+            with open(f"/proc/{pid}/statm") as f:
+                total += int(f.read().split()[1]) * page_size
+        except (OSError, ValueError, IndexError):
+            continue  # exited meanwhile
+    return total
+
+def _children_io_bytes():
+    """(bytes read, bytes written) by exited child processes, from their block counts, or (None, None)."""
+    if resource is None:
+        return None, None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_inblock * 512, usage.ru_oublock * 512
+
+def _io_bytes():
+    """(bytes read, bytes written) by this process at the storage layer, or (None, None)."""
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines())
+        return int(fields['read_bytes']), int(fields['write_bytes'])
+    except (OSError, ValueError, KeyError):
+        return None, None
+
+def _cpu_seconds():
+    """(own CPU, CPU of finished child processes) in seconds."""
+    t = os.times()
+    return t.user + t.system, t.children_user + t.children_system
+
+class Span:
+    """One timed section of the pipeline (a phase, an image, a tile, a batch).
+
+    Records wall time, CPU time of the process and of worker processes that
+    finished during the span, peak RSS of the process and of its live worker
+    processes, bytes read and written by both, and any counts added with
+    `count` (tiles, segments, rows); `FIELD_SCOPES` says what each number
+    covers. CPU and I/O are process-wide, so spans that run at the same time
+    in different threads overlap in those numbers.
+    """
+    def __init__(self, name, category, parent=None, attrs=None):
+        self.name = name
+        self.category = category
+        self.parent = parent
+        self.attrs = attrs or {}
+        self.counts = {}
+        self.id = None
+        self.thread_id = threading.get_ident()
+        self.wall_seconds = None
+        self.record = None
+        self._peak_rss = 0
+        self._peak_children_rss = None
+        self._peak_total_rss = 0
+
+    def count(self, key, n=1):
+        self.counts[key] = self.counts.get(key, 0) + n
+
+    def _observe_rss(self, rss, children_rss=None):
+        if rss > self._peak_rss:
+            self._peak_rss = rss
+        if children_rss is not None and (self._peak_children_rss is None or children_rss > self._peak_children_rss):
+            self._peak_children_rss = children_rss
+        if rss + (children_rss or 0) > self._peak_total_rss:
+            self._peak_total_rss = rss + (children_rss or 0)
+
+    def start(self):
+        self.start_time = time.time()
+        self._start_perf = time.perf_counter()
+        self._start_cpu = _cpu_seconds()
+        self._start_io = _io_bytes()
+        self._start_children_io = _children_io_bytes()
+        self._observe_rss(_rss_bytes(), _children_rss_bytes())
+        return self
+
+    def finish(self):
+        self.wall_seconds = time.perf_counter() - self._start_perf
+        cpu, children_cpu = _cpu_seconds()
+        read_bytes, write_bytes = _io_bytes()
+        children_read, children_write = _children_io_bytes()
+        self._observe_rss(_rss_bytes(), _children_rss_bytes())
+        mb = 1024 * 1024
+        record = {
+            'id': self.id,
+            'parent': self.parent.id if self.parent is not None else None,
+            'name': self.name,
+            'category': self.category,
+            'start': self.start_time,
+            'wall_seconds': self.wall_seconds,
+            'cpu_seconds': cpu - self._start_cpu[0],
+            'children_cpu_seconds': children_cpu - self._start_cpu[1],
+            'peak_rss_mb': self._peak_rss / mb,
+            'children_peak_rss_mb': self._peak_children_rss / mb if self._peak_children_rss is not None else None,
+            'total_peak_rss_mb': self._peak_total_rss / mb,
+            'read_bytes': read_bytes - self._start_io[0] if read_bytes is not None else None,
+            'write_bytes': write_bytes - self._start_io[1] if write_bytes is not None else None,
+            'children_read_bytes': children_read - self._start_children_io[0] if children_read is not None else None,
+            'children_write_bytes': children_write - self._start_children_io[1] if children_write is not None else None,
+            'counts': self.counts,
+            'attrs': self.attrs,
+            'pid': os.getpid(),
+            'thread': self.thread_id,
+            'scopes': FIELD_SCOPES,
+        }
+        self.record = record
+        return record
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.attrs['error'] = f"{exc_type.__name__}: {exc}"
+        _end_span(self)
+        return False
+
+class Trace:
+    """Collects finished spans and writes them as JSON lines and as a Chrome trace.
+
+    The JSON lines file gets one record per span as it finishes. The Chrome
+    trace (`<prefix>.chrome.json`, open it in chrome://tracing or Perfetto) is
+    written on `close`, with the sampled RSS as a counter track.
+    """
+    def __init__(self, path_prefix, sample_interval=0.2):
+        self.jsonl_path = f"{path_prefix}.jsonl"
+        self.chrome_path = f"{path_prefix}.chrome.json"
+        os.makedirs(os.path.dirname(self.jsonl_path) or '.', exist_ok=True)
+        self._file = open(self.jsonl_path, 'w', buffering=1)
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._open = set()
+        self._events = []
+        self._rss_samples = []
+        self._stop = threading.Event()
+        self._sampler = None
+        if sample_interval:
+            # Spans are too coarse to catch short allocation peaks on their own
+            self._sampler = threading.Thread(target=self._sample, args=(sample_interval,), daemon=True)
+            self._sampler.start()
+
+    def _sample(self, interval):
+        while not self._stop.wait(interval):
+            rss, children_rss = _rss_bytes(), _children_rss_bytes()
+            with self._lock:
+                self._rss_samples.append((time.time(), rss, children_rss))
+                for span in self._open:
+                    span._observe_rss(rss, children_rss)
+
+    def begin(self, span):
+        with self._lock:
+            span.id = self._next_id
+            self._next_id += 1
+            self._open.add(span)
+
+    def end(self, span, record):
+        with self._lock:
+            self._open.discard(span)
+            self._file.write(json.dumps(record, default=str) + '\n')
+            self._events.append(record)
+
+    def close(self):
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        with self._lock:
+            self._file.close()
+            pid = os.getpid()
+            events = [{
+                'name': r['name'], 'cat': r['category'], 'ph': 'X',
+                'ts': r['start'] * 1e6, 'dur': r['wall_seconds'] * 1e6,
+                'pid': r['pid'], 'tid': r['thread'],
+                'args': {k: r[k] for k in FIELD_SCOPES} | r['counts'] | r['attrs'],
+            } for r in self._events]
+            events += [{'name': 'rss_mb', 'ph': 'C', 'ts': t * 1e6, 'pid': pid,
+                        'args': {'rss_mb': rss / (1024 * 1024), 'children_rss_mb': (children_rss or 0) / (1024 * 1024)}}
+                       for t, rss, children_rss in self._rss_samples]
+        part_path = f"{self.chrome_path}.part"
+        with open(part_path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms', 'metadata': {'scopes': FIELD_SCOPES}}, f, default=str)
+        os.replace(part_path, self.chrome_path)
+
+# The active trace of this process (None when tracing is off) and each thread's open spans
+_trace = None
+_local = threading.local()
+
+def _reset_in_child():
+    # Forked worker processes must not write into the parent's trace
+    global _trace
+    _trace = None
+    _local.__dict__.clear()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_in_child)
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+def span(name, category='span', parent=None, **attrs):
+    """Opens a span nested under the calling thread's current span; use it as a context manager.
+
+    Pass `parent` for work handed to another thread (e.g. `current()` taken
+    before submitting it). Spans are measured whether or not a trace is
+    active, so callers can use `wall_seconds` for their own logging.
+    """
+    stack = _stack()
+    if parent is None and stack:
+        parent = stack[-1]
+    s = Span(name, category, parent=parent, attrs=attrs)
+    if _trace is not None:
+        _trace.begin(s)
+    stack.append(s.start())
+    return s
+
+def _end_span(s):
+    stack = _stack()
+    if s in stack:
+        stack.remove(s)
+    record = s.finish()
+    if _trace is not None and s.id is not None:
+        _trace.end(s, record)
+
+def current():
+    """The calling thread's innermost open span, or None."""
+    stack = _stack()
+    return stack[-1] if stack else None
+
+def count(key, n=1):
+    """Adds to a count on the calling thread's current span (no-op outside a span)."""
+    s = current()
+    if s is not None:
+        s.count(key, n)
+
+def start_trace(path_prefix, sample_interval=0.2):
+    """Starts writing spans of this process to `<path_prefix>.jsonl` and `<path_prefix>.chrome.json`."""
+    global _trace
+    stop_trace()
+    _trace = Trace(path_prefix, sample_interval)
+    return _trace
+
+def stop_trace():
+    """Finishes the active trace, if any, and writes the Chrome trace file."""
+    global _trace
+    trace, _trace = _trace, None
+    if trace is not None:
+        trace.close()
+        log(f"Performance trace written to {trace.jsonl_path} and {trace.chrome_path}")
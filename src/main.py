@@ -1,6 +1,5 @@
 import os
 import glob
-import subprocess
 import geopandas as gpd
 import ee
 import argparse
@@ -9,47 +8,51 @@ from datetime import datetime
 import pandas as pd
 import shutil
 import json
-import sys
+import contextlib
 from dateutil.relativedelta import relativedelta
 
 from config import load_config
-from data_download import gee_utils, multispectral, radar
-from processing import segmentation, labeling, feature_extraction, modeling, mapping, compression
-
-def _log(message):
-    print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {message}")
+from data_download import gee_utils, multispectral, radar, metadata
+from processing import segmentation, labeling, feature_extraction, modeling, mapping, compression, mosaic, feature_store
+import manifest
+import instrumentation
+from instrumentation import log as _log
 
 def _generate_monthly_ranges(start_date, end_date):
     months = pd.date_range(start=start_date, end=end_date, freq='MS')
     return [(s.strftime('%Y-%m-%d'), (s + pd.offsets.MonthEnd(1)).strftime('%Y-%m-%d')) for s in months]
 
-def run_gdal_merge(tile_paths, output_image_path):
-    if not tile_paths or not isinstance(tile_paths, list):
-        _log(f"- No new tiles to merge for {os.path.basename(output_image_path)}.")
-        return
-    tile_dir = os.path.dirname(tile_paths[0])
-    _log(f"- Merging {len(tile_paths)} tiles from {os.path.basename(tile_dir)} into {os.path.basename(output_image_path)}")
+def _segmentation_range(config):
+    if config['segmentation_composite_uses_full_study_period']:
+        return config['study_period']['start_date'], config['study_period']['end_date']
+    return config['segmentation_composite_custom_range']['start_date'], config['segmentation_composite_custom_range']['end_date']
 
-    if sys.platform == "win32":
-        gdal_merge_script = os.path.join(os.path.dirname(sys.executable), 'Scripts', 'gdal_merge.py')
-    else:
-        gdal_merge_script = os.path.join(os.path.dirname(sys.executable), 'gdal_merge.py')
+def download_and_merge(image, study_area, output_path, config, aoi_bounds=None):
+    """Downloads a composite and streams its tiles into the final mosaic as they arrive.
 
-    if not os.path.exists(gdal_merge_script):
-        gdal_merge_script = shutil.which("gdal_merge.py")
-        if not gdal_merge_script:
-            _log(f"- GDAL Merge FAILED. Could not find 'gdal_merge.py'. Please ensure it is in your PATH.")
-            return
-
-    command = [sys.executable, gdal_merge_script, '-o', output_image_path, '-of', 'GTiff', '-co', 'COMPRESS=LZW'] + tile_paths
-    try:
-        subprocess.run(command, check=True, capture_output=True, text=True)
-        _log("- Merge successful.")
-        shutil.rmtree(tile_dir)
-    except subprocess.CalledProcessError as e:
-        error_message = e.stderr if e.stderr else str(e)
-        _log(f"- GDAL Merge FAILED. Error: {error_message.strip()}")
-        _log(f"- Temporary tiles kept for inspection in: {tile_dir}")
+    Returns True if the final mosaic exists afterwards.
+    """
+    mosaic_params = config.get('mosaic_params', {})
+    fmt = mosaic_params.get('format', 'GTiff')
+    final_path = mosaic.mosaic_output_path(output_path, fmt)
+    if os.path.exists(final_path):
+        _log(f"- Final composite already exists: {os.path.basename(final_path)}. Skipping download.")
+        return True
+    writer = mosaic.StreamingMosaicWriter(
+        output_path,
+        fmt=fmt,
+        compress=mosaic_params.get('compress', 'LZW'),
+        blocksize=mosaic_params.get('blocksize', 512),
+        overview_resampling=mosaic_params.get('overview_resampling', 'average')
+    )
+    with writer, instrumentation.span(os.path.basename(final_path), 'image') as span:
+        tile_paths = multispectral.download_composite(image, study_area, final_path, download_params=config.get('download_params', {}), sink=writer, aoi_bounds=aoi_bounds)
+        if not tile_paths or not isinstance(tile_paths, list):
+            return False
+        span.count('tiles', len(tile_paths))
+        with instrumentation.span('merge', 'mosaic'):
+            writer.finish()
+    return os.path.exists(final_path)
 
 def show_config(config_path, config_data):
     _log(f"--- Displaying settings from: {config_path} ---")
@@ -93,24 +96,46 @@ def run_cleanup_phase(output_dir):
         _log("- No tile directories found to clean up.")
         return
     for tile_dir in tile_dirs:
+        # A VRT mosaic reads its pixels from the tiles it was built over
+        vrt_path = f"{tile_dir[:-len('_tiles')]}.vrt"
+        if os.path.exists(vrt_path):
+            _log(f"- Keeping {tile_dir}: it holds the source tiles of {os.path.basename(vrt_path)}.")
+            continue
         _log(f"- Removing temporary tile directory: {tile_dir}")
         shutil.rmtree(tile_dir)
     _log("- Cleanup complete.")
 
-def run_download_phase(config, study_area, output_dir):
+def run_download_phase(config, study_area, output_dir, aoi_geojson=None):
+    """Downloads the segmentation composite and the monthly mosaics.
+
+    Returns True if every composite with images produced its mosaic, so a
+    failed month is retried on the next run instead of being recorded as done.
+    """
     monthly_ranges = _generate_monthly_ranges(config['study_period']['start_date'], config['study_period']['end_date'])
-    _log("--- Processing Main Segmentation Composite ---")
-    if config['segmentation_composite_uses_full_study_period']:
-        seg_start, seg_end = config['study_period']['start_date'], config['study_period']['end_date']
+    seg_start, seg_end = _segmentation_range(config)
+
+    # --- Build all collections up front and resolve their sizes in one request ---
+    collections = {'segmentation': multispectral.get_hls_collection(seg_start, seg_end, study_area)}
+    for start, end in monthly_ranges:
+        month_str = start[:7]
+        collections[f"hls_{month_str}"] = multispectral.get_hls_collection(start, end, study_area)
+        collections[f"s1_{month_str}"] = radar.get_s1_collection(start, end, study_area)
+    if aoi_geojson is not None:
+        aoi_bounds = gee_utils.geojson_bounds(aoi_geojson)
+        date_ranges = [[seg_start, seg_end]] + [list(r) for r in monthly_ranges]
+        key = metadata.cache_key(aoi_geojson, date_ranges)
+        sizes = metadata.get_collection_sizes(collections, os.path.join(output_dir, 'gee_metadata_cache.json'), key)
     else:
-        seg_start, seg_end = config['segmentation_composite_custom_range']['start_date'], config['segmentation_composite_custom_range']['end_date']
+        aoi_bounds = None
+        sizes = ee.Dictionary({name: c.size() for name, c in collections.items()}).getInfo()
+
+    complete = True
+    _log("--- Processing Main Segmentation Composite ---")
     seg_output_dir = os.path.join(output_dir, 'segmentation')
     main_composite_path = os.path.join(seg_output_dir, config['output_names']['segmentation_image'])
-    hls_collection = multispectral.get_hls_collection(seg_start, seg_end, study_area)
-    if hls_collection.size().getInfo() > 0:
-        main_composite = multispectral.get_geometric_median(hls_collection)
-        tile_paths = multispectral.download_composite(main_composite, study_area, main_composite_path)
-        run_gdal_merge(tile_paths, main_composite_path)
+    if sizes['segmentation'] > 0:
+        main_composite = multispectral.get_geometric_median(collections['segmentation'])
+        complete &= download_and_merge(main_composite, study_area, main_composite_path, config, aoi_bounds)
     else:
         _log(f"No images found for the main composite period. Skipping.")
     _log("--- Processing Monthly Composites ---")
@@ -119,139 +144,381 @@ def run_download_phase(config, study_area, output_dir):
         _log(f"-- Processing month: {month_str} --")
         optical_dir = os.path.join(output_dir, 'multispectral', month_str)
         optical_path = os.path.join(optical_dir, f"multispectral_{month_str}.tif")
-        hls_monthly = multispectral.get_hls_collection(start, end, study_area)
-        if hls_monthly.size().getInfo() > 0:
-            optical_composite = multispectral.get_geometric_median(hls_monthly)
-            tile_paths_opt = multispectral.download_composite(optical_composite, study_area, optical_path)
-            run_gdal_merge(tile_paths_opt, optical_path)
+        if sizes[f"hls_{month_str}"] > 0:
+            optical_composite = multispectral.get_geometric_median(collections[f"hls_{month_str}"])
+            complete &= download_and_merge(optical_composite, study_area, optical_path, config, aoi_bounds)
         else:
             _log(f"No optical images found for {month_str}. Skipping.")
         radar_dir = os.path.join(output_dir, 'radar', month_str)
         radar_path = os.path.join(radar_dir, f"radar_{month_str}.tif")
-        s1_monthly = radar.get_s1_collection(start, end, study_area)
-        if s1_monthly.size().getInfo() > 0:
-            radar_composite = s1_monthly.median()
-            tile_paths_rad = multispectral.download_composite(radar_composite, study_area, radar_path)
-            run_gdal_merge(tile_paths_rad, radar_path)
+        if sizes[f"s1_{month_str}"] > 0:
+            radar_composite = collections[f"s1_{month_str}"].median()
+            complete &= download_and_merge(radar_composite, study_area, radar_path, config, aoi_bounds)
         else:
             _log(f"No radar images found for {month_str}. Skipping.")
+    return complete
 
-def main():
-    parser = argparse.ArgumentParser(description="GeoCrop Analysis Pipeline")
-    parser.add_argument('--config', default='config.yaml', help='Configuration file to use')
-    parser.add_argument('--phase', choices=['show_config', 'setup_test', 'download', 'segment', 'label', 'extract', 'train', 'predict', 'cleanup_tiles', 'full_run', 'predict_full_run', 'compress_mosaics'], default='full_run', help='The specific pipeline phase to run')
-    parser.add_argument('--prediction-year', type=int, help='The year to run predictions for. Activates prediction mode.')
-    args = parser.parse_args()
+def _mosaic_path(config, path):
+    return mosaic.mosaic_output_path(path, config.get('mosaic_params', {}).get('format', 'GTiff'))
 
-    _log(f"--- Geocrop Analysis Pipeline Initializing --- Config: {args.config}, Phase: {args.phase} ---")
-    config = load_config(args.config)
+def reuse_reference_segmentation(config, prediction_mode):
+    """True if a prediction run reuses the reference year's segmentation instead of segmenting again."""
+    return prediction_mode and config.get('prediction_params', {}).get('reuse_reference_segmentation', False)
+
+def build_image_list(config, output_dir):
+    """Images to extract features from: the segmentation composite plus the monthly optical and radar mosaics.
+
+    All of them come from `output_dir`, so a prediction run that reuses the
+    reference segments still takes its 'gm_' features from its own year.
+    """
+    image_list = [{'path': _mosaic_path(config, os.path.join(output_dir, 'segmentation', config['output_names']['segmentation_image'])), 'prefix': 'gm_'}]
+    for start, _ in _generate_monthly_ranges(config['study_period']['start_date'], config['study_period']['end_date']):
+        month_str = start[:7] # YYYY-MM
+        month_only = month_str.split('-')[1] # MM
+        image_list.append({'path': _mosaic_path(config, os.path.join(output_dir, 'multispectral', month_str, f"multispectral_{month_str}.tif")), 'prefix': f'ms_{month_only}_'})
+        image_list.append({'path': _mosaic_path(config, os.path.join(output_dir, 'radar', month_str, f"radar_{month_str}.tif")), 'prefix': f'sar_{month_only}_'})
+    return image_list
+
+def build_stage_specs(config, output_dir, data_dir, prediction_mode, model_path=None):
+    """Describes each pipeline stage's inputs, relevant config and outputs for the run manifest."""
+    names = config['output_names']
+    modeling_params = config['modeling_params']
+    original_output_dir = os.path.dirname(output_dir) if prediction_mode else output_dir
+    aoi_path = os.path.join(data_dir, config['aoi_file'])
+    mosaic_format = config.get('mosaic_params', {}).get('format', 'GTiff')
+
+    reuse_segmentation = reuse_reference_segmentation(config, prediction_mode)
+    segmentation_dir = os.path.join(original_output_dir if reuse_segmentation else output_dir, 'segmentation')
+    composite_path = _mosaic_path(config, os.path.join(output_dir, 'segmentation', names['segmentation_image']))
+    clumps_path = os.path.join(segmentation_dir, names['segmented_clumps'].replace('.kea', '.tif'))
+    polygons_path = os.path.join(segmentation_dir, names['segmented_polygons'])
+    label_map_path = os.path.join(original_output_dir, 'labeling', 'segment_label_map.csv')
+    features_path = feature_store.store_path(output_dir, config)
+    modeling_dir = os.path.join(output_dir, 'modeling')
+    model_path = model_path or os.path.join(modeling_dir, modeling_params['output_model_name'])
+    image_paths = [info['path'] for info in build_image_list(config, output_dir)]
+    prediction_keys = [k for k in modeling_params if k.startswith('predict') or k in ('output_prediction_name', 'output_map_name', 'output_map_format', 'output_raster_map_name')]
+
+    # Keys that only change how fast a stage runs, not what it produces
+    segmentation_perf_keys = ('polygonize_window_size', 'polygonize_batch_size')
+    feature_perf_keys = ('num_workers', 'max_memory_per_worker_mb', 'block_size')
+    predict_perf_keys = ('predict_batch_size', 'predict_n_jobs')
+    train_perf_keys = ('tpot_checkpoint_every', 'tpot_memory', 'use_dask', 'dask_scheduler_address', 'dask_n_workers')
+
+    specs = []
+    # The composite is downloaded even when the segments are reused: it feeds the 'gm_' features
+    specs.append(manifest.StageSpec(
+        'download_segmentation',
+        inputs=[aoi_path],
+        config={'range': _segmentation_range(config), 'mosaic_format': mosaic_format},
+        outputs=[composite_path]
+    ))
+    # Monthly mosaic names encode their month, so a changed study period
+    # only adds or drops months and never invalidates existing mosaics.
+    specs.append(manifest.StageSpec(
+        'download_monthly',
+        inputs=[aoi_path],
+        config={'study_period': config['study_period'], 'mosaic_format': mosaic_format},
+        optional_outputs=image_paths[1:],
+        clean_on=('inputs',)
+    ))
+    if not reuse_segmentation:
+        specs.append(manifest.StageSpec(
+            'segment',
+            inputs=[composite_path],
+            config={k: v for k, v in config['segmentation_params'].items() if k not in segmentation_perf_keys},
+            outputs=[clumps_path, polygons_path],
+            deps=['download_segmentation']
+        ))
+    if not prediction_mode:
+        specs.append(manifest.StageSpec(
+            'label',
+            inputs=[polygons_path, clumps_path, os.path.join(data_dir, 'labels', config['labels_file'])],
+            config={'labels_field_name': config['labels_field_name'],
+                    'labeling_params': {k: v for k, v in config.get('labeling_params', {}).items() if k not in ('block_size', 'label_chunk_size')}},
+            outputs=[label_map_path],
+            deps=['segment']
+        ))
+    specs.append(manifest.StageSpec(
+        'extract',
+        inputs=[clumps_path, polygons_path, label_map_path] + image_paths + ([feature_store.model_features_path(model_path)] if prediction_mode else []),
+        config={k: v for k, v in config.get('feature_params', {}).items() if k not in feature_perf_keys},
+        outputs=[features_path],
+        deps=['download_segmentation', 'download_monthly', 'segment', 'label']
+    ))
+    if not prediction_mode:
+        specs.append(manifest.StageSpec(
+            'train',
+            inputs=[features_path, label_map_path],
+            config={k: v for k, v in modeling_params.items() if k not in prediction_keys and k not in train_perf_keys},
+            outputs=[model_path],
+            # Missing side files are rewritten without retraining the model
+            optional_outputs=[feature_store.model_features_path(model_path), os.path.join(modeling_dir, 'classification_report.txt')],
+            deps=['extract', 'label']
+        ))
+    specs.append(manifest.StageSpec(
+        'predict',
+        inputs=[model_path, features_path, label_map_path, polygons_path, clumps_path],
+        config={k: modeling_params[k] for k in prediction_keys if k not in predict_perf_keys},
+        outputs=[os.path.join(modeling_dir, modeling_params['output_prediction_name'])] + mapping.map_output_paths(config, output_dir),
+        deps=['segment', 'extract', 'train']
+    ))
+    return {spec.name: spec for spec in specs}
+
+# Manifest stages covered by each pipeline phase
+PHASE_STAGES = {
+    'download': ['download_segmentation', 'download_monthly'],
+    'segment': ['segment'],
+    'label': ['label'],
+    'extract': ['extract'],
+    'train': ['train'],
+    'predict': ['predict'],
+}
+
+# Phases that are not affected by prediction mode
+UTILITY_PHASES = ('show_config', 'setup_test', 'cleanup_tiles', 'compress_mosaics')
+
+# Per-phase concurrency limits shared by batch workers (phase name -> semaphore)
+_phase_semaphores = {}
+
+def set_phase_semaphores(semaphores):
+    _phase_semaphores.clear()
+    _phase_semaphores.update(semaphores or {})
+
+def _phase_slot(phase):
+    """Holds one of the phase's batch slots while it runs; a no-op outside batch mode."""
+    semaphore = _phase_semaphores.get(phase)
+    return semaphore if semaphore is not None else contextlib.nullcontext()
+
+def _trace_prefix(config, phase, prediction_year):
+    """Path prefix of the performance trace files of a run."""
+    output_dir = os.path.join(config['output_dir'], os.path.splitext(config['aoi_file'])[0])
+    if prediction_year is not None:
+        output_dir = os.path.join(output_dir, f"prediction_{prediction_year}")
+    return os.path.join(output_dir, 'traces', f"{phase}_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+
+def run_pipeline(config, phase, prediction_year=None, dry_run=False, config_path=None):
+    """Runs one pipeline phase (or a full run) for the AOI in `config`.
+
+    Returns a dict of phase name -> duration in seconds for the phases that
+    ran, or None if the run stopped on an error. With
+    `instrumentation_params.trace`, the run's spans are written to
+    `traces/<phase>_<timestamp>.jsonl` and `.chrome.json` in its output directory.
+    """
+    instrumentation_params = config.get('instrumentation_params', {})
+    tracing = instrumentation_params.get('trace', False) and not dry_run and phase != 'show_config'
+    if tracing:
+        instrumentation.start_trace(_trace_prefix(config, phase, prediction_year), instrumentation_params.get('sample_interval', 0.2))
+    try:
+        with instrumentation.span(phase, 'run', aoi=config['aoi_file'], prediction_year=prediction_year):
+            return _run_pipeline(config, phase, prediction_year, dry_run, config_path)
+    finally:
+        if tracing:
+            instrumentation.stop_trace()
+
+def _run_pipeline(config, phase, prediction_year, dry_run, config_path):
+    _log(f"--- Geocrop Analysis Pipeline Initializing --- Config: {config_path}, AOI: {config['aoi_file']}, Phase: {phase} ---")
     aoi_identifier = os.path.splitext(config['aoi_file'])[0]
     
     # --- Handle Prediction Mode ---
-    prediction_mode = args.prediction_year is not None
+    prediction_mode = prediction_year is not None
     original_model_path = None
 
     if prediction_mode:
-        _log(f"*** PREDICTION MODE ACTIVATED FOR YEAR: {args.prediction_year} ***")
+        _log(f"*** PREDICTION MODE ACTIVATED FOR YEAR: {prediction_year} ***")
         original_output_dir = os.path.join(config['output_dir'], aoi_identifier)
-        output_dir = os.path.join(original_output_dir, f"prediction_{args.prediction_year}")
+        output_dir = os.path.join(original_output_dir, f"prediction_{prediction_year}")
         original_model_path = os.path.join(original_output_dir, 'modeling', config['modeling_params']['output_model_name'])
         
         # Shift dates to the prediction year
         start_date_orig = datetime.strptime(config['study_period']['start_date'], '%Y-%m-%d')
         end_date_orig = datetime.strptime(config['study_period']['end_date'], '%Y-%m-%d')
-        year_diff = args.prediction_year - start_date_orig.year
+        year_diff = prediction_year - start_date_orig.year
         
         config['study_period']['start_date'] = (start_date_orig + relativedelta(years=year_diff)).strftime('%Y-%m-%d')
         config['study_period']['end_date'] = (end_date_orig + relativedelta(years=year_diff)).strftime('%Y-%m-%d')
         _log(f"Shifted study period to: {config['study_period']['start_date']} to {config['study_period']['end_date']}")
     else:
         output_dir = os.path.join(config['output_dir'], aoi_identifier)
+        original_output_dir = output_dir
+
+    reuse_segmentation = reuse_reference_segmentation(config, prediction_mode)
+    segmentation_dir = os.path.join(original_output_dir if reuse_segmentation else output_dir, 'segmentation')
+    if reuse_segmentation:
+        _log(f"Reusing the reference segmentation from {segmentation_dir}. Features of this year's images are extracted against the reference segments.")
 
     data_dir = os.path.join(config['data_dir'], aoi_identifier)
     os.makedirs(output_dir, exist_ok=True)
 
     # --- Phase Execution ---
-    if args.phase in ['show_config', 'setup_test', 'cleanup_tiles', 'compress_mosaics']:
+    if phase in UTILITY_PHASES:
         # These phases are not affected by prediction mode
-        if args.phase == 'show_config': show_config(args.config, config)
-        if args.phase == 'setup_test': run_setup_test_phase(config)
-        if args.phase == 'cleanup_tiles': run_cleanup_phase(output_dir)
-        if args.phase == 'compress_mosaics': compression.run_compression_phase(output_dir, config)
-        return
+        if phase == 'show_config': show_config(config_path, config)
+        if phase == 'setup_test': run_setup_test_phase(config)
+        if phase == 'cleanup_tiles': run_cleanup_phase(output_dir)
+        if phase == 'compress_mosaics': compression.run_compression_phase(output_dir, config)
+        return {}
 
     pipeline_start_time = time.time()
+    phase_durations = {}
     
-    run_all = args.phase == 'full_run'
-    run_all_predict = args.phase == 'predict_full_run'
+    run_all = phase == 'full_run'
+    run_all_predict = phase == 'predict_full_run'
 
     if run_all_predict and not prediction_mode:
         _log("Error: --phase predict_full_run requires the --prediction-year argument.")
-        return
+        return None
+
+    # --- Run Manifest ---
+    # Each stage records content hashes of its inputs, outputs and config, so
+    # only stages whose inputs or settings changed are recomputed.
+    run_manifest = manifest.RunManifest(os.path.join(output_dir, 'run_manifest.json'))
+    stage_specs = build_stage_specs(config, output_dir, data_dir, prediction_mode, original_model_path)
+    if run_all or run_all_predict:
+        selected_stages = list(stage_specs)
+    else:
+        selected_stages = [name for name in PHASE_STAGES[phase] if name in stage_specs]
+
+    if dry_run:
+        rebuild = manifest.plan(run_manifest, [stage_specs[name] for name in selected_stages])
+        _log(f"--- Dry run: {len(rebuild)} of {len(selected_stages)} stages would be rebuilt ---")
+        for name, reason in rebuild:
+            print(f"  {name}: {reason}")
+        return {}
+
+    # Stages found stale so far; their dependents are stale too, as in the dry-run plan
+    stale_names = set()
+
+    # Stale stages whose invalidated outputs have not been removed yet
+    pending_clean = {}
+
+    def clean(phase):
+        for name in PHASE_STAGES[phase]:
+            if name in pending_clean:
+                run_manifest.clean(stage_specs[name], pending_clean.pop(name))
+
+    def stale(phase, clean_now=True):
+        """Checks the phase's stages and returns True if any is stale.
+
+        Invalidated outputs of stale stages are removed straight away, or by
+        `clean(phase)` once the phase has checked its inputs when `clean_now` is False.
+        """
+        any_stale = False
+        for name in PHASE_STAGES[phase]:
+            if name not in stage_specs:
+                continue
+            is_stale, reason, change_kind = manifest.evaluate(run_manifest, stage_specs[name], stale_names)
+            if change_kind == 'adopt':
+                _log(f"- Stage '{name}' has no manifest record; adopting its existing outputs.")
+                run_manifest.record(stage_specs[name])
+            if is_stale:
+                _log(f"- Stage '{name}' is stale ({reason}).")
+                pending_clean[name] = change_kind
+                stale_names.add(name)
+                any_stale = True
+        if not any_stale:
+            _log(f"PHASE '{phase}' is up to date. Skipping.")
+        elif clean_now:
+            clean(phase)
+        return any_stale
+
+    def record(phase):
+        for name in PHASE_STAGES[phase]:
+            if name in stage_specs:
+                run_manifest.record(stage_specs[name])
 
     # --- Core Pipeline Phases ---
-    if args.phase == 'download' or run_all or run_all_predict:
-        _log("Initializing Google Earth Engine for Download...")
-        gee_utils.initialize_gee()
-        aoi_path = os.path.join(data_dir, config['aoi_file'])
-        study_area = ee.Geometry(gpd.read_file(aoi_path).geometry[0].__geo_interface__)
-        phase_start_time = time.time()
-        _log(f"Executing PHASE: Download (Output: {output_dir})")
-        run_download_phase(config, study_area, output_dir)
-        _log(f"PHASE 'Download' complete. Duration: {time.time() - phase_start_time:.2f} seconds.")
-
-    if args.phase == 'segment' or run_all or run_all_predict:
-        phase_start_time = time.time()
+    if (phase == 'download' or run_all or run_all_predict) and stale('download'):
+        with _phase_slot('download'), instrumentation.span('download', 'phase') as span:
+            _log("Initializing Google Earth Engine for Download...")
+            gee_utils.initialize_gee()
+            aoi_path = os.path.join(data_dir, config['aoi_file'])
+            aoi_geojson = gpd.read_file(aoi_path).geometry[0].__geo_interface__
+            study_area = ee.Geometry(aoi_geojson)
+            _log(f"Executing PHASE: Download (Output: {output_dir})")
+            if run_download_phase(config, study_area, output_dir, aoi_geojson):
+                record('download')
+            else:
+                _log("- Some composites failed to download. Not recording the download stage, so they are retried on the next run.")
+        phase_durations['download'] = span.wall_seconds
+        _log(f"PHASE 'Download' complete. Duration: {phase_durations['download']:.2f} seconds.")
+
+    if (phase == 'segment' or run_all or run_all_predict) and reuse_segmentation:
+        _log("Skipping PHASE: Segment (reusing the reference segmentation).")
+    elif (phase == 'segment' or run_all or run_all_predict) and stale('segment', clean_now=False):
         _log(f"Executing PHASE: Segment (Output: {output_dir})")
-        main_composite_path = os.path.join(output_dir, 'segmentation', config['output_names']['segmentation_image'])
+        main_composite_path = _mosaic_path(config, os.path.join(output_dir, 'segmentation', config['output_names']['segmentation_image']))
         if not os.path.exists(main_composite_path):
             _log(f"Error: Main composite image not found. Please run the 'download' phase first.")
-            return
-        segmentation.run_segmentation(config['segmentation_params'], main_composite_path, os.path.join(output_dir, 'segmentation'), config['output_names'])
-        _log(f"PHASE 'Segment' complete. Duration: {time.time() - phase_start_time:.2f} seconds.")
+            return None
+        # Existing segments are only removed once there is a composite to rebuild them from
+        clean('segment')
+        with _phase_slot('segment'), instrumentation.span('segment', 'phase') as span:
+            segmentation.run_segmentation(config['segmentation_params'], main_composite_path, os.path.join(output_dir, 'segmentation'), config['output_names'])
+            record('segment')
+        phase_durations['segment'] = span.wall_seconds
+        _log(f"PHASE 'Segment' complete. Duration: {phase_durations['segment']:.2f} seconds.")
 
-    if args.phase == 'label' or run_all:
+    if phase == 'label' or run_all:
         if prediction_mode:
             _log("Skipping PHASE: Label in prediction mode.")
-        else:
-            phase_start_time = time.time()
+        elif stale('label'):
             _log("Executing PHASE: Label")
-            labeling.generate_label_map(output_dir, data_dir, config)
-            _log(f"PHASE 'Label' complete. Duration: {time.time() - phase_start_time:.2f} seconds.")
+            with _phase_slot('label'), instrumentation.span('label', 'phase') as span:
+                labeling.generate_label_map(output_dir, data_dir, config)
+                record('label')
+            phase_durations['label'] = span.wall_seconds
+            _log(f"PHASE 'Label' complete. Duration: {phase_durations['label']:.2f} seconds.")
 
-    if args.phase == 'extract' or run_all or run_all_predict:
-        phase_start_time = time.time()
+    if (phase == 'extract' or run_all or run_all_predict) and stale('extract'):
         _log(f"Executing PHASE: Extract Features (Output: {output_dir})")
-        # Construct the list of images for feature extraction
-        image_list = []
-        image_list.append({'path': os.path.join(output_dir, 'segmentation', config['output_names']['segmentation_image']), 'prefix': 'gm_'})
-        monthly_ranges = _generate_monthly_ranges(config['study_period']['start_date'], config['study_period']['end_date'])
-        for start, _ in monthly_ranges:
-            month_str = start[:7] # YYYY-MM
-            month_only = month_str.split('-')[1] # MM
-            image_list.append({'path': os.path.join(output_dir, 'multispectral', month_str, f"multispectral_{month_str}.tif"), 'prefix': f'ms_{month_only}_'})
-            image_list.append({'path': os.path.join(output_dir, 'radar', month_str, f"radar_{month_str}.tif"), 'prefix': f'sar_{month_only}_'})
-        
-        feature_extraction.extract_features(output_dir, config, image_list)
-        _log(f"PHASE 'Extract Features' complete. Duration: {time.time() - phase_start_time:.2f} seconds.")
+        # Prediction runs compute only the features the trained model uses
+        model_features = feature_store.load_model_features(original_model_path) if prediction_mode else None
+        with _phase_slot('extract'), instrumentation.span('extract', 'phase') as span:
+            feature_extraction.extract_features(output_dir, config, build_image_list(config, output_dir), columns=model_features)
+            record('extract')
+        phase_durations['extract'] = span.wall_seconds
+        _log(f"PHASE 'Extract Features' complete. Duration: {phase_durations['extract']:.2f} seconds.")
 
-    if args.phase == 'train' or run_all:
+    if phase == 'train' or run_all:
         if prediction_mode:
             _log("Skipping PHASE: Train in prediction mode.")
-        else:
-            phase_start_time = time.time()
+        elif stale('train'):
             _log("Executing PHASE: Train Model")
-            modeling.train_model(config, output_dir)
-            _log(f"PHASE 'Train Model' complete. Duration: {time.time() - phase_start_time:.2f} seconds.")
+            with _phase_slot('train'), instrumentation.span('train', 'phase') as span:
+                modeling.train_model(config, output_dir)
+                record('train')
+            phase_durations['train'] = span.wall_seconds
+            _log(f"PHASE 'Train Model' complete. Duration: {phase_durations['train']:.2f} seconds.")
 
-    if args.phase == 'predict' or run_all or run_all_predict:
-        phase_start_time = time.time()
+    if (phase == 'predict' or run_all or run_all_predict) and stale('predict'):
         _log(f"Executing PHASE: Predict and Generate Map (Output: {output_dir})")
-        mapping.generate_map(config, output_dir, model_path=original_model_path)
-        _log(f"PHASE 'Predict and Generate Map' complete. Duration: {time.time() - phase_start_time:.2f} seconds.")
+        with _phase_slot('predict'), instrumentation.span('predict', 'phase') as span:
+            mapping.generate_map(config, output_dir, model_path=original_model_path)
+            record('predict')
+        phase_durations['predict'] = span.wall_seconds
+        _log(f"PHASE 'Predict and Generate Map' complete. Duration: {phase_durations['predict']:.2f} seconds.")
 
     if run_all or run_all_predict:
         _log(f"--- Pipeline Finished --- Total Duration: {time.time() - pipeline_start_time:.2f} seconds ---")
+    return phase_durations
+
+def main():
+    parser = argparse.ArgumentParser(description="GeoCrop Analysis Pipeline")
+    parser.add_argument('--config', default='config.yaml', help='Configuration file to use')
+    parser.add_argument('--phase', choices=['show_config', 'setup_test', 'download', 'segment', 'label', 'extract', 'train', 'predict', 'cleanup_tiles', 'full_run', 'predict_full_run', 'compress_mosaics'], default='full_run', help='The specific pipeline phase to run')
+    parser.add_argument('--prediction-year', type=int, help='The year to run predictions for. Activates prediction mode.')
+    parser.add_argument('--dry-run', action='store_true', help='List the stages that would be rebuilt and why, without running them.')
+    parser.add_argument('--batch', help='YAML file listing (AOI, year) jobs to run over a process pool. Overrides --phase and --prediction-year.')
+    args = parser.parse_args()
+
+    if args.batch:
+        import batch
+        batch.run_batch(args.batch, default_config_path=args.config)
+        return
+
+    config = load_config(args.config)
+    run_pipeline(config, args.phase, prediction_year=args.prediction_year, dry_run=args.dry_run, config_path=args.config)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,144 @@
+import os
+import glob
+import json
+from datetime import datetime
+
+from processing import fingerprint
+from instrumentation import log as _log
+
+class StageSpec:
+    """Describes one pipeline stage for the run manifest.
+
+    `inputs` are files whose content the stage depends on, `config` the config
+    values that affect its results, and `outputs` the files it must produce.
+    `optional_outputs` are recorded when present but not required. `clean_on`
+    lists the kinds of change ('inputs', 'config') that make existing outputs
+    invalid and get them deleted before the stage reruns. Modified outputs are
+    always deleted, so the stage really rebuilds them; a missing output never
+    causes a deletion. `deps` names the upstream stages whose outputs this
+    stage reads.
+    """
+    def __init__(self, name, inputs=(), config=None, outputs=(), optional_outputs=(), clean_on=('inputs', 'config'), deps=()):
+        self.name = name
+        self.deps = list(deps)
+        self.inputs = list(inputs)
+        self.config = config or {}
+        self.outputs = list(outputs)
+        self.optional_outputs = list(optional_outputs)
+        self.clean_on = tuple(clean_on)
+
+def _remove_output(path):
+    """Removes an output file, including the sidecar files of a Shapefile."""
+    base, ext = os.path.splitext(path)
+    paths = glob.glob(f"{glob.escape(base)}.*") if ext.lower() == '.shp' else [path]
+    for p in paths:
+        if os.path.isfile(p):
+            os.remove(p)
+
+class RunManifest:
+    """Records, per stage, content hashes of its inputs and outputs and of its config.
+
+    A stage is stale when it has no record, a required output is missing, its
+    config changed, or any input or output no longer matches the recorded hash.
+    A stage with no record whose outputs all exist (e.g. an output directory
+    from before the manifest, or copied test mosaics) is adopted as it is.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.memo_path = f"{os.path.splitext(path)[0]}.fingerprints.json"
+        self.stages = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.stages = json.load(f).get('stages', {})
+
+    def _hash_files(self, paths):
+        return {p: fingerprint.file_fingerprint(p, self.memo_path) if os.path.exists(p) else None for p in paths}
+
+    def check(self, spec):
+        """Returns (is_stale, reason, change_kind) for a stage.
+
+        `change_kind` is 'new' (no record), 'missing', 'config', 'inputs' or 'outputs'.
+        """
+        record = self.stages.get(spec.name)
+        if record is None:
+            return True, 'no previous run recorded', 'new'
+        missing = [p for p in spec.outputs if not os.path.exists(p)]
+        if missing:
+            return True, f"output missing: {os.path.basename(missing[0])}", 'missing'
+        if record.get('config') != fingerprint.payload_fingerprint(spec.config):
+            return True, 'config changed', 'config'
+        current = self._hash_files(spec.inputs)
+        for p, digest in current.items():
+            if record.get('inputs', {}).get(p) != digest:
+                return True, f"input changed: {os.path.basename(p)}", 'inputs'
+        recorded_outputs = record.get('outputs', {})
+        for p in spec.outputs:
+            if recorded_outputs.get(p) != fingerprint.file_fingerprint(p, self.memo_path):
+                return True, f"output modified: {os.path.basename(p)}", 'outputs'
+        return False, 'up to date', None
+
+    def adoptable(self, spec):
+        """True if a stage with no record already has all of its outputs on disk."""
+        return (spec.name not in self.stages and bool(spec.outputs or spec.optional_outputs)
+                and all(os.path.exists(p) for p in spec.outputs + spec.optional_outputs))
+
+    def clean(self, spec, change_kind):
+        """Deletes the stage's outputs so the phase's own skip checks do not reuse them.
+
+        Config or input changes listed in `spec.clean_on` and modified outputs
+        invalidate the outputs; for a missing output the phase rebuilds just
+        what is missing.
+        """
+        if change_kind != 'outputs' and change_kind not in spec.clean_on:
+            return
+        for p in spec.outputs + spec.optional_outputs:
+            if os.path.exists(p):
+                _log(f"- Removing stale output: {p}")
+                _remove_output(p)
+
+    def record(self, spec):
+        """Stores the current hashes of a stage's inputs, outputs and config."""
+        missing = [p for p in spec.outputs if not os.path.exists(p)]
+        if missing:
+            _log(f"- Stage '{spec.name}' did not produce {os.path.basename(missing[0])}. Not recording it in the manifest.")
+            return
+        outputs = spec.outputs + [p for p in spec.optional_outputs if os.path.exists(p)]
+        self.stages[spec.name] = {
+            'config': fingerprint.payload_fingerprint(spec.config),
+            'inputs': self._hash_files(spec.inputs),
+            'outputs': self._hash_files(outputs),
+            'recorded_at': datetime.now().isoformat(timespec='seconds'),
+        }
+        self.save()
+
+    def save(self):
+        part_path = f"{self.path}.part"
+        with open(part_path, 'w') as f:
+            json.dump({'stages': self.stages}, f, indent=2)
+        os.replace(part_path, self.path)
+
+def evaluate(run_manifest, spec, stale_names):
+    """Returns (is_stale, reason, change_kind) for a stage, given the stages already found stale.
+
+    Staleness propagates downstream: a stage that depends on a stale stage is
+    stale because its inputs are about to change. A stage with no record whose
+    outputs all exist is reported up to date with change_kind 'adopt'.
+    """
+    stale, reason, change_kind = run_manifest.check(spec)
+    stale_deps = [d for d in spec.deps if d in stale_names]
+    if stale_deps and change_kind not in ('config', 'inputs'):
+        return True, f"upstream stage '{stale_deps[0]}' is stale", 'inputs'
+    if change_kind == 'new' and run_manifest.adoptable(spec):
+        return False, 'existing outputs adopted', 'adopt'
+    return stale, reason, change_kind
+
+def plan(run_manifest, specs):
+    """Returns [(name, reason)] for the stages that would be rebuilt, in order."""
+    rebuild = []
+    stale_names = set()
+    for spec in specs:
+        stale, reason, _ = evaluate(run_manifest, spec, stale_names)
+        if stale:
+            stale_names.add(spec.name)
+            rebuild.append((spec.name, reason))
+    return rebuild
@@ -0,0 +1,37 @@
+import os
+import rasterio
+import rasterio.shutil
+
+def cog_options(compress='DEFLATE', level=None, predictor=None, blocksize=512, overview_resampling='average', max_z_error=None, num_threads='ALL_CPUS'):
+    """Builds GDAL COG driver creation options."""
+    options = {
+        'COMPRESS': compress.upper(),
+        'BLOCKSIZE': blocksize,
+        'OVERVIEWS': 'AUTO',
+        'OVERVIEW_RESAMPLING': overview_resampling.upper(),
+        'BIGTIFF': 'IF_SAFER',
+        'NUM_THREADS': num_threads,
+    }
+    if level is not None:
+        options['LEVEL'] = level
+    if predictor is not None:
+        options['PREDICTOR'] = predictor
+    if max_z_error is not None:
+        options['MAX_Z_ERROR'] = max_z_error
+    return options
+
+def to_cog(src_path, dst_path, **kwargs):
+    """Copies a raster to a tiled Cloud-Optimized GeoTIFF with internal overviews.
+
+    Keyword arguments are passed to `cog_options`. The COG is written to a
+    temporary name and renamed into place, so a partial file is never left at
+    `dst_path`.
+    """
+    part_path = f"{dst_path}.part"
+    try:
+        rasterio.shutil.copy(src_path, part_path, driver='COG', **cog_options(**kwargs))
+        os.replace(part_path, dst_path)
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+    return dst_path
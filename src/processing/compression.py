@@ -1,21 +1,87 @@
 import os
-import subprocess
 import glob
-import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from osgeo import gdal
+from . import cog, mosaic
+from instrumentation import log as _log
 
-def _log(message):
-    from datetime import datetime
-    print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {message}")
+# Codecs accepted by the COG driver; LERC codecs are lossless unless max_z_error > 0
+CODECS = ('DEFLATE', 'ZSTD', 'LZW', 'LERC', 'LERC_DEFLATE', 'LERC_ZSTD')
+LEVEL_CODECS = ('DEFLATE', 'ZSTD', 'LERC_DEFLATE', 'LERC_ZSTD')
+
+def _cog_kwargs(compression_params, num_threads):
+    """Maps `compression_params` to `cog.to_cog` keyword arguments."""
+    codec = compression_params.get('codec', 'DEFLATE').upper()
+    if codec not in CODECS:
+        raise ValueError(f"Unsupported compression codec '{codec}'. Expected one of {CODECS}.")
+    kwargs = {
+        'compress': codec,
+        'blocksize': compression_params.get('blocksize', 512),
+        'overview_resampling': compression_params.get('overview_resampling', 'average'),
+        'num_threads': num_threads,
+    }
+    if codec in LEVEL_CODECS:
+        kwargs['level'] = compression_params.get('level', 9 if codec.endswith('DEFLATE') else 15)
+    if codec.startswith('LERC'):
+        kwargs['max_z_error'] = compression_params.get('max_z_error', 0)
+    else:
+        # YES lets GDAL pick horizontal differencing or the floating-point predictor by data type
+        kwargs['predictor'] = compression_params.get('predictor', 'YES')
+    return kwargs
+
+def _mosaic_files(scan_dir, config):
+    """Mosaic outputs of one run directory; the source tiles VRT mosaics keep are not mosaics."""
+    paths = []
+    for kind in ('multispectral', 'radar'):
+        for ext in ('tif', 'vrt'):
+            # Monthly mosaics are <kind>/<YYYY-MM>/<kind>_<YYYY-MM>.<ext>; their tiles sit one level deeper
+            paths.extend(glob.glob(os.path.join(scan_dir, kind, '*', f"{kind}_*.{ext}")))
+    seg_composite_path = os.path.join(scan_dir, 'segmentation', config['output_names']['segmentation_image'])
+    for fmt in ('GTiff', 'VRT'):
+        path = mosaic.mosaic_output_path(seg_composite_path, fmt)
+        if os.path.exists(path) and path not in paths:
+            paths.append(path)
+    return paths
+
+def _output_filename(input_path, config):
+    """Name of the compressed mosaic; prediction-year composites get the year appended."""
+    filename = os.path.basename(input_path)
+    if filename.endswith('.vrt'):
+        # VRT mosaics are compressed into a self-contained GeoTIFF
+        filename = filename[:-len('.vrt')] + '.tif'
+    if filename == os.path.splitext(config['output_names']['segmentation_image'])[0] + '.tif' and 'prediction_' in input_path:
+        try:
+            year = os.path.basename(os.path.dirname(os.path.dirname(input_path))).split('_')[-1]
+            base, ext = os.path.splitext(filename)
+            return f"{base}_{year}{ext}"
+        except (IndexError, ValueError):
+            # Fallback if the directory structure is unexpected
+            return filename
+    return filename
+
+def _input_bytes(input_path):
+    """Size of a mosaic on disk; for a VRT, the size of the files it references."""
+    files = gdal.Open(input_path).GetFileList() if input_path.endswith('.vrt') else [input_path]
+    return sum(os.path.getsize(f) for f in files if os.path.exists(f))
+
+def _compress_one(input_path, output_path, cog_kwargs):
+    """Writes one mosaic as a COG and returns (input_bytes, output_bytes, seconds)."""
+    start = time.time()
+    cog.to_cog(input_path, output_path, **cog_kwargs)
+    return _input_bytes(input_path), os.path.getsize(output_path), time.time() - start
 
 def run_compression_phase(output_dir, config):
-    """Compresses all mosaic files from the main output and all prediction subdirectories."""
-    _log("--- Executing PHASE: Compress Mosaics ---")
+    """Compresses all mosaic files from the main output and all prediction subdirectories.
 
-    gdal_translate_path = shutil.which('gdal_translate')
-    if not gdal_translate_path:
-        _log("  - FAILED: 'gdal_translate' command not found. Is GDAL installed and in your system's PATH?")
-        return
-    _log(f"- Using gdal_translate found at: {gdal_translate_path}")
+    Each mosaic is rewritten as a tiled Cloud-Optimized GeoTIFF with internal
+    overviews, using the codec and level from `compression_params`. Mosaics are
+    compressed in parallel in-process; `num_workers` files run at once and the
+    CPU cores are split between them for GDAL's own compression threads.
+    """
+    _log("--- Executing PHASE: Compress Mosaics ---")
+    compression_params = config.get('compression_params', {})
+    num_workers = compression_params.get('num_workers') or os.cpu_count() or 1
 
     # The single, top-level directory for all compressed mosaics
     compressed_dir = os.path.join(output_dir, 'mosaics_compressed')
@@ -30,14 +96,9 @@ def run_compression_phase(output_dir, config):
     # --- Build list of all mosaics to compress ---
     mosaics_to_compress = []
     for scan_dir in dirs_to_scan:
-        # Add monthly mosaics
-        mosaics_to_compress.extend(glob.glob(os.path.join(scan_dir, "multispectral", "**", "*.tif"), recursive=True))
-        mosaics_to_compress.extend(glob.glob(os.path.join(scan_dir, "radar", "**", "*.tif"), recursive=True))
-        # Add main composite
-        seg_composite_name = config['output_names']['segmentation_image']
-        seg_composite_path = os.path.join(scan_dir, 'segmentation', seg_composite_name)
-        if os.path.exists(seg_composite_path):
-            mosaics_to_compress.append(seg_composite_path)
+        mosaics_to_compress.extend(_mosaic_files(scan_dir, config))
+    # Mosaics still being merged are not finished products
+    mosaics_to_compress = [p for p in mosaics_to_compress if '.partial.' not in os.path.basename(p)]
 
     if not mosaics_to_compress:
         _log("- No mosaics found to compress.")
@@ -45,46 +106,50 @@ def run_compression_phase(output_dir, config):
 
     _log(f"Found {len(mosaics_to_compress)} unique mosaics to compress.")
 
+    jobs = []
     for input_path in mosaics_to_compress:
-        filename = os.path.basename(input_path)
-        
-        # --- Determine the correct output path and name ---
-        # If the mosaic is a main composite from a prediction year, rename it
-        if filename == config['output_names']['segmentation_image'] and 'prediction_' in input_path:
-            try:
-                year = os.path.basename(os.path.dirname(os.path.dirname(input_path))).split('_')[-1]
-                base, ext = os.path.splitext(filename)
-                output_filename = f"{base}_{year}{ext}"
-            except (IndexError, ValueError):
-                # Fallback if the directory structure is unexpected
-                output_filename = filename
-        else:
-            output_filename = filename
-        
+        output_filename = _output_filename(input_path, config)
         output_path = os.path.join(compressed_dir, output_filename)
-
         if os.path.exists(output_path):
             _log(f"- Compressed file already exists: {output_filename}. Skipping.")
             continue
+        jobs.append((input_path, output_path))
 
-        _log(f"- Compressing {filename} -> {output_filename}...")
+    if not jobs:
+        _log("--- Compress Mosaics phase complete ---")
+        return
 
-        command = [
-            gdal_translate_path,
-            '-co', 'COMPRESS=DEFLATE',
-            '-co', 'PREDICTOR=2',
-            '-co', 'ZLEVEL=9',
-            input_path,
-            output_path
-        ]
+    num_workers = max(1, min(num_workers, len(jobs)))
+    num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+    cog_kwargs = _cog_kwargs(compression_params, num_threads)
+    _log(f"- Writing COGs with {cog_kwargs['compress']} (level {cog_kwargs.get('level', '-')}), "
+         f"{num_workers} files at a time, {num_threads} GDAL threads each.")
 
-        try:
-            subprocess.run(command, check=True, capture_output=True, text=True)
-            input_size = os.path.getsize(input_path) / (1024 * 1024)
-            output_size = os.path.getsize(output_path) / (1024 * 1024)
-            _log(f"  - Success. Size: {input_size:.2f} MB -> {output_size:.2f} MB")
-        except subprocess.CalledProcessError as e:
-            _log(f"  - FAILED to compress {filename}. Error: {e.stderr}")
+    total_in, total_out, failed = 0, 0, 0
+    phase_start = time.time()
+    # GDAL releases the GIL while copying, so threads compress files concurrently
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = {executor.submit(_compress_one, input_path, output_path, cog_kwargs): (input_path, output_path)
+                   for input_path, output_path in jobs}
+        for future in as_completed(futures):
+            input_path, output_path = futures[future]
+            filename = os.path.basename(input_path)
+            try:
+                input_bytes, output_bytes, seconds = future.result()
+            except Exception as e:
+                failed += 1
+                _log(f"  - FAILED to compress {filename}. Error: {e}")
+                continue
+            total_in += input_bytes
+            total_out += output_bytes
+            input_mb, output_mb = input_bytes / (1024 * 1024), output_bytes / (1024 * 1024)
+            _log(f"  - {filename} -> {os.path.basename(output_path)}: {input_mb:.2f} MB -> {output_mb:.2f} MB "
+                 f"(ratio {input_bytes / max(output_bytes, 1):.2f}x, {input_mb / max(seconds, 1e-6):.1f} MB/s)")
 
+    elapsed = time.time() - phase_start
+    if total_out:
+        _log(f"- Compressed {len(jobs) - failed} mosaics: {total_in / (1024 * 1024):.2f} MB -> {total_out / (1024 * 1024):.2f} MB "
+             f"(ratio {total_in / total_out:.2f}x, {total_in / (1024 * 1024) / max(elapsed, 1e-6):.1f} MB/s overall)")
+    if failed:
+        _log(f"- {failed} mosaics failed to compress.")
     _log("--- Compress Mosaics phase complete ---")
-
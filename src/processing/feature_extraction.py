@@ -1,88 +1,266 @@
-import geopandas as gpd
 import pandas as pd
+import numpy as np
 import os
+import glob
+import json
+import math
+import re
+import rasterio
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from exactextract import exact_extract
 from osgeo import gdal
-import ast
+from . import vector_io, zonal, feature_store, fingerprint
+import instrumentation
 
 # Enable GDAL exceptions for cleaner error handling
 gdal.UseExceptions()
 
-def extract_features(output_dir, config, image_list):
-    """Extracts statistics for ALL segments and saves them to a clean, structured CSV file."""
+def _drop_redundant_counts(df_stats):
+    """Keeps a single valid-pixel `count` column per image instead of one per band.
+
+    The kept count is always band 1's, whichever bands were extracted, so a
+    prediction run computing a band subset produces the same `count` as training.
+    """
+    count_cols = [c for c in df_stats.columns if c == 'count' or c.endswith('_count')]
+    keep = 'count' if 'count' in count_cols else 'b1_count'
+    df_stats = df_stats.drop(columns=[c for c in count_cols if c != keep])
+    return df_stats.rename(columns={keep: 'count'})
+
+def _exact_extract_shard(image_path, zones, stats):
+    """Runs exact_extract over a partition of the zones; returns stats indexed by segment ID."""
+    df_stats = exact_extract(image_path, zones, stats, output='pandas')
+    # exact_extract names multi-band columns band_<n>_<stat>; features are named b<n>_<stat>
+    df_stats = df_stats.rename(columns=lambda c: re.sub(r'^band_(\d+)_', r'b\1_', c))
+    df_stats.index = pd.Index(zones['raster_val'].to_numpy(), name='segment_id')
+    return df_stats.astype(np.float32)
+
+def _partition_count(image_path, memory_per_worker):
+    """Number of partitions an image is split into so each fits the per-worker memory budget.
+
+    The count is not capped at the number of workers; the pool works through
+    extra partitions as workers free up.
+    """
+    with rasterio.open(image_path) as src:
+        image_bytes = src.width * src.height * src.count * np.dtype(src.dtypes[0]).itemsize
+    return max(1, math.ceil(image_bytes / memory_per_worker))
+
+def _spatial_partitions(gdf_zones, n_parts):
+    """Splits zones into spatially compact partitions along a Hilbert curve."""
+    if n_parts <= 1:
+        return [gdf_zones]
+    order = np.argsort(gdf_zones.geometry.hilbert_distance().to_numpy())
+    return [gdf_zones.iloc[idx] for idx in np.array_split(order, n_parts) if len(idx)]
+
+def _required_bands_and_stats(columns, prefix, stats):
+    """Bands and stats an image must produce for the requested feature columns.
+
+    Returns (bands, stats, wanted_columns); bands and stats are None when the
+    image contributes no requested column.
+    """
+    wanted = [c for c in columns if c.startswith(prefix)]
+    if not wanted:
+        return None, None, []
+    bands, needed = set(), set()
+    for column in wanted:
+        match = re.fullmatch(r'b(\d+)_(\w+)', column[len(prefix):])
+        if match:
+            bands.add(int(match.group(1)))
+            needed.add(match.group(2))
+        else:
+            needed.add(column[len(prefix):])
+    # A bare stat column is either a single-band stat or the image's shared count, both from band 1
+    if 'count' in needed:
+        bands.add(1)
+    return sorted(bands) or [1], [st for st in stats if st in needed], wanted
+
+def _load_cache_index(index_path):
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path) as f:
+        return json.load(f)
+
+def _save_cache_index(index_path, index):
+    part_path = f"{index_path}.part"
+    with open(part_path, 'w') as f:
+        json.dump(index, f, indent=2)
+    os.replace(part_path, index_path)
+
+def _shard_path(cache_dir, prefix, key):
+    return os.path.join(cache_dir, f"{prefix}{key[:16]}.parquet")
+
+def _remove_stale_shards(cache_dir, prefix, keep_path):
+    for path in glob.glob(os.path.join(cache_dir, f"{prefix}*.parquet")):
+        if path != keep_path and os.path.basename(path)[len(prefix):-len('.parquet')].isalnum():
+            os.remove(path)
+
+def _write_shard(job, df_stats, cache_dir):
+    """Finishes one image's stats and writes them as its cache shard."""
+    prefix = job['prefix']
+    with instrumentation.span(os.path.basename(job['path']), 'image') as span:
+        df_stats = feature_store.to_float32(_drop_redundant_counts(df_stats)).add_prefix(prefix)
+        if job['columns'] is not None:
+            df_stats = df_stats[[c for c in df_stats.columns if c in job['columns']]]
+        # A shard is only ever seen complete: an interrupted write leaves just the .part file
+        part_path = f"{job['shard']}.part"
+        df_stats.to_parquet(part_path)
+        os.replace(part_path, job['shard'])
+        _remove_stale_shards(cache_dir, prefix, job['shard'])
+        span.count('segments', len(df_stats))
+
+def extract_features(output_dir, config, image_list, columns=None):
+    """Extracts statistics for ALL segments and saves them to a typed, columnar feature table.
+
+    Images on the same grid as the clumps raster are summarized with the
+    raster-native zonal engine; any other image falls back to exact_extract.
+    Each image is processed in a worker process, and images too large for one
+    worker's memory budget are split into row or spatial partitions. Every
+    image's stats are cached as a shard keyed by a fingerprint of the image,
+    the segmentation and the stats list, so only new or changed images are
+    recomputed; the final table is assembled from the shards on segment_id.
+
+    With `columns` (e.g. the features a saved model uses), only the bands and
+    stats needed for those columns are computed.
+    """
     print("\n--- Starting Feature Extraction (Surgical Post-processing) ---")
 
     # --- Define Paths ---
-    segmentation_dir = os.path.join(output_dir, 'segmentation')
-    features_csv_path = os.path.join(output_dir, config['output_names']['features_csv'])
-    full_segmentation_path = os.path.join(segmentation_dir, config['output_names']['segmented_polygons'])
-
-    if os.path.exists(features_csv_path):
-        print(f"- Features CSV already exists: {os.path.basename(features_csv_path)}. Skipping.")
-        return
+    prediction_mode = 'prediction_' in os.path.basename(output_dir)
+    original_output_dir = os.path.dirname(output_dir) if prediction_mode else output_dir
+    label_map_path = os.path.join(original_output_dir, 'labeling', 'segment_label_map.csv')
 
-    # --- 1. Load Full Segmentation ---
-    print(f"- Loading ALL segments from: {os.path.basename(full_segmentation_path)}")
-    gdf_zones = gpd.read_file(full_segmentation_path)
+    # Prediction runs may reuse the reference year's segments instead of their own
+    reuse_segmentation = prediction_mode and config.get('prediction_params', {}).get('reuse_reference_segmentation', False)
+    segmentation_dir = os.path.join(original_output_dir if reuse_segmentation else output_dir, 'segmentation')
+    features_path = feature_store.store_path(output_dir, config)
+    full_segmentation_path = os.path.join(segmentation_dir, config['output_names']['segmented_polygons'])
+    clumps_path = os.path.join(segmentation_dir, config['output_names']['segmented_clumps'].replace('.kea', '.tif'))
+    cache_dir = os.path.join(output_dir, 'feature_cache')
+    os.makedirs(cache_dir, exist_ok=True)
+    index_path = os.path.join(cache_dir, 'index.json')
+    memo_path = os.path.join(cache_dir, 'fingerprints.json')
 
-    # --- 2. Define stats to extract ---
+    # --- 1. Define stats to extract ---
     stats_to_calc = ['mean', 'stdev', 'min', 'max', 'count', 'sum']
+    feature_params = config.get('feature_params', {})
+    engine = feature_params.get('engine', 'auto')
+    block_size = feature_params.get('block_size', 1024)
+    num_workers = feature_params.get('num_workers') or os.cpu_count() or 1
+    memory_per_worker = feature_params.get('max_memory_per_worker_mb', 2048) * 1024 * 1024
 
-    # --- 3. Loop and Extract Stats ---
-    raw_df = gdf_zones[['raster_val']].copy()
-    raw_df.rename(columns={'raster_val': 'segment_id'}, inplace=True)
-
+    # --- 2. Fingerprint Inputs and Check the Cache ---
+    segmentation_fp = [fingerprint.file_fingerprint(p, memo_path) for p in (clumps_path, full_segmentation_path) if os.path.exists(p)]
+    jobs = []
     for image_info in image_list:
-        image_path = image_info['path']
+        image_path, prefix = image_info['path'], image_info['prefix']
         if not os.path.exists(image_path):
             print(f"- WARNING: Image not found, skipping: {os.path.basename(image_path)}")
             continue
-        
-        print(f"- Extracting stats from {os.path.basename(image_path)}...")
-        results = exact_extract(image_path, gdf_zones, stats_to_calc)
-        df_stats = pd.DataFrame(results)
-        df_stats = df_stats.add_prefix(image_info['prefix'])
-        raw_df = raw_df.join(df_stats)
-
-    # --- 4. Post-Processing Step ---
-    print("- Post-processing and structuring data for final CSV...")
-    clean_df = raw_df[['segment_id']].copy()
-    prop_cols = [col for col in raw_df.columns if 'properties' in str(col)]
-
-    for col_name in prop_cols:
-        prefix = col_name.replace('properties', '')
-        def safe_literal_eval(val):
-            try:
-                return ast.literal_eval(str(val))
-            except (ValueError, SyntaxError):
-                return {}
-        props_as_dicts = raw_df[col_name].apply(safe_literal_eval)
-        df_flat = pd.json_normalize(props_as_dicts)
-        rename_dict = {}
-        for flat_col in df_flat.columns:
-            parts = flat_col.split('.')
-            if len(parts) == 2:
-                band_num = parts[0].split('_')[1]
-                stat_name = parts[1]
-                rename_dict[flat_col] = f"{prefix}b{band_num}_{stat_name}"
-            else:
-                rename_dict[flat_col] = f"{prefix}{flat_col}"
-        df_flat.rename(columns=rename_dict, inplace=True)
-        clean_df = clean_df.join(df_flat)
-
-    # --- 5. Handle Final DataFrame based on mode ---
+        bands, stats, wanted = None, stats_to_calc, None
+        if columns is not None:
+            bands, stats, wanted = _required_bands_and_stats(columns, prefix, stats_to_calc)
+            if not wanted:
+                print(f"- No requested features come from {os.path.basename(image_path)}. Skipping it.")
+                continue
+        key = fingerprint.payload_fingerprint({
+            'image': fingerprint.file_fingerprint(image_path, memo_path),
+            'segmentation': segmentation_fp,
+            'stats': stats,
+            'bands': bands,
+            'columns': wanted,
+            'engine': engine,
+            'prefix': prefix,
+            'naming': 'b<n>_<stat>',
+            'count_band': 1,
+        })
+        jobs.append({'path': image_path, 'prefix': prefix, 'key': key, 'shard': _shard_path(cache_dir, prefix, key),
+                     'bands': bands, 'stats': stats, 'columns': wanted})
+
+    labels_fp = None
+    if not prediction_mode and os.path.exists(label_map_path):
+        labels_fp = fingerprint.file_fingerprint(label_map_path, memo_path)
+    table_record = {'shards': [job['key'] for job in jobs], 'labels': labels_fp}
+    index = _load_cache_index(index_path)
+    if os.path.exists(features_path) and index.get(os.path.basename(features_path)) == table_record:
+        print(f"- Feature table is up to date: {os.path.basename(features_path)}. Skipping.")
+        return
+
+    to_compute = [job for job in jobs if not os.path.exists(job['shard'])]
+    print(f"- {len(jobs) - len(to_compute)} of {len(jobs)} image shards are cached; extracting {len(to_compute)}.")
+
+    # --- 3. Load Full Segmentation ---
+    print(f"- Loading ALL segments from: {os.path.basename(full_segmentation_path)}")
+    with instrumentation.span('load_segments', 'io') as span:
+        gdf_zones = vector_io.read_vector(full_segmentation_path, columns=['raster_val'])
+        span.count('segments', len(gdf_zones))
+
+    # --- 4. Extract Stats in Parallel for New or Changed Images ---
+    # Partial results are held per image only until its last partition returns
+    accumulators = {}
+    shards = {}
+    outstanding = {}
+    if to_compute:
+        print(f"- Extracting features with {num_workers} workers ({feature_params.get('max_memory_per_worker_mb', 2048)} MB per worker).")
+        with instrumentation.span('zonal_stats', 'batch', images=len(to_compute)) as span, ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = {}
+            for job in to_compute:
+                image_path, prefix = job['path'], job['prefix']
+                n_parts = _partition_count(image_path, memory_per_worker)
+
+                if engine != 'exact_extract' and os.path.exists(clumps_path) and zonal.same_grid(clumps_path, image_path):
+                    with rasterio.open(clumps_path) as clumps:
+                        row_ranges = zonal.row_partitions(clumps.height, n_parts, block_size)
+                    print(f"- Queued {os.path.basename(image_path)} (raster zonal engine, {len(row_ranges)} partitions)")
+                    for row_range in row_ranges:
+                        future = executor.submit(zonal.accumulate, clumps_path, image_path, job['stats'], block_size, job['bands'], row_range)
+                        futures[future] = ('raster', job)
+                    outstanding[prefix] = len(row_ranges)
+                    span.count('partitions', len(row_ranges))
+                else:
+                    if engine == 'raster':
+                        print(f"- WARNING: {os.path.basename(image_path)} is not on the clumps grid. Falling back to exact_extract.")
+                    partitions = _spatial_partitions(gdf_zones, n_parts)
+                    print(f"- Queued {os.path.basename(image_path)} (exact_extract, {len(partitions)} partitions)")
+                    for zones in partitions:
+                        futures[executor.submit(_exact_extract_shard, image_path, zones, job['stats'])] = ('exact', job)
+                    outstanding[prefix] = len(partitions)
+                    span.count('partitions', len(partitions))
+
+            for future in as_completed(futures):
+                kind, job = futures.pop(future)
+                prefix = job['prefix']
+                result = future.result()
+                if kind == 'raster':
+                    accumulators[prefix] = accumulators[prefix].merge(result) if prefix in accumulators else result
+                else:
+                    shards.setdefault(prefix, []).append(result)
+                outstanding[prefix] -= 1
+                if outstanding[prefix]:
+                    continue
+                # The image's last partition is in: write its shard and free its partial results
+                if kind == 'raster':
+                    df_stats = accumulators.pop(prefix).finalize(zonal.band_labels(job['path'], job['bands']))
+                else:
+                    df_stats = pd.concat(shards.pop(prefix)).groupby(level=0).first()
+                _write_shard(job, df_stats, cache_dir)
+
+    # --- 5. Assemble the Table from Cached Shards on segment_id ---
+    print("- Joining feature shards on segment_id...")
+    columns = [pd.read_parquet(job['shard']) for job in jobs]
+    segment_ids = pd.Index(np.unique(gdf_zones['raster_val'].to_numpy()), name='segment_id')
+    clean_df = pd.DataFrame(index=segment_ids)
+    if columns:
+        clean_df = clean_df.join(columns, how='left')
+    clean_df = clean_df.reset_index()
+
+    # --- 6. Handle Final DataFrame based on mode ---
     # In prediction mode, we do NOT merge labels to avoid false-positives.
-    # The final CSV will be clean, containing only segment IDs and features.
-    if 'prediction_' in os.path.basename(output_dir):
+    # The final table will be clean, containing only segment IDs and features.
+    if prediction_mode:
         print("- Prediction mode detected. Saving features without labels.")
         final_df = clean_df
     else:
         # In normal mode, merge the labels for the training phase.
         print("- Merging labels with features...")
-        original_output_dir = os.path.dirname(output_dir) if 'prediction_' in os.path.basename(output_dir) else output_dir
-        labeling_dir = os.path.join(original_output_dir, 'labeling')
-        label_map_path = os.path.join(labeling_dir, 'segment_label_map.csv')
-        
         if not os.path.exists(label_map_path):
             print(f"- ERROR: Label map not found at {label_map_path}. Cannot merge labels.")
             final_df = clean_df
@@ -94,7 +272,11 @@ def extract_features(output_dir, config, image_list):
             final_df['class_id'] = final_df['class_id'].fillna(0)
             final_df['class_id'] = final_df['class_id'].astype(int)
 
-    print(f"- Saving final, structured features to {os.path.basename(features_csv_path)}")
-    final_df.to_csv(features_csv_path, index=False)
+    print(f"- Saving final, structured features to {os.path.basename(features_path)}")
+    with instrumentation.span('write_features', 'io') as span:
+        feature_store.write_features(final_df, features_path)
+        span.count('rows', len(final_df))
+    index[os.path.basename(features_path)] = table_record
+    _save_cache_index(index_path, index)
 
     print("- Feature extraction complete.")
@@ -0,0 +1,79 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+# Columns of the feature table that are identifiers or labels, not model inputs
+NON_FEATURE_COLUMNS = ('segment_id', 'label', 'class_id', 'klass')
+
+# Rows per Parquet row group; segment IDs are written in order, so row-group
+# statistics let ID filters skip most of the file
+ROW_GROUP_SIZE = 100000
+
+def store_path(output_dir, config):
+    """Path of the feature table: `features_store` (Parquet) or the legacy `features_csv`."""
+    names = config['output_names']
+    return os.path.join(output_dir, names.get('features_store') or names['features_csv'])
+
+def is_parquet(path):
+    return os.path.splitext(path)[1].lower() == '.parquet'
+
+def to_float32(df):
+    """Downcasts float feature columns to float32, leaving identifiers and labels alone."""
+    float_cols = [c for c in df.columns if c not in NON_FEATURE_COLUMNS and df[c].dtype.kind == 'f']
+    return df.astype({c: np.float32 for c in float_cols})
+
+def write_features(df, path):
+    """Writes the feature table as Parquet (or CSV for a .csv path) with float32 features."""
+    df = to_float32(df)
+    if is_parquet(path):
+        df.to_parquet(path, index=False, row_group_size=ROW_GROUP_SIZE)
+    else:
+        df.to_csv(path, index=False)
+
+def read_columns(path):
+    """Column names of the feature table, read from the Parquet schema (or the CSV header)."""
+    if is_parquet(path):
+        return pq.read_schema(path).names
+    return list(pd.read_csv(path, nrows=0).columns)
+
+def feature_columns(path):
+    """Model input columns of the feature table."""
+    return [c for c in read_columns(path) if c not in NON_FEATURE_COLUMNS]
+
+def load_features(path, columns=None, filters=None):
+    """Loads the feature table, reading only `columns` (and rows matching pyarrow `filters`)."""
+    if is_parquet(path):
+        return pd.read_parquet(path, columns=columns, filters=filters, memory_map=True)
+    df = pd.read_csv(path, usecols=columns)
+    if filters:
+        for column, op, value in filters:
+            if op != 'in':
+                raise ValueError(f"Only 'in' filters are supported for CSV feature tables, got '{op}'.")
+            df = df[df[column].isin(value)]
+    return df
+
+def iter_batches(path, columns=None, batch_size=100000):
+    """Yields the feature table as DataFrames of at most `batch_size` rows, reading only `columns`."""
+    if is_parquet(path):
+        for batch in pq.ParquetFile(path, memory_map=True).iter_batches(batch_size=batch_size, columns=columns):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, usecols=columns, chunksize=batch_size)
+
+def model_features_path(model_path):
+    """Sidecar file listing the feature columns a saved model was trained on."""
+    return f"{os.path.splitext(model_path)[0]}.features.json"
+
+def save_model_features(model_path, columns):
+    with open(model_features_path(model_path), 'w') as f:
+        json.dump({'features': list(columns)}, f, indent=2)
+
+def load_model_features(model_path):
+    """Feature columns a saved model expects, or None if it has no feature list."""
+    path = model_features_path(model_path)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)['features']
@@ -0,0 +1,50 @@
+import os
+import json
+import hashlib
+
+CHUNK_SIZE = 4 * 1024 * 1024
+
+def _load_memo(memo_path):
+    if memo_path and os.path.exists(memo_path):
+        try:
+            with open(memo_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            pass
+    return {}
+
+def _save_memo(memo_path, memo):
+    os.makedirs(os.path.dirname(memo_path) or '.', exist_ok=True)
+    part_path = f"{memo_path}.part"
+    with open(part_path, 'w') as f:
+        json.dump(memo, f, indent=2)
+    os.replace(part_path, memo_path)
+
+def file_fingerprint(path, memo_path=None):
+    """SHA-256 of a file's content.
+
+    With `memo_path`, digests are remembered per (size, mtime) so unchanged
+    files are not re-read on every run.
+    """
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    stamp = f"{st.st_size}:{st.st_mtime_ns}"
+    memo = _load_memo(memo_path)
+    entry = memo.get(path)
+    if entry and entry.get('stamp') == stamp:
+        return entry['sha256']
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    sha = digest.hexdigest()
+    if memo_path:
+        memo = _load_memo(memo_path)
+        memo[path] = {'stamp': stamp, 'sha256': sha}
+        _save_memo(memo_path, memo)
+    return sha
+
+def payload_fingerprint(payload):
+    """SHA-256 of a JSON-serializable payload (e.g. config values and input digests)."""
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode('utf-8')).hexdigest()
@@ -1,10 +1,77 @@
-import geopandas as gpd
 import pandas as pd
+import numpy as np
 import os
+import rasterio
+import rasterio.features
+import rasterio.windows
+import shapely
+from shapely.geometry import box
+from . import vector_io
+from .zonal import block_windows
+import instrumentation
+
+def _label_histograms(clumps_path, gdf_labels, label_field, block_size=1024):
+    """Per-segment pixel counts of each label, from label polygons burned block by block onto the clumps grid.
+
+    Returns (segment_ids, labels, counts) where counts[i, j] is the number of
+    pixels of segment_ids[i] whose center falls inside a polygon of labels[j].
+    """
+    labels = sorted(gdf_labels[label_field].dropna().unique())
+    codes = {label: i + 1 for i, label in enumerate(labels)}
+    n_codes = len(labels) + 1
+    hist = np.zeros((0, n_codes), dtype=np.int64)
+    with rasterio.open(clumps_path) as clumps:
+        if gdf_labels.crs != clumps.crs:
+            gdf_labels = gdf_labels.to_crs(clumps.crs)
+        geoms = gdf_labels.geometry.values
+        values = gdf_labels[label_field].map(codes).to_numpy()
+        tree = gdf_labels.sindex
+        for window in block_windows(clumps.width, clumps.height, block_size):
+            idx = tree.query(box(*rasterio.windows.bounds(window, clumps.transform)))
+            idx = idx[pd.notna(values[idx])]
+            if len(idx) == 0:
+                continue
+            segments = clumps.read(1, window=window).astype(np.int64, copy=False)
+            burned = rasterio.features.rasterize(
+                zip(geoms[idx], values[idx].astype(int)), out_shape=segments.shape,
+                transform=clumps.window_transform(window), fill=0, dtype='uint16'
+            )
+            mask = burned > 0
+            if clumps.nodata is not None:
+                mask &= segments != clumps.nodata
+            if not mask.any():
+                continue
+            block_ids, inverse = np.unique(segments[mask], return_inverse=True)
+            counts = np.bincount(inverse * n_codes + burned[mask], minlength=len(block_ids) * n_codes)
+            if block_ids[-1] >= hist.shape[0]:
+                grown = np.zeros((max(int(block_ids[-1]) + 1, int(hist.shape[0] * 1.5)), n_codes), dtype=np.int64)
+                grown[:hist.shape[0]] = hist
+                hist = grown
+            hist[block_ids] += counts.reshape(-1, n_codes)
+    segment_ids = np.nonzero(hist.sum(axis=1))[0]
+    return segment_ids, labels, hist[segment_ids, 1:]
+
+def _raster_purity_labels(clumps_path, gdf_labels, label_field, min_purity=0.9, min_labeled_pixels=1, block_size=1024):
+    """Segments whose dominant label covers at least `min_purity` of their labeled pixels.
+
+    Only pixel centers inside a label polygon count, so polygons that merely
+    graze a segment's boundary do not disqualify it.
+    """
+    segment_ids, labels, counts = _label_histograms(clumps_path, gdf_labels, label_field, block_size)
+    labeled = counts.sum(axis=1)
+    dominant = counts.argmax(axis=1)
+    purity = counts[np.arange(len(segment_ids)), dominant] / np.maximum(labeled, 1)
+    keep = (labeled >= min_labeled_pixels) & (purity >= min_purity)
+    print(f"- {len(segment_ids)} segments overlap labels; {int(keep.sum())} pass purity >= {min_purity} with >= {min_labeled_pixels} labeled pixels.")
+    return pd.Series(np.asarray(labels, dtype=object)[dominant[keep]], index=pd.Index(segment_ids[keep], name='raster_val'))
 
 def generate_label_map(output_dir, data_dir, config):
-    """Performs a vector-based purity filter and creates a CSV map
+    """Performs a purity filter and creates a CSV map
     linking pure segment IDs to their text label and a numeric class ID.
+
+    labeling_params.mode selects the filter: 'vector' keeps segments that
+    intersect polygons of a single label; 'raster' burns the labels onto the
+    clumps grid and keeps segments by per-pixel label purity.
     """
     print("\n--- Starting Label Mapping (Purity Filter) ---")
 
@@ -21,24 +88,55 @@ def generate_label_map(output_dir, data_dir, config):
         print(f"- Label map file already exists: {os.path.basename(output_csv_path)}. Skipping.")
         return
 
-    # --- 1. Vector-based Purity Filter ---
-    print("- Loading segments and ground truth labels for purity analysis.")
-    gdf_segments = gpd.read_file(segmented_polygons_path)
-    gdf_labels = gpd.read_file(ground_truth_path)
-
-    if gdf_segments.crs != gdf_labels.crs:
-        gdf_labels = gdf_labels.to_crs(gdf_segments.crs)
+    label_field = config['labels_field_name']
+    labeling_params = config.get('labeling_params', {})
+    mode = labeling_params.get('mode', 'vector')
 
-    print("- Performing spatial join...")
-    sjoined = gpd.sjoin(gdf_segments, gdf_labels, how='inner', predicate='intersects')
+    if mode == 'raster':
+        # --- 1. Raster-based Purity Filter ---
+        clumps_path = os.path.join(segmentation_dir, config['output_names']['segmented_clumps'].replace('.kea', '.tif'))
+        print("- Loading ground truth labels and burning them onto the clumps grid.")
+        gdf_labels = vector_io.read_vector(ground_truth_path, columns=[label_field])
+        label_map = _raster_purity_labels(
+            clumps_path, gdf_labels, label_field,
+            min_purity=labeling_params.get('min_purity', 0.9),
+            min_labeled_pixels=labeling_params.get('min_labeled_pixels', 1),
+            block_size=labeling_params.get('block_size', 1024)
+        )
+        print(f"- Found {len(label_map)} purely labeled segments.")
+    elif mode == 'vector':
+        # --- 1. Vector-based Purity Filter ---
+        # Labels are read in chunks; for each chunk only the segments whose
+        # bounding box touches a label are read, and the segment/label pairs
+        # come from one bulk STRtree query.
+        print("- Reading ground truth labels in chunks and loading only the segments they touch.")
+        segments_crs = vector_io.read_vector_info(segmented_polygons_path)['crs']
+        pairs = []
+        n_segments_read = 0
+        for gdf_labels in vector_io.iter_vector(ground_truth_path, columns=[label_field], chunk_size=labeling_params.get('label_chunk_size', 50000)):
+            gdf_labels = gdf_labels[gdf_labels[label_field].notna() & gdf_labels.geometry.notna()]
+            if gdf_labels.empty:
+                continue
+            if gdf_labels.crs != segments_crs:
+                gdf_labels = gdf_labels.to_crs(segments_crs)
+            label_geoms = gdf_labels.geometry.values
+            gdf_segments = vector_io.read_vector_intersecting(segmented_polygons_path, label_geoms, columns=['raster_val'])
+            n_segments_read += len(gdf_segments)
+            segment_idx, label_idx = shapely.STRtree(label_geoms).query(gdf_segments.geometry.values, predicate='intersects')
+            pairs.append(pd.DataFrame({
+                'raster_val': gdf_segments['raster_val'].to_numpy()[segment_idx],
+                label_field: gdf_labels[label_field].to_numpy()[label_idx]
+            }))
+        pairs = pd.concat(pairs, ignore_index=True).drop_duplicates() if pairs else pd.DataFrame(columns=['raster_val', label_field])
+        print(f"- Read {n_segments_read} candidate segments; {pairs['raster_val'].nunique()} intersect labels.")
 
-    label_field = config['labels_field_name']
-    labels_per_segment = sjoined.groupby('raster_val')[label_field].nunique()
-    pure_segments_ids = labels_per_segment[labels_per_segment == 1].index
-    print(f"- Found {len(pure_segments_ids)} purely labeled segments.")
+        labels_per_segment = pairs.groupby('raster_val')[label_field].nunique()
+        pure_segments_ids = labels_per_segment[labels_per_segment == 1].index
+        print(f"- Found {len(pure_segments_ids)} purely labeled segments.")
 
-    pure_sjoined = sjoined[sjoined['raster_val'].isin(pure_segments_ids)]
-    label_map = pure_sjoined.groupby('raster_val')[label_field].first()
+        label_map = pairs[pairs['raster_val'].isin(pure_segments_ids)].groupby('raster_val')[label_field].first()
+    else:
+        raise ValueError(f"Unsupported labeling mode '{mode}'. Use 'vector' or 'raster'.")
 
     # --- 2. Create Final Mapping DataFrame ---
     df_map = label_map.reset_index()
@@ -51,5 +149,6 @@ def generate_label_map(output_dir, data_dir, config):
     # --- 4. Save the Mapping to CSV ---
     print(f"- Saving segment-to-label map to: {os.path.basename(output_csv_path)}")
     df_map.to_csv(output_csv_path, index=False)
+    instrumentation.count('segments', len(df_map))
 
     print("- Label mapping phase complete.")
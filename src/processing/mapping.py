@@ -1,12 +1,161 @@
 import pandas as pd
-import geopandas as gpd
 import joblib
 import os
 import numpy as np
-from datetime import datetime
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import rasterio
+from . import vector_io, feature_store, cog
+from .zonal import block_windows
+import instrumentation
+from instrumentation import log as _log
 
-def _log(message):
-    print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {message}")
+# Model loaded once per inference worker process
+_worker_model = None
+
+# Models already loaded in this process, keyed by path: (mtime, model)
+_model_cache = {}
+
+def load_model(model_path):
+    """Loads a joblib model, reusing the loaded copy while the file is unchanged (e.g. across batch jobs)."""
+    path = os.path.abspath(model_path)
+    mtime = os.path.getmtime(path)
+    cached = _model_cache.get(path)
+    if cached is None or cached[0] != mtime:
+        _model_cache[path] = (mtime, joblib.load(path))
+    return _model_cache[path][1]
+
+def _init_worker(model_path):
+    global _worker_model
+    _worker_model = load_model(model_path)
+
+def _predict_batch(model, batch, feature_cols):
+    """Runs the model once per batch: the class is the argmax of predict_proba."""
+    proba = model.predict_proba(batch[feature_cols])
+    best = np.argmax(proba, axis=1)
+    return pd.DataFrame({
+        'segment_id': batch['segment_id'].to_numpy(),
+        'class_id': model.classes_[best],
+        'probability': proba[np.arange(len(best)), best]
+    })
+
+def _predict_batch_in_worker(args):
+    batch, feature_cols = args
+    return _predict_batch(_worker_model, batch, feature_cols)
+
+def predict_batches(model_path, batches, feature_cols, n_jobs=1):
+    """Yields prediction frames for each feature batch, in input order.
+
+    With n_jobs > 1 batches are scored in a process pool, each worker loading
+    the model once; at most 2 * n_jobs batches are in flight at any time.
+    """
+    if n_jobs <= 1:
+        model = load_model(model_path)
+        for batch in batches:
+            yield _predict_batch(model, batch, feature_cols)
+        return
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=(model_path,)) as executor:
+        pending = deque()
+        for batch in batches:
+            pending.append(executor.submit(_predict_batch_in_worker, (batch, feature_cols)))
+            if len(pending) >= 2 * n_jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+MAP_FORMATS = ('vector', 'raster', 'both')
+
+def map_output_paths(config, output_dir):
+    """Paths of the map outputs selected by modeling_params.output_map_format."""
+    modeling_params = config['modeling_params']
+    modeling_dir = os.path.join(output_dir, 'modeling')
+    fmt = modeling_params.get('output_map_format', 'vector')
+    if fmt not in MAP_FORMATS:
+        raise ValueError(f"Unsupported output_map_format '{fmt}'. Use one of {MAP_FORMATS}.")
+    paths = []
+    if fmt in ('vector', 'both'):
+        paths.append(os.path.join(modeling_dir, modeling_params['output_map_name']))
+    if fmt in ('raster', 'both'):
+        paths.append(os.path.join(modeling_dir, modeling_params.get('output_raster_map_name', 'predicted_map.tif')))
+    return paths
+
+class PredictionLookup:
+    """Dense segment ID -> prediction arrays, filled batch by batch as predictions are produced.
+
+    `class_lut` and `confidence_lut` (0-100) are uint8 with 0 marking
+    unpredicted segments; `probability_lut` keeps the model probability for
+    the vector map. Memory grows with the largest segment ID (7 bytes per ID)
+    rather than with a DataFrame of all predictions.
+    """
+    def __init__(self):
+        self.class_lut = np.zeros(1, dtype=np.uint8)
+        self.confidence_lut = np.zeros(1, dtype=np.uint8)
+        self.probability_lut = np.zeros(1, dtype=np.float32)
+        self.predicted = np.zeros(1, dtype=bool)
+
+    def _grow(self, size):
+        size = max(size, self.class_lut.shape[0] + self.class_lut.shape[0] // 2)
+        for name in ('class_lut', 'confidence_lut', 'probability_lut', 'predicted'):
+            old = getattr(self, name)
+            new = np.zeros(size, dtype=old.dtype)
+            new[:old.shape[0]] = old
+            setattr(self, name, new)
+
+    def add(self, predictions):
+        if not len(predictions):
+            return
+        if predictions['class_id'].max() > 254:
+            raise ValueError("The raster map supports at most 254 classes.")
+        ids = predictions['segment_id'].to_numpy(dtype=np.int64)
+        size = int(ids.max()) + 1
+        if size > self.class_lut.shape[0]:
+            self._grow(size)
+        probability = predictions['probability'].to_numpy()
+        self.class_lut[ids] = predictions['class_id'].to_numpy()
+        self.confidence_lut[ids] = np.clip(np.rint(probability * 100), 1, 100)
+        self.probability_lut[ids] = probability
+        self.predicted[ids] = True
+        # Segment 0 is the clumps nodata value and never gets a class
+        self.class_lut[0] = self.confidence_lut[0] = 0
+        self.predicted[0] = False
+
+    def has_prediction(self, segment_ids):
+        """Mask of `segment_ids` that have a prediction (IDs beyond the tables have none)."""
+        segment_ids = np.asarray(segment_ids, dtype=np.int64)
+        known = (segment_ids >= 0) & (segment_ids < self.predicted.shape[0])
+        known[known] = self.predicted[segment_ids[known]]
+        return known
+
+def write_raster_map(clumps_path, lookup, output_path, class_labels=None, block_size=1024, blocksize=512):
+    """Writes the classified map as a two-band uint8 COG by indexing `lookup`'s tables with the clumps raster.
+
+    Band 1 holds the class ID and band 2 the confidence in percent; 0 is
+    nodata in both. Class labels are stored as band 1 tags.
+    """
+    class_lut, confidence_lut = lookup.class_lut, lookup.confidence_lut
+    tmp_path = f"{output_path}.tmp.tif"
+    with rasterio.open(clumps_path) as clumps:
+        profile = clumps.profile.copy()
+        profile.update(driver='GTiff', dtype='uint8', count=2, nodata=0, tiled=True,
+                       blockxsize=blocksize, blockysize=blocksize, compress=None)
+        with rasterio.open(tmp_path, 'w', **profile) as dst:
+            for window in block_windows(clumps.width, clumps.height, block_size):
+                segments = clumps.read(1, window=window).astype(np.int64, copy=False)
+                known = (segments >= 0) & (segments < class_lut.shape[0])
+                if clumps.nodata is not None:
+                    known &= segments != clumps.nodata
+                segments = np.where(known, segments, 0)
+                dst.write(np.where(known, class_lut[segments], 0), 1, window=window)
+                dst.write(np.where(known, confidence_lut[segments], 0), 2, window=window)
+            dst.set_band_description(1, 'class_id')
+            dst.set_band_description(2, 'confidence')
+            if class_labels:
+                dst.update_tags(1, **{str(class_id): str(label) for class_id, label in class_labels.items()})
+    try:
+        cog.to_cog(tmp_path, output_path, compress='DEFLATE', blocksize=blocksize, overview_resampling='nearest')
+    finally:
+        os.remove(tmp_path)
+    return output_path
 
 def generate_map(config, output_dir, model_path=None):
     _log("--- Executing PHASE: Predict and Generate Map ---")
@@ -19,72 +168,107 @@ def generate_map(config, output_dir, model_path=None):
     if model_path is None:
         model_path = os.path.join(modeling_dir, config['modeling_params']['output_model_name'])
     
-    features_path = os.path.join(output_dir, config['output_names']['features_csv'])
+    features_path = feature_store.store_path(output_dir, config)
     # The label map is needed to map class IDs back to text labels
     # In prediction mode, we need to get it from the original output directory
-    original_output_dir = os.path.dirname(output_dir) if 'prediction_' in os.path.basename(output_dir) else output_dir
+    prediction_mode = 'prediction_' in os.path.basename(output_dir)
+    original_output_dir = os.path.dirname(output_dir) if prediction_mode else output_dir
     label_map_path = os.path.join(original_output_dir, 'labeling', 'segment_label_map.csv')
-    polygons_path = os.path.join(output_dir, 'segmentation', config['output_names']['segmented_polygons'])
+    # Prediction runs may reuse the reference year's segments instead of their own
+    reuse_segmentation = prediction_mode and config.get('prediction_params', {}).get('reuse_reference_segmentation', False)
+    segmentation_dir = os.path.join(original_output_dir if reuse_segmentation else output_dir, 'segmentation')
+    polygons_path = os.path.join(segmentation_dir, config['output_names']['segmented_polygons'])
+    clumps_path = os.path.join(segmentation_dir, config['output_names']['segmented_clumps'].replace('.kea', '.tif'))
     
     predictions_csv_path = os.path.join(modeling_dir, config['modeling_params']['output_prediction_name'])
-    output_map_path = os.path.join(modeling_dir, config['modeling_params']['output_map_name'])
+    map_format = config['modeling_params'].get('output_map_format', 'vector')
+    output_map_paths = map_output_paths(config, output_dir)
 
     if not os.path.exists(model_path):
         _log(f"Model not found at {model_path}. Please run the 'train' phase first.")
         return
 
-    if os.path.exists(output_map_path):
-        _log(f"Predicted map already exists at {output_map_path}. Skipping.")
+    if all(os.path.exists(p) for p in output_map_paths):
+        _log(f"Predicted map already exists at {', '.join(output_map_paths)}. Skipping.")
         return
 
-    # --- Load Model and Data ---
-    _log(f"Loading model from {model_path}")
-    model = joblib.load(model_path)
+    modeling_params = config['modeling_params']
+    batch_size = modeling_params.get('predict_batch_size', 100000)
+    n_jobs = modeling_params.get('predict_n_jobs') or os.cpu_count() or 1
 
-    _log(f"Loading full feature set from {features_path}")
-    features_df = pd.read_csv(features_path)
+    # --- Load Feature Schema and Label Map ---
+    # Models saved with a feature list (e.g. after pruning) are fed exactly those columns
+    feature_cols = feature_store.load_model_features(model_path)
+    if feature_cols is None:
+        _log(f"Reading feature columns from {features_path}")
+        feature_cols = feature_store.feature_columns(features_path)
+    else:
+        _log(f"Using the {len(feature_cols)} features the model was trained on")
 
     _log(f"Loading label map for class name lookup from {label_map_path}")
     label_map_df = pd.read_csv(label_map_path)
-
-    # --- Predict on Full Dataset ---
-    _log("Generating predictions for all segments...")
-    # Prepare features for prediction (drop non-feature columns)
-    cols_to_drop = ['segment_id', 'label', 'class_id']
-    if 'klass' in features_df.columns:
-        cols_to_drop.append('klass')
-    
-    cols_to_drop_existing = [col for col in cols_to_drop if col in features_df.columns]
-    features_to_predict = features_df.drop(columns=cols_to_drop_existing)
-    
-    predictions_numeric = model.predict(features_to_predict)
-    predictions_proba = model.predict_proba(features_to_predict)
-    _log("Prediction complete.")
-
-    # --- Format Results ---
-    _log("Formatting prediction results...")
     class_id_to_label = dict(zip(label_map_df['class_id'], label_map_df['label']))
 
-    confidence = np.max(predictions_proba, axis=1)
-
-    results_df = pd.DataFrame({
-        'segment_id': features_df['segment_id'],
-        'class_id': predictions_numeric,
-        'probability': confidence
-    })
-    results_df['prediction'] = results_df['class_id'].map(class_id_to_label)
-
-    _log(f"Saving prediction data to {predictions_csv_path}")
-    results_df.to_csv(predictions_csv_path, index=False)
-
-    # --- Generate Final Map ---
-    _log("Generating final map by joining predictions with polygons...")
-    _log(f"Loading polygons from {polygons_path}")
-    polygons_gdf = gpd.read_file(polygons_path)
+    # --- Predict in Batches ---
+    # Features are read and scored batch by batch and each batch's results are
+    # appended to the predictions file, so memory stays flat with segment count.
+    _log(f"Generating predictions for all segments (model: {model_path}, batch size: {batch_size}, workers: {n_jobs})...")
+    batches = feature_store.iter_batches(features_path, columns=['segment_id'] + feature_cols, batch_size=batch_size)
+    part_path = f"{predictions_csv_path}.part"
+    n_predicted = 0
+    lookup = PredictionLookup()
+    with instrumentation.span('inference', 'batch', batch_size=batch_size, workers=n_jobs) as span:
+        for results_df in predict_batches(model_path, batches, feature_cols, n_jobs=n_jobs):
+            results_df['prediction'] = results_df['class_id'].map(class_id_to_label)
+            results_df.to_csv(part_path, mode='a' if n_predicted else 'w', header=not n_predicted, index=False)
+            lookup.add(results_df)
+            n_predicted += len(results_df)
+            span.count('batches')
+        span.count('rows', n_predicted)
+    if not os.path.exists(part_path):
+        pd.DataFrame(columns=['segment_id', 'class_id', 'probability', 'prediction']).to_csv(part_path, index=False)
+    os.replace(part_path, predictions_csv_path)
+    _log(f"Prediction complete. Saved {n_predicted} predictions to {predictions_csv_path}")
 
-    merged_gdf = polygons_gdf.merge(results_df, left_on='raster_val', right_on='segment_id')
+    # --- Generate Raster Map ---
+    if map_format in ('raster', 'both'):
+        raster_map_path = output_map_paths[-1]
+        _log(f"Writing classified raster map (class + confidence) to {raster_map_path}")
+        with instrumentation.span('raster_map', 'io'):
+            write_raster_map(clumps_path, lookup, raster_map_path, class_labels=class_id_to_label,
+                             blocksize=config.get('mosaic_params', {}).get('blocksize', 512))
 
-    _log(f"Saving final predicted map to {output_map_path}")
-    merged_gdf.to_file(output_map_path)
+    # --- Generate Vector Map ---
+    if map_format in ('vector', 'both'):
+        output_map_path = output_map_paths[0]
+        _log("Generating vector map by joining predictions with polygons...")
+        _log(f"Streaming polygons from {polygons_path}; saving final predicted map to {output_map_path}")
+        # Polygons are joined chunk by chunk against the lookup tables built
+        # during inference, so neither the polygons nor the predictions are
+        # ever held in memory as a whole.
+        writer = vector_io.VectorBatchWriter(output_map_path, vector_io.read_vector_info(polygons_path)['crs'])
+        empty_gdf = None
+        with instrumentation.span('vector_map', 'io') as span:
+            for polygons_gdf in vector_io.iter_vector(polygons_path, columns=['raster_val'], chunk_size=batch_size):
+                segment_ids = polygons_gdf['raster_val'].to_numpy(dtype=np.int64)
+                known = lookup.has_prediction(segment_ids)
+                merged_gdf = polygons_gdf[known].copy()
+                segment_ids = segment_ids[known]
+                merged_gdf['segment_id'] = segment_ids
+                merged_gdf['class_id'] = lookup.class_lut[segment_ids].astype(np.int64)
+                merged_gdf['probability'] = lookup.probability_lut[segment_ids]
+                merged_gdf['prediction'] = merged_gdf['class_id'].map(class_id_to_label)
+                writer.write(merged_gdf)
+                if empty_gdf is None:
+                    empty_gdf = merged_gdf.iloc[:0]
+                span.count('chunks')
+            writer.close()
+            span.count('segments', writer.n_written)
+        if not os.path.exists(output_map_path):
+            # No polygon matched a prediction; still leave an (empty) map behind
+            if empty_gdf is None:
+                empty_gdf = vector_io.read_vector(polygons_path, columns=['raster_val']).iloc[:0].assign(
+                    segment_id=[], class_id=[], probability=[], prediction=[])
+            vector_io.write_vector(empty_gdf, output_map_path)
 
-    _log("--- Predict and Generate Map phase complete ---")
\ No newline at end of file
+    _log("--- Predict and Generate Map phase complete ---")
@@ -1,13 +1,18 @@
 import pandas as pd
+import numpy as np
 import joblib
 import os
+import time
+import shutil
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import classification_report
-from tpot import TPOTClassifier
-from datetime import datetime
-
-def _log(message):
-    print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {message}")
+from sklearn.ensemble import HistGradientBoostingClassifier
+from sklearn.inspection import permutation_importance
+from sklearn.base import clone
+from tpot import TPOTClassifier, __version__ as TPOT_VERSION
+from . import feature_store, fingerprint
+import instrumentation
+from instrumentation import log as _log
 
 def _balance_classes(data, config):
     if not config.get('balance_classes', False):
@@ -17,25 +22,236 @@ def _balance_classes(data, config):
     col_clase = 'label'
     _log(f"Balancing classes to a max of {max_samples} samples per class.")
 
-    conteo_clases = data[col_clase].value_counts()
-    clases_grandes = conteo_clases[conteo_clases > max_samples].index
-    
-    frames = []
-    for clase in clases_grandes:
-        clase_df = data[data[col_clase] == clase]
-        clase_df_reducido = clase_df.sample(n=max_samples, random_state=config.get('random_state', 42))
-        frames.append(clase_df_reducido)
-    
-    otras_clases_df = data[~data[col_clase].isin(clases_grandes)]
-    data_balanceado = pd.concat([otras_clases_df] + frames)
+    # One random permutation, then keep the first max_samples rows of each class
+    shuffled = data.sample(frac=1, random_state=config.get('random_state', 42))
+    data_balanceado = shuffled[shuffled.groupby(col_clase).cumcount() < max_samples].sort_index()
     _log(f"Data balanced. New size: {len(data_balanceado)} rows.")
     return data_balanceado
 
+def _load_checkpoint(checkpoint_path, run_key):
+    """Loads a TPOT search checkpoint if it belongs to the same data and settings."""
+    if not os.path.exists(checkpoint_path):
+        return None
+    try:
+        checkpoint = joblib.load(checkpoint_path)
+    except Exception as e:
+        _log(f"Warning: Could not read checkpoint {checkpoint_path} ({e}). Starting a new search.")
+        return None
+    if checkpoint.get('run_key') != run_key:
+        _log("Checkpoint was made with different training data or settings. Starting a new search.")
+        return None
+    return checkpoint
+
+def _save_checkpoint(checkpoint_path, checkpoint):
+    part_path = f"{checkpoint_path}.part"
+    joblib.dump(checkpoint, part_path)
+    os.replace(part_path, checkpoint_path)
+
+# Checkpointing reads and restores private TPOT state; other versions run the search in one go
+CHECKPOINT_TPOT_VERSIONS = ('0.12.',)
+
+def _checkpointing_supported():
+    return TPOT_VERSION.startswith(CHECKPOINT_TPOT_VERSIONS) and hasattr(TPOTClassifier, '_fit_init')
+
+def _search_state(tpot):
+    """The parts of a TPOT search a checkpoint stores, or None if this TPOT does not expose them."""
+    try:
+        return {
+            'population': [str(ind) for ind in tpot._pop],
+            'evaluated_individuals': tpot.evaluated_individuals_,
+            'stale_generations': tpot._last_optimized_pareto_front_n_gens,
+        }
+    except AttributeError:
+        return None
+
+def _restore_search(tpot, checkpoint):
+    """Seeds a warm-start TPOT with a checkpointed population and its already evaluated pipelines."""
+    from deap import creator
+    tpot._fit_init()
+    tpot._pop = [creator.Individual.from_string(s, tpot._pset) for s in checkpoint['population']]
+    tpot.evaluated_individuals_ = dict(checkpoint['evaluated_individuals'])
+    tpot._last_optimized_pareto_front_n_gens = checkpoint.get('stale_generations', 0)
+
+def _run_tpot_search(tpot_config, X_train, y_train, modeling_params, checkpoint_path, run_key):
+    """Runs the TPOT search a few generations at a time, checkpointing after each chunk.
+
+    The population and the scores of every evaluated pipeline are saved, so an
+    interrupted search resumes where it stopped without re-scoring pipelines.
+    Stops after `tpot_generations` in total, when `max_time_mins` of search time
+    is used up, or after `early_stop` generations without improvement.
+    """
+    total_generations = tpot_config['generations']
+    chunk = max(1, modeling_params.get('tpot_checkpoint_every', 1))
+    max_time_mins = modeling_params.get('max_time_mins')
+    early_stop = modeling_params.get('early_stop')
+    if not _checkpointing_supported():
+        _log(f"Warning: Checkpointing is not supported with TPOT {TPOT_VERSION}. Running the search without checkpoints.")
+        tpot = TPOTClassifier(**dict(tpot_config, max_time_mins=max_time_mins, early_stop=early_stop))
+        with instrumentation.span('tpot_generations', 'batch') as span:
+            tpot.fit(X_train, y_train)
+            span.count('generations', total_generations)
+        return tpot
+
+    tpot = TPOTClassifier(**dict(tpot_config, generations=chunk, warm_start=True, early_stop=early_stop))
+    checkpoint = _load_checkpoint(checkpoint_path, run_key)
+    generations_done, elapsed = 0, 0.0
+    if checkpoint is not None:
+        try:
+            _restore_search(tpot, checkpoint)
+            generations_done, elapsed = checkpoint['generations_done'], checkpoint['elapsed_seconds']
+            _log(f"Resuming TPOT search from checkpoint after {generations_done} generations ({len(checkpoint['evaluated_individuals'])} pipelines already evaluated).")
+        except Exception as e:
+            _log(f"Warning: Could not restore checkpoint ({e}). Starting a new search.")
+            tpot = TPOTClassifier(**dict(tpot_config, generations=chunk, warm_start=True, early_stop=early_stop))
+
+    while True:
+        remaining = None if max_time_mins is None else max_time_mins - elapsed / 60
+        out_of_time = remaining is not None and remaining <= 0
+        n_gens = 0 if out_of_time else max(0, min(chunk, total_generations - generations_done))
+        if n_gens == 0 and getattr(tpot, 'fitted_pipeline_', None) is not None:
+            if out_of_time:
+                _log(f"Search time budget of {max_time_mins} minutes used up.")
+            break
+        # A session always fits at least once, so a resumed search that is already
+        # complete still rebuilds its best pipeline (from the cached scores).
+        tpot.generations = n_gens
+        tpot.max_time_mins = None if out_of_time else remaining
+        start = time.time()
+        with instrumentation.span('tpot_generations', 'batch') as span:
+            tpot.fit(X_train, y_train)
+            span.count('generations', n_gens)
+        elapsed += time.time() - start
+        generations_done += n_gens
+
+        state = _search_state(tpot)
+        if state is None:
+            _log(f"Warning: TPOT {TPOT_VERSION} does not expose its search state. Continuing without checkpoints.")
+        else:
+            _save_checkpoint(checkpoint_path, dict(state, run_key=run_key, generations_done=generations_done, elapsed_seconds=elapsed))
+            _log(f"Checkpoint saved after {generations_done}/{total_generations} generations ({elapsed / 60:.1f} min of search).")
+        if n_gens == 0:
+            break
+        if early_stop is not None and state is not None and state['stale_generations'] >= early_stop:
+            _log(f"No improvement for {early_stop} generations. Stopping early.")
+            break
+    return tpot
+
+def _dask_client(modeling_params):
+    """Connects to `dask_scheduler_address`, or starts a local cluster of worker processes.
+
+    Returns (client, cluster); cluster is None for an external scheduler.
+    """
+    from dask.distributed import Client, LocalCluster
+    address = modeling_params.get('dask_scheduler_address')
+    if address:
+        _log(f"Connecting to Dask scheduler at {address}")
+        return Client(address), None
+    n_workers = modeling_params.get('dask_n_workers') or os.cpu_count() or 1
+    cluster = LocalCluster(n_workers=n_workers, threads_per_worker=1, processes=True)
+    _log(f"Started a local Dask cluster with {n_workers} workers (dashboard: {cluster.dashboard_link})")
+    return Client(cluster), cluster
+
+def _train_tpot(X_train, y_train, modeling_params, modeling_dir, checkpoint_path, random_state):
+    """Searches for the best pipeline with TPOT and returns it fitted.
+
+    With `use_dask`, candidate pipelines are evaluated on a Dask cluster
+    instead of the local joblib pool.
+    """
+    tpot_config = {
+        'generations': modeling_params.get('tpot_generations', 5),
+        'population_size': modeling_params.get('tpot_population_size', 20),
+        'verbosity': 2,
+        'random_state': random_state,
+        'n_jobs': -1,
+        'config_dict': 'TPOT light'
+    }
+    if modeling_params.get('tpot_memory', True):
+        # Fitted pipeline steps are cached on disk and reused across generations and runs
+        tpot_config['memory'] = os.path.join(modeling_dir, 'tpot_cache')
+    client = cluster = None
+    if modeling_params.get('use_dask', False):
+        client, cluster = _dask_client(modeling_params)
+        tpot_config['use_dask'] = True
+        tpot_config['n_jobs'] = max(1, sum(client.nthreads().values()))
+    _log(f"Initializing TPOT with config: {tpot_config}")
+
+    run_key = fingerprint.payload_fingerprint({
+        'train': pd.util.hash_pandas_object(X_train).sum(),
+        'target': pd.util.hash_pandas_object(y_train).sum(),
+        'columns': list(X_train.columns),
+        # Raising tpot_generations continues a checkpointed search instead of
+        # restarting it; where pipelines are evaluated does not change the search.
+        'tpot': {k: v for k, v in tpot_config.items() if k not in ('generations', 'n_jobs', 'use_dask', 'memory')},
+    })
+
+    _log("Starting TPOT training...")
+    try:
+        tpot = _run_tpot_search(tpot_config, X_train, y_train, modeling_params, checkpoint_path, run_key)
+    finally:
+        if client is not None:
+            client.close()
+        if cluster is not None:
+            cluster.close()
+    return tpot.fitted_pipeline_
+
+def _train_hist_gbm(X_train, y_train, modeling_params, random_state):
+    """Trains a histogram gradient-boosting classifier with early stopping.
+
+    Boosting stops once the score on a held-out, stratified part of the
+    training split stops improving.
+    """
+    gbm_params = {
+        'max_iter': 500,
+        'learning_rate': 0.1,
+        'max_leaf_nodes': 31,
+        'validation_fraction': 0.1,
+        'n_iter_no_change': 20,
+    }
+    gbm_params.update(modeling_params.get('hist_gbm_params') or {})
+    _log(f"Training HistGradientBoostingClassifier with params: {gbm_params}")
+    model = HistGradientBoostingClassifier(early_stopping=True, random_state=random_state, **gbm_params)
+    model.fit(X_train, y_train)
+    _log(f"Boosting stopped after {model.n_iter_} iterations.")
+    return model
+
+def _prune_features(model, X_train, y_train, modeling_params, random_state):
+    """Selects features by permutation importance, skipping ones highly correlated with a better feature.
+
+    A validation split (`pruning_validation_size`) is carved out of the
+    training data and the model is refit on the rest, so the test split stays
+    held out for the report. Features are ranked by their mean permutation
+    importance on the validation split; walking down the ranking, a feature is
+    kept unless its absolute correlation with an already kept feature exceeds
+    `pruning_max_correlation`. Returns the kept features, most important first.
+    """
+    max_features = modeling_params.get('pruning_max_features', 100)
+    max_correlation = modeling_params.get('pruning_max_correlation', 0.95)
+    X_fit, X_val, y_fit, y_val = train_test_split(X_train, y_train, test_size=modeling_params.get('pruning_validation_size', 0.2),
+                                                  random_state=random_state, stratify=y_train)
+    model = clone(model).fit(X_fit, y_fit)
+    result = permutation_importance(model, X_val, y_val, n_repeats=modeling_params.get('pruning_n_repeats', 3),
+                                    random_state=random_state, n_jobs=-1)
+    order = np.argsort(-result.importances_mean)
+    ranked = [X_val.columns[i] for i in order if result.importances_mean[i] > 0]
+    if not ranked:
+        _log("Warning: No feature has a positive permutation importance. Keeping all features.")
+        return list(X_train.columns)
+
+    correlation = X_fit[ranked].corr().abs()
+    selected = []
+    for column in ranked:
+        if len(selected) >= max_features:
+            break
+        if selected and correlation.loc[column, selected].max() > max_correlation:
+            continue
+        selected.append(column)
+    return selected
+
 def train_model(config, output_dir):
     _log("--- Executing PHASE: Train Model ---")
     
     # --- Define Paths ---
-    features_path = os.path.join(output_dir, config['output_names']['features_csv'])
+    features_path = feature_store.store_path(output_dir, config)
     label_map_path = os.path.join(output_dir, 'labeling', 'segment_label_map.csv')
     modeling_dir = os.path.join(output_dir, 'modeling')
     os.makedirs(modeling_dir, exist_ok=True)
@@ -48,33 +264,27 @@ def train_model(config, output_dir):
         return
 
     # --- Load Data ---
-    _log(f"Loading features from {features_path}")
-    features_df = pd.read_csv(features_path)
-    
     _log(f"Loading label map from {label_map_path}")
     label_map_df = pd.read_csv(label_map_path)
 
+    # Only labeled segments are read from the feature store (row filter pushed down to the reader)
+    _log(f"Loading features of {len(label_map_df)} labeled segments from {features_path}")
+    feature_cols = feature_store.feature_columns(features_path)
+    features_df = feature_store.load_features(
+        features_path,
+        columns=['segment_id'] + feature_cols,
+        filters=[('segment_id', 'in', label_map_df['segment_id'].tolist())]
+    )
+
     # --- Prepare Data for Training ---
     _log("Preparing data for training...")
-    # Merge features with labels, handling potential duplicate columns
-    training_data = pd.merge(features_df, label_map_df, on='segment_id', suffixes=('_features', '_labels'))
-
-    # If merge created duplicate columns, clean them up, prioritizing the label map
-    if 'label_labels' in training_data.columns:
-        training_data['label'] = training_data['label_labels']
-        training_data['class_id'] = training_data['class_id_labels']
-        training_data.drop(columns=['label_labels', 'class_id_labels', 'label_features', 'class_id_features'], inplace=True)
+    training_data = pd.merge(features_df, label_map_df[['segment_id', 'label', 'class_id']], on='segment_id')
 
     # Balance classes
     balanced_data = _balance_classes(training_data, config['modeling_params'])
     
     # Define features (X) and target (y)
-    # Drop non-feature columns
-    drop_cols = ['segment_id', 'label', 'class_id']
-    if 'klass' in balanced_data.columns:
-        drop_cols.append('klass')
-        
-    X = balanced_data.drop(columns=drop_cols)
+    X = balanced_data[feature_cols]
     y = balanced_data['class_id']
 
     # Split data
@@ -85,25 +295,33 @@ def train_model(config, output_dir):
     _log(f"Training data shape: {X_train.shape}")
     _log(f"Testing data shape: {X_test.shape}")
 
-    # --- Train TPOT Model ---
-    tpot_config = {
-        'generations': config['modeling_params'].get('tpot_generations', 5),
-        'population_size': config['modeling_params'].get('tpot_population_size', 20),
-        'verbosity': 2,
-        'random_state': random_state,
-        'n_jobs': -1,
-        'config_dict': 'TPOT light'
-    }
-    _log(f"Initializing TPOT with config: {tpot_config}")
-    tpot = TPOTClassifier(**tpot_config)
-    
-    _log("Starting TPOT training...")
-    tpot.fit(X_train, y_train)
-    
-    _log("TPOT training complete. Evaluating model...")
+    # --- Train Model ---
+    modeling_params = config['modeling_params']
+    engine = modeling_params.get('engine', 'tpot')
+    checkpoint_path = os.path.join(modeling_dir, 'tpot_checkpoint.pkl')
+    with instrumentation.span('fit', 'model', engine=engine) as span:
+        span.count('rows', len(X_train))
+        if engine == 'hist_gbm':
+            X_train, X_test = X_train.astype(np.float32), X_test.astype(np.float32)
+            model = _train_hist_gbm(X_train, y_train, modeling_params, random_state)
+        elif engine == 'tpot':
+            model = _train_tpot(X_train, y_train, modeling_params, modeling_dir, checkpoint_path, random_state)
+        else:
+            raise ValueError(f"Unsupported modeling engine '{engine}'. Use 'tpot' or 'hist_gbm'.")
+
+    # --- Prune Features and Refit ---
+    if modeling_params.get('feature_pruning', False):
+        _log("Ranking features by permutation importance and correlation...")
+        with instrumentation.span('prune_features', 'model') as span:
+            selected = _prune_features(model, X_train, y_train, modeling_params, random_state)
+            _log(f"Selected {len(selected)} of {X_train.shape[1]} features. Refitting the model on them...")
+            X_train, X_test = X_train[selected], X_test[selected]
+            model = clone(model).fit(X_train, y_train)
+            span.count('features', len(selected))
+    _log("Training complete. Evaluating model...")
 
     # --- Evaluate and Save Report ---
-    predictions = tpot.predict(X_test)
+    predictions = model.predict(X_test)
     report = classification_report(y_test, predictions)
     
     _log("Classification Report:")
@@ -115,6 +333,11 @@ def train_model(config, output_dir):
 
     # --- Save Model ---
     _log(f"Saving trained model to {model_path}")
-    joblib.dump(tpot.fitted_pipeline_, model_path)
+    joblib.dump(model, model_path)
+    feature_store.save_model_features(model_path, X_train.columns)
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    # The pipeline step cache only speeds up a search; it can grow large and is not needed once the model is saved
+    shutil.rmtree(os.path.join(modeling_dir, 'tpot_cache'), ignore_errors=True)
     
     _log("--- Train Model phase complete ---")
\ No newline at end of file
@@ -0,0 +1,191 @@
+import os
+import math
+import shutil
+import numpy as np
+import rasterio
+import rasterio.windows
+from osgeo import gdal, gdal_array
+from . import cog
+from instrumentation import log as _log
+
+gdal.UseExceptions()
+
+MOSAIC_FORMATS = ('GTiff', 'COG', 'VRT')
+
+def mosaic_output_path(output_path, fmt='GTiff'):
+    """Returns the file the mosaic is written to for a given output format."""
+    if fmt.upper() == 'VRT':
+        return os.path.splitext(output_path)[0] + '.vrt'
+    return output_path
+
+class StreamingMosaicWriter:
+    """Merges downloaded tiles into one raster as they arrive.
+
+    The output grid is preallocated from the expected tile footprints (using the
+    resolution and pixel alignment of the first tile), each tile is written into
+    its window and deleted straight away, so the mosaic never needs all tiles on
+    disk at once. Merged tiles are recorded in a ledger inside the tile
+    directory so an interrupted download resumes without refetching them; the
+    mosaic is flushed to disk before a tile enters the ledger and is deleted.
+    The partial mosaic stays open and uncompressed while tiles arrive and is
+    compressed once in `finish`. Use it as a context manager so the mosaic is
+    closed if the download fails.
+
+    `fmt` selects the final product: a tiled GeoTIFF ('GTiff'), a
+    Cloud-Optimized GeoTIFF with overviews ('COG'), or a VRT over the kept
+    tiles ('VRT').
+    """
+    def __init__(self, output_path, fmt='GTiff', compress='LZW', blocksize=512, overview_resampling='average'):
+        fmt = {f.upper(): f for f in MOSAIC_FORMATS}.get(fmt.upper())
+        if fmt is None:
+            raise ValueError(f"Unsupported mosaic format. Expected one of {MOSAIC_FORMATS}.")
+        self.fmt = fmt
+        self.output_path = mosaic_output_path(output_path, fmt)
+        base, ext = os.path.splitext(output_path)
+        self.partial_path = f"{base}.partial{ext}"
+        self.compress = compress
+        self.blocksize = blocksize
+        self.overview_resampling = overview_resampling
+        self.tile_dir = None
+        self._footprints = None
+        self._ledger_path = None
+        self._merged = set()
+        self._tiles = []
+        self._dst = None
+
+    def start(self, footprints, tile_dir):
+        """Registers the expected (minX, minY, maxX, maxY) tile footprints and the tile directory."""
+        self._footprints = list(footprints)
+        self.tile_dir = tile_dir
+        self._ledger_path = os.path.join(tile_dir, 'merged_tiles.txt')
+        if self.fmt == 'VRT':
+            return
+        if os.path.exists(self._ledger_path) and os.path.exists(self.partial_path):
+            with open(self._ledger_path) as f:
+                self._merged = {line.strip() for line in f if line.strip()}
+            _log(f"- Resuming mosaic {os.path.basename(self.partial_path)} ({len(self._merged)} tiles already merged).")
+        else:
+            if os.path.exists(self.partial_path):
+                os.remove(self.partial_path)
+            if os.path.exists(self._ledger_path):
+                os.remove(self._ledger_path)
+
+    def is_merged(self, tile_path):
+        return os.path.basename(tile_path) in self._merged
+
+    def _open_output(self, tile):
+        res_x, res_y = tile.transform.a, -tile.transform.e
+        min_x = min(f[0] for f in self._footprints)
+        min_y = min(f[1] for f in self._footprints)
+        max_x = max(f[2] for f in self._footprints)
+        max_y = max(f[3] for f in self._footprints)
+        # Snap the union of footprints to the tiles' pixel grid, with a one-pixel
+        # margin for pixels Earth Engine includes past a region's edge.
+        origin_x = tile.transform.c + (math.floor((min_x - tile.transform.c) / res_x) - 1) * res_x
+        origin_y = tile.transform.f + (math.ceil((max_y - tile.transform.f) / res_y) + 1) * res_y
+        width = math.ceil((max_x - origin_x) / res_x) + 1
+        height = math.ceil((origin_y - min_y) / res_y) + 1
+
+        _log(f"- Preallocating {width}x{height} mosaic grid for {os.path.basename(self.output_path)}")
+        # Uncompressed, so blocks shared by neighbouring tiles are rewritten in place;
+        # the mosaic is compressed once in finish().
+        self._dst = gdal.GetDriverByName('GTiff').Create(
+            self.partial_path, width, height, tile.count,
+            gdal_array.NumericTypeCodeToGDALTypeCode(np.dtype(tile.dtypes[0])),
+            options=['TILED=YES', f'BLOCKXSIZE={self.blocksize}', f'BLOCKYSIZE={self.blocksize}',
+                     'SPARSE_OK=TRUE', 'BIGTIFF=IF_SAFER'])
+        self._dst.SetGeoTransform((origin_x, res_x, 0.0, origin_y, 0.0, -res_y))
+        if tile.crs is not None:
+            self._dst.SetProjection(tile.crs.to_wkt())
+        for i, description in enumerate(tile.descriptions, start=1):
+            band = self._dst.GetRasterBand(i)
+            if tile.nodata is not None:
+                band.SetNoDataValue(tile.nodata)
+            if description:
+                band.SetDescription(description)
+
+    def _windows(self, tile):
+        """Returns matching (tile, mosaic) windows as (row_off, col_off, height, width) tuples."""
+        dst = self._dst
+        origin_x, res_x, _, origin_y, _, neg_res_y = dst.GetGeoTransform()
+        col_off = round((tile.transform.c - origin_x) / res_x)
+        row_off = round((origin_y - tile.transform.f) / -neg_res_y)
+        src_col, src_row = max(0, -col_off), max(0, -row_off)
+        dst_col, dst_row = max(0, col_off), max(0, row_off)
+        width = min(tile.width - src_col, dst.RasterXSize - dst_col)
+        height = min(tile.height - src_row, dst.RasterYSize - dst_row)
+        if width <= 0 or height <= 0:
+            return None
+        return (src_row, src_col, height, width), (dst_row, dst_col, height, width)
+
+    def add_tile(self, tile_path):
+        """Writes one tile into its window of the mosaic and deletes it."""
+        if self.fmt == 'VRT':
+            self._tiles.append(tile_path)
+            return
+        with rasterio.open(tile_path) as tile:
+            if self._dst is None:
+                if os.path.exists(self.partial_path):
+                    self._dst = gdal.Open(self.partial_path, gdal.GA_Update)
+                else:
+                    self._open_output(tile)
+            windows = self._windows(tile)
+            if windows is None:
+                _log(f"  - WARNING: {os.path.basename(tile_path)} falls outside the mosaic grid.")
+            else:
+                (s_row, s_col, h, w), (d_row, d_col, _, _) = windows
+                data = tile.read(window=rasterio.windows.Window(s_col, s_row, w, h))
+                nodata = self._dst.GetRasterBand(1).GetNoDataValue()
+                if nodata is not None:
+                    # Do not let a neighbour's nodata edge overwrite valid pixels
+                    existing = self._dst.ReadAsArray(d_col, d_row, w, h).reshape(data.shape)
+                    data = np.where(data == nodata, existing, data)
+                for b in range(data.shape[0]):
+                    self._dst.GetRasterBand(b + 1).WriteArray(data[b], d_col, d_row)
+        # The tile's pixels are on disk before the ledger says it is merged and the tile goes away
+        self._dst.FlushCache()
+        self._merged.add(os.path.basename(tile_path))
+        with open(self._ledger_path, 'a') as f:
+            f.write(os.path.basename(tile_path) + '\n')
+        os.remove(tile_path)
+
+    def finish(self):
+        """Finalizes the mosaic and removes the tile directory (kept for VRT output)."""
+        if self.fmt == 'VRT':
+            gdal.BuildVRT(self.output_path, sorted(self._tiles)).FlushCache()
+            _log(f"- VRT written: {os.path.basename(self.output_path)} (tiles kept in {self.tile_dir}).")
+            return self.output_path
+        self.close()
+        if not os.path.exists(self.partial_path):
+            _log(f"- No tiles were merged for {os.path.basename(self.output_path)}.")
+            return None
+        if self.fmt == 'COG':
+            _log(f"- Writing Cloud-Optimized GeoTIFF: {os.path.basename(self.output_path)}")
+            cog.to_cog(self.partial_path, self.output_path, compress=self.compress,
+                       blocksize=self.blocksize, overview_resampling=self.overview_resampling)
+        else:
+            _log(f"- Compressing mosaic: {os.path.basename(self.output_path)}")
+            part_path = f"{self.output_path}.part"
+            ds = gdal.Translate(part_path, self.partial_path, format='GTiff', creationOptions=[
+                'TILED=YES', f'BLOCKXSIZE={self.blocksize}', f'BLOCKYSIZE={self.blocksize}',
+                f'COMPRESS={self.compress}', 'BIGTIFF=IF_SAFER', 'NUM_THREADS=ALL_CPUS'])
+            ds = None
+            os.replace(part_path, self.output_path)
+        os.remove(self.partial_path)
+        shutil.rmtree(self.tile_dir, ignore_errors=True)
+        _log(f"- Merge successful: {os.path.basename(self.output_path)}")
+        return self.output_path
+
+    def close(self):
+        """Closes the partial mosaic, keeping it and the ledger for a later resume."""
+        if self._dst is not None:
+            self._dst.FlushCache()
+            # GDAL closes a dataset when its last reference goes away
+            self._dst = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
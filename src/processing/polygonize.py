@@ -0,0 +1,143 @@
+import os
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import rasterio
+import rasterio.features
+import rasterio.windows
+from rasterio.transform import Affine
+import geopandas as gpd
+import shapely
+from shapely.geometry import shape
+from . import vector_io
+import instrumentation
+
+# dtypes accepted by rasterio.features.shapes
+SHAPES_DTYPES = ('int16', 'int32', 'uint8', 'uint16', 'float32')
+
+def _windows(width, height, window_size):
+    for row_off in range(0, height, window_size):
+        for col_off in range(0, width, window_size):
+            yield rasterio.windows.Window(col_off, row_off,
+                                          min(window_size, width - col_off),
+                                          min(window_size, height - row_off))
+
+def _polygonize_window(args):
+    """Polygonizes one window in pixel coordinates.
+
+    Returns (complete, partial) lists of (segment_id, WKB) pairs. Segments that
+    reach an interior window edge are partial and must be merged with their
+    pieces from neighbouring windows. Working in integer pixel coordinates keeps
+    shared edges exactly equal, so the merge is a clean union.
+    """
+    clumps_path, window, width, height = args
+    with rasterio.open(clumps_path) as src:
+        arr = src.read(1, window=window)
+    if arr.dtype.name not in SHAPES_DTYPES:
+        arr = arr.astype('int32')
+
+    edges = []
+    if window.row_off > 0:
+        edges.append(arr[0, :])
+    if window.row_off + window.height < height:
+        edges.append(arr[-1, :])
+    if window.col_off > 0:
+        edges.append(arr[:, 0])
+    if window.col_off + window.width < width:
+        edges.append(arr[:, -1])
+    edge_ids = set(np.unique(np.concatenate(edges)).tolist()) if edges else set()
+
+    complete, partial = [], []
+    transform = Affine.translation(window.col_off, window.row_off)
+    for geom, value in rasterio.features.shapes(arr, transform=transform):
+        value = int(value)
+        item = (value, shapely.to_wkb(shape(geom)))
+        (partial if value in edge_ids else complete).append(item)
+    return complete, partial
+
+def _imap_bounded(executor, fn, items, max_in_flight):
+    """Like executor.map, but keeps at most `max_in_flight` results pending."""
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def _to_crs(geoms, transform):
+    """Maps pixel-space geometries to map coordinates with the raster's affine transform."""
+    t = transform
+    return shapely.transform(geoms, lambda xy: np.column_stack([
+        t.a * xy[:, 0] + t.b * xy[:, 1] + t.c,
+        t.d * xy[:, 0] + t.e * xy[:, 1] + t.f,
+    ]))
+
+class _BatchWriter:
+    """Buffers (segment_id, WKB) pairs and writes them to the output layer in batches."""
+    def __init__(self, output_path, transform, crs, batch_size):
+        self.transform = transform
+        self.crs = crs
+        self.batch_size = batch_size
+        self._writer = vector_io.VectorBatchWriter(output_path, crs)
+        self._ids = []
+        self._wkbs = []
+
+    @property
+    def n_written(self):
+        return self._writer.n_written
+
+    def add(self, items):
+        for segment_id, wkb in items:
+            self._ids.append(segment_id)
+            self._wkbs.append(wkb)
+        if len(self._ids) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._ids:
+            return
+        geoms = _to_crs(shapely.from_wkb(self._wkbs), self.transform)
+        gdf = gpd.GeoDataFrame({'raster_val': np.asarray(self._ids, dtype='int64')}, geometry=geoms, crs=self.crs)
+        self._writer.write(gdf)
+        self._ids, self._wkbs = [], []
+
+    def close(self):
+        self.flush()
+        self._writer.close()
+
+def polygonize_clumps(clumps_path, output_path, window_size=2048, num_workers=None, batch_size=100000):
+    """Polygonizes a clumps raster window by window in a process pool.
+
+    Polygons fully inside a window are written straight to the output layer in
+    batches; polygons crossing window edges are merged once all windows are
+    done. Peak memory is bounded by the window size and the batch size, not by
+    the number of segments. The output format follows the file extension
+    (GeoParquet for .parquet).
+    """
+    with rasterio.open(clumps_path) as src:
+        width, height = src.width, src.height
+        transform, crs = src.transform, src.crs
+
+    num_workers = num_workers or os.cpu_count() or 1
+    windows = list(_windows(width, height, window_size))
+    print(f"- Polygonizing {len(windows)} windows of {window_size}px with {num_workers} workers...")
+
+    writer = _BatchWriter(output_path, transform, crs, batch_size)
+    partial = defaultdict(list)
+    tasks = ((clumps_path, window, width, height) for window in windows)
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        for complete, parts in _imap_bounded(executor, _polygonize_window, tasks, 2 * num_workers):
+            writer.add(complete)
+            instrumentation.count('windows')
+            for segment_id, wkb in parts:
+                partial[segment_id].append(wkb)
+
+    print(f"- Merging {len(partial)} segments that cross window edges...")
+    for segment_id in sorted(partial):
+        merged = shapely.union_all(shapely.from_wkb(partial.pop(segment_id)))
+        writer.add((segment_id, shapely.to_wkb(part)) for part in shapely.get_parts(merged))
+    writer.close()
+    instrumentation.count('segments', writer.n_written)
+    print(f"- Wrote {writer.n_written} polygons to {os.path.basename(output_path)}")
+    return output_path
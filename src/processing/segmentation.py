@@ -1,9 +1,10 @@
 import rasterio
-import rasterio.features
-import geopandas as gpd
 import numpy as np
-from pyshepseg import shepseg
+from pyshepseg import shepseg, tiling
 import os
+import math
+from . import polygonize
+import instrumentation
 
 def run_segmentation(segmentation_params, composite_image_path, output_dir, output_names):
     """Performs Shepherd segmentation using the pyshepseg library and polygonizes the result."""
@@ -18,10 +19,72 @@ def run_segmentation(segmentation_params, composite_image_path, output_dir, outp
         print(f"- Segmentation output already exists: {os.path.basename(shapefile_path)}")
         return clumps_path, shapefile_path
 
+    tiled = _use_tiled_mode(segmentation_params, composite_image_path)
+    with instrumentation.span('shepherd', 'segmentation', tiled=tiled):
+        if tiled:
+            _run_tiled_segmentation(segmentation_params, composite_image_path, clumps_path)
+        else:
+            _run_in_memory_segmentation(segmentation_params, composite_image_path, clumps_path)
+
+    print(f"- Polygonizing raster to vector: {os.path.basename(shapefile_path)}")
+    with instrumentation.span('polygonize', 'segmentation'):
+        polygonize.polygonize_clumps(
+            clumps_path,
+            shapefile_path,
+            window_size=segmentation_params.get('polygonize_window_size', 2048),
+            num_workers=segmentation_params.get('num_workers'),
+            batch_size=segmentation_params.get('polygonize_batch_size', 100000)
+        )
+
+    print("- Segmentation and polygonizing complete.")
+    return clumps_path, shapefile_path
+
+def _bytes_per_pixel(n_bands, itemsize):
+    """Rough working-set size of Shepherd segmentation per pixel (input, k-means labels, clumps)."""
+    return n_bands * itemsize * 2 + 16
+
+def _segmentation_bands(segmentation_params, n_bands):
+    """1-based band numbers to segment: the configured `bands`, or every band of the composite."""
+    return list(segmentation_params.get('bands') or range(1, n_bands + 1))
+
+def _use_tiled_mode(segmentation_params, composite_image_path):
+    """Decides between in-memory and tiled segmentation."""
+    tiled = segmentation_params.get('tiled', 'auto')
+    if tiled is True or tiled is False:
+        return tiled
+    max_memory_mb = segmentation_params.get('max_memory_mb')
+    if not max_memory_mb:
+        return False
+    with rasterio.open(composite_image_path) as src:
+        itemsize = np.dtype(src.dtypes[0]).itemsize
+        n_bands = len(_segmentation_bands(segmentation_params, src.count))
+        estimate = src.width * src.height * _bytes_per_pixel(n_bands, itemsize)
+    if estimate > max_memory_mb * 1024 * 1024:
+        print(f"- Estimated in-memory footprint ({estimate / 1024**2:.0f} MB) exceeds max_memory_mb ({max_memory_mb}). Using tiled mode.")
+        return True
+    return False
+
+def _tile_size_for_memory(segmentation_params, n_bands, itemsize, num_workers, overlap_size):
+    """Largest tile size whose overlapped tiles fit in the memory ceiling across all workers."""
+    if segmentation_params.get('tile_size'):
+        return segmentation_params['tile_size']
+    max_memory_mb = segmentation_params.get('max_memory_mb', 4096)
+    budget = max_memory_mb * 1024 * 1024 / max(1, num_workers)
+    side = int(math.sqrt(budget / _bytes_per_pixel(n_bands, itemsize))) - 2 * overlap_size
+    if side < 512:
+        needed_mb = (512 + 2 * overlap_size) ** 2 * _bytes_per_pixel(n_bands, itemsize) * max(1, num_workers) / (1024 * 1024)
+        print(f"- WARNING: max_memory_mb ({max_memory_mb} MB) is too small for the minimum 512px tile with "
+              f"{overlap_size}px overlap on {num_workers} workers; segmentation will need about {needed_mb:.0f} MB. "
+              f"Raise max_memory_mb or lower num_workers.")
+        return 512
+    return side // 256 * 256
+
+def _run_in_memory_segmentation(segmentation_params, composite_image_path, clumps_path):
+    """Segments the whole composite in one piece and writes the clumps raster."""
     print(f"- Reading composite image: {os.path.basename(composite_image_path)}")
     with rasterio.open(composite_image_path) as src:
-        # pyshepseg expects (bands, rows, cols)
-        img_array = src.read()
+        # pyshepseg expects (bands, rows, cols); only the configured bands are segmented, as in tiled mode
+        img_array = src.read(_segmentation_bands(segmentation_params, src.count))
         transform = src.transform
         crs = src.crs
         # pyshepseg handles nulls with a specific parameter, so we don't need to mask here.
@@ -41,7 +104,7 @@ def run_segmentation(segmentation_params, composite_image_path, output_dir, outp
     # The result is an object containing the segmentation image as a numpy array
     segments_array = seg_result.segimg
 
-    # Convert array to a dtype supported by rasterio.features.shapes
+    # Store as a dtype supported by rasterio.features.shapes
     if segments_array.dtype not in [rasterio.int16, rasterio.int32, rasterio.uint8, rasterio.uint16, rasterio.float32]:
         print(f"- Converting segmentation array from {segments_array.dtype} to int32 for polygonizing.")
         segments_array = segments_array.astype(rasterio.int32)
@@ -61,19 +124,38 @@ def run_segmentation(segmentation_params, composite_image_path, output_dir, outp
     ) as dst:
         dst.write(segments_array, 1)
 
-    # Polygonize the output raster to Shapefile
-    print(f"- Polygonizing raster to vector: {os.path.basename(shapefile_path)}")
-    results = (
-        {'properties': {'raster_val': v}, 'geometry': s}
-        for i, (s, v) 
-        in enumerate(rasterio.features.shapes(segments_array, transform=transform)))
-
-    geoms = list(results)
-    gdf = gpd.GeoDataFrame.from_features(geoms)
-    # Cast raster_val to integer, as it represents segment IDs
-    gdf['raster_val'] = gdf['raster_val'].astype(int)
-    gdf.set_crs(crs=crs, inplace=True)
-    gdf.to_file(shapefile_path, driver='ESRI Shapefile')
-    
-    print("- Segmentation and polygonizing complete.")
-    return clumps_path, shapefile_path
\ No newline at end of file
+def _run_tiled_segmentation(segmentation_params, composite_image_path, clumps_path):
+    """Segments the image in overlapping tiles in a process pool and stitches segment IDs across seams."""
+    with rasterio.open(composite_image_path) as src:
+        bands = _segmentation_bands(segmentation_params, src.count)
+        itemsize = np.dtype(src.dtypes[0]).itemsize
+        img_null_val = src.nodata
+
+    num_workers = segmentation_params.get('num_workers', os.cpu_count() or 1)
+    overlap_size = segmentation_params.get('overlap_size', 1024)
+    tile_size = _tile_size_for_memory(segmentation_params, len(bands), itemsize, num_workers, overlap_size)
+    print(f"- Running tiled Shepherd segmentation (tile {tile_size}px, overlap {overlap_size}px, {num_workers} workers)...")
+
+    kwargs = {}
+    if hasattr(tiling, 'SegmentationConcurrencyConfig') and num_workers > 1:
+        kwargs['concurrencyCfg'] = tiling.SegmentationConcurrencyConfig(
+            concurrencyType=tiling.CONC_SUBPROC, numWorkers=num_workers)
+    elif num_workers > 1:
+        print("- WARNING: This pyshepseg version has no tile concurrency. Segmenting tiles sequentially.")
+
+    tiling.doTiledShepherdSegmentation(
+        composite_image_path,
+        clumps_path,
+        tileSize=tile_size,
+        overlapSize=overlap_size,
+        minSegmentSize=segmentation_params.get('min_n_pxls', 100),
+        numClusters=segmentation_params.get('num_clusters', 80),
+        bandNumbers=bands,
+        imgNullVal=img_null_val,
+        outputDriver='GTiff',
+        creationOptions=['COMPRESS=DEFLATE', 'TILED=YES', 'BIGTIFF=IF_SAFER'],
+        tempfilesDriver='GTiff',
+        tempfilesExt='tif',
+        writeHistogram=False,
+        **kwargs
+    )
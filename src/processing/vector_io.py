@@ -0,0 +1,141 @@
+import os
+import json
+import numpy as np
+import geopandas as gpd
+import pyogrio
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+from pyproj import CRS
+
+PARQUET_EXTENSIONS = ('.parquet', '.geoparquet')
+
+def is_parquet(path):
+    return os.path.splitext(path)[1].lower() in PARQUET_EXTENSIONS
+
+def _parquet_geometry_column(path):
+    metadata = pq.read_schema(path).metadata or {}
+    geo = json.loads(metadata.get(b'geo', b'{}'))
+    return geo.get('primary_column', 'geometry')
+
+def read_vector(path, columns=None, bbox=None, mask=None):
+    """Reads a vector layer, projecting `columns` and filtering by `bbox` or `mask` on read.
+
+    GeoParquet is read through Arrow (using its bbox covering column for the
+    spatial filter); every other format goes through pyogrio.
+    """
+    if is_parquet(path):
+        if columns is not None:
+            columns = list(columns) + [_parquet_geometry_column(path)]
+        if mask is not None:
+            bbox = mask.bounds
+        gdf = gpd.read_parquet(path, columns=columns, bbox=bbox)
+        if mask is not None:
+            gdf = gdf[gdf.intersects(mask)]
+        return gdf
+    return pyogrio.read_dataframe(path, columns=columns, bbox=bbox, mask=mask, use_arrow=True)
+
+def iter_vector(path, columns=None, chunk_size=100000):
+    """Yields a vector layer as GeoDataFrames of at most `chunk_size` features."""
+    crs = read_vector_info(path)['crs']
+    if is_parquet(path):
+        geometry_column = _parquet_geometry_column(path)
+        read_columns = None if columns is None else list(columns) + [geometry_column]
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=read_columns):
+            df = batch.to_pandas().drop(columns='bbox', errors='ignore')
+            geoms = shapely.from_wkb(df.pop(geometry_column).to_numpy())
+            yield gpd.GeoDataFrame(df, geometry=geoms, crs=crs)
+        return
+    n_features = pyogrio.read_info(path)['features']
+    for offset in range(0, n_features, chunk_size):
+        yield pyogrio.read_dataframe(path, columns=columns, skip_features=offset, max_features=chunk_size, use_arrow=True)
+
+def read_vector_intersecting(path, geoms, columns=None):
+    """Reads only the features whose bounding box intersects one of `geoms` (given in the layer's CRS).
+
+    For GeoParquet with a bbox covering column, the envelope of `geoms` is
+    pushed down to the reader, so only row groups whose bbox statistics
+    overlap it are decoded; the rows read are then matched against `geoms`
+    with one bulk STRtree query. Other formats are read through pyogrio with
+    the union of the geometries' envelopes as mask. Callers apply the exact
+    predicate themselves.
+    """
+    geoms = np.asarray(geoms)
+    crs = read_vector_info(path)['crs']
+    if len(geoms) == 0:
+        return gpd.GeoDataFrame({c: [] for c in columns or []}, geometry=[], crs=crs)
+    if not is_parquet(path) or 'bbox' not in pq.read_schema(path).names:
+        return read_vector(path, columns=columns, mask=shapely.union_all(shapely.envelope(geoms)))
+
+    gdf = read_vector(path, columns=columns, bbox=tuple(shapely.total_bounds(geoms)))
+    gdf = gdf.drop(columns='bbox', errors='ignore')
+    rows = np.unique(shapely.STRtree(geoms).query(shapely.envelope(gdf.geometry.values), predicate='intersects')[0])
+    return gdf.iloc[rows]
+
+def read_vector_info(path):
+    """Returns the CRS and feature count of a vector layer without reading its features."""
+    if is_parquet(path):
+        metadata = pq.read_schema(path).metadata or {}
+        geo = json.loads(metadata.get(b'geo', b'{}'))
+        crs = geo.get('columns', {}).get(geo.get('primary_column', 'geometry'), {}).get('crs')
+        return {'crs': CRS.from_json_dict(crs) if crs else None, 'features': pq.ParquetFile(path).metadata.num_rows}
+    info = pyogrio.read_info(path)
+    return {'crs': CRS.from_user_input(info['crs']) if info['crs'] else None, 'features': info['features']}
+
+def write_vector(gdf, path):
+    """Writes a GeoDataFrame, as GeoParquet (with a bbox covering column) or via pyogrio."""
+    if is_parquet(path):
+        gdf.to_parquet(path, index=False, write_covering_bbox=True)
+    else:
+        pyogrio.write_dataframe(gdf, path, use_arrow=True)
+
+def _geo_metadata(crs):
+    column = {'encoding': 'WKB', 'geometry_types': [],
+              'covering': {'bbox': {k: ['bbox', k] for k in ('xmin', 'ymin', 'xmax', 'ymax')}}}
+    if crs is not None:
+        column['crs'] = CRS.from_user_input(crs).to_json_dict()
+    return {'version': '1.1.0', 'primary_column': 'geometry', 'columns': {'geometry': column}}
+
+class VectorBatchWriter:
+    """Appends GeoDataFrame batches to one vector layer.
+
+    GeoParquet batches are streamed as row groups of a single file through a
+    pyarrow ParquetWriter into `<path>.part`, which is renamed to `path` on
+    `close`, so an interrupted run never leaves a valid-looking partial layer.
+    Other formats are appended through pyogrio.
+    """
+    def __init__(self, path, crs):
+        self.path = path
+        self.part_path = f"{path}.part"
+        self.crs = crs
+        self.n_written = 0
+        self._parquet_writer = None
+
+    def _to_arrow(self, gdf):
+        geoms = gdf.geometry.values
+        bounds = shapely.bounds(geoms)
+        columns = {name: pa.array(gdf[name].to_numpy()) for name in gdf.columns if name != gdf.geometry.name}
+        columns['geometry'] = pa.array(shapely.to_wkb(geoms), type=pa.binary())
+        columns['bbox'] = pa.StructArray.from_arrays(
+            [pa.array(bounds[:, i].astype(np.float64)) for i in range(4)],
+            names=['xmin', 'ymin', 'xmax', 'ymax'])
+        return pa.table(columns)
+
+    def write(self, gdf):
+        if len(gdf) == 0:
+            return
+        if is_parquet(self.path):
+            table = self._to_arrow(gdf)
+            if self._parquet_writer is None:
+                schema = table.schema.with_metadata({b'geo': json.dumps(_geo_metadata(self.crs)).encode('utf-8')})
+                self._parquet_writer = pq.ParquetWriter(self.part_path, schema)
+            self._parquet_writer.write_table(table)
+        else:
+            pyogrio.write_dataframe(gdf, self.path, append=self.n_written > 0)
+        self.n_written += len(gdf)
+
+    def close(self):
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+            os.replace(self.part_path, self.path)
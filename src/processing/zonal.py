@@ -0,0 +1,192 @@
+import numpy as np
+import pandas as pd
+import rasterio
+import rasterio.windows
+
+SUPPORTED_STATS = ('mean', 'stdev', 'min', 'max', 'count', 'sum')
+
+def same_grid(clumps_path, image_path):
+    """True if the image shares the clumps raster's CRS, transform and shape."""
+    with rasterio.open(clumps_path) as clumps, rasterio.open(image_path) as image:
+        return (clumps.crs == image.crs
+                and clumps.width == image.width
+                and clumps.height == image.height
+                and clumps.transform.almost_equals(image.transform))
+
+class ZonalAccumulator:
+    """Running per-segment reductions for each band, indexed by segment ID.
+
+    The arrays only span the range of segment IDs seen so far (from `offset`),
+    so an accumulator over a row partition holds about as many entries as the
+    partition has segments. Only the reductions needed by the requested stats
+    are kept. Accumulators built over disjoint parts of a raster can be
+    combined with `merge`.
+    """
+    def __init__(self, n_bands, stats):
+        unknown = set(stats) - set(SUPPORTED_STATS)
+        if unknown:
+            raise ValueError(f"Unsupported zonal stats: {sorted(unknown)}")
+        self.n_bands = n_bands
+        self.stats = list(stats)
+        self._need_sum = bool({'mean', 'sum', 'stdev'} & set(stats))
+        self._need_sumsq = 'stdev' in stats
+        self._need_min = 'min' in stats
+        self._need_max = 'max' in stats
+        self.offset = 0
+        self.present = np.zeros(0, dtype=bool)
+        self.count = np.zeros((n_bands, 0))
+        self.sum = np.zeros((n_bands, 0)) if self._need_sum else None
+        self.sumsq = np.zeros((n_bands, 0)) if self._need_sumsq else None
+        self.min = np.zeros((n_bands, 0)) if self._need_min else None
+        self.max = np.zeros((n_bands, 0)) if self._need_max else None
+
+    def _cover(self, lo, hi):
+        """Extends the arrays so they span segment IDs [lo, hi)."""
+        old = self.present.shape[0]
+        if old == 0:
+            new_lo, new_hi = lo, hi
+        else:
+            new_lo = min(lo, self.offset)
+            new_hi = max(hi, self.offset + old)
+            if new_lo == self.offset and new_hi == self.offset + old:
+                return
+            if new_hi > self.offset + old:
+                # Leave room above, where IDs usually grow as more rows are read
+                new_hi = max(new_hi, new_lo + int((self.offset + old - new_lo) * 1.5))
+        start = self.offset - new_lo
+        def _extend(arr, fill):
+            out = np.full(arr.shape[:-1] + (new_hi - new_lo,), fill, dtype=arr.dtype)
+            out[..., start:start + old] = arr
+            return out
+        self.present = _extend(self.present, False)
+        self.count = _extend(self.count, 0.0)
+        if self._need_sum:
+            self.sum = _extend(self.sum, 0.0)
+        if self._need_sumsq:
+            self.sumsq = _extend(self.sumsq, 0.0)
+        if self._need_min:
+            self.min = _extend(self.min, np.inf)
+        if self._need_max:
+            self.max = _extend(self.max, -np.inf)
+        self.offset = new_lo
+
+    def update(self, segments, data, nodata=None):
+        """Adds one block. `segments` is (rows, cols); `data` is a masked (bands, rows, cols) array.
+
+        Pixels whose segment equals `nodata` (the clumps nodata value) are skipped.
+        """
+        segments = segments.astype(np.int64, copy=False)
+        keep = segments != nodata if nodata is not None else np.ones(segments.shape, dtype=bool)
+        if not keep.any():
+            return
+        kept = segments[keep]
+        self._cover(int(kept.min()), int(kept.max()) + 1)
+        local = segments - self.offset
+        size = self.present.shape[0]
+        self.present[np.unique(kept - self.offset)] = True
+        values = np.ma.getdata(data).astype(np.float64, copy=False)
+        invalid = np.ma.getmaskarray(data) | np.isnan(values) | ~keep
+        for b in range(self.n_bands):
+            valid = ~invalid[b]
+            ids = local[valid]
+            vals = values[b][valid]
+            self.count[b] += np.bincount(ids, minlength=size)
+            if self._need_sum:
+                self.sum[b] += np.bincount(ids, weights=vals, minlength=size)
+            if self._need_sumsq:
+                self.sumsq[b] += np.bincount(ids, weights=vals * vals, minlength=size)
+            if self._need_min:
+                np.minimum.at(self.min[b], ids, vals)
+            if self._need_max:
+                np.maximum.at(self.max[b], ids, vals)
+
+    def merge(self, other):
+        """Folds another accumulator (over a disjoint part of the raster) into this one."""
+        n = other.present.shape[0]
+        if n == 0:
+            return self
+        self._cover(other.offset, other.offset + n)
+        span = slice(other.offset - self.offset, other.offset - self.offset + n)
+        self.present[span] |= other.present
+        self.count[:, span] += other.count
+        if self._need_sum:
+            self.sum[:, span] += other.sum
+        if self._need_sumsq:
+            self.sumsq[:, span] += other.sumsq
+        if self._need_min:
+            np.minimum(self.min[:, span], other.min, out=self.min[:, span])
+        if self._need_max:
+            np.maximum(self.max[:, span], other.max, out=self.max[:, span])
+        return self
+
+    def finalize(self, band_labels=None):
+        """Returns a DataFrame indexed by segment_id with one column per band and stat.
+
+        Columns keep the pipeline's feature naming (`b<n>_<stat>`, or just the
+        stat for single-band rasters), so models trained on either engine's
+        features load the other's. `band_labels` overrides the band numbers used.
+        """
+        ids = np.nonzero(self.present)[0]
+        use_prefix = band_labels is not None or self.n_bands > 1
+        band_labels = band_labels or list(range(1, self.n_bands + 1))
+        columns = {}
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for b, label in enumerate(band_labels):
+                count = self.count[b, ids]
+                empty = count == 0
+                values = {'count': count}
+                if self._need_sum:
+                    total = self.sum[b, ids]
+                    mean = np.where(empty, np.nan, total / count)
+                    values['sum'] = total
+                    values['mean'] = mean
+                if self._need_sumsq:
+                    variance = np.maximum(self.sumsq[b, ids] / count - mean * mean, 0.0)
+                    values['stdev'] = np.where(empty, np.nan, np.sqrt(variance))
+                if self._need_min:
+                    values['min'] = np.where(empty, np.nan, self.min[b, ids])
+                if self._need_max:
+                    values['max'] = np.where(empty, np.nan, self.max[b, ids])
+                prefix = f"b{label}_" if use_prefix else ''
+                for stat in self.stats:
+                    columns[f"{prefix}{stat}"] = values[stat]
+        return pd.DataFrame(columns, index=pd.Index(ids + self.offset, name='segment_id'))
+
+def block_windows(width, height, block_size, row_range=None):
+    """Yields block windows over a raster, optionally restricted to [row_start, row_stop)."""
+    row_start, row_stop = row_range if row_range is not None else (0, height)
+    for row_off in range(row_start, row_stop, block_size):
+        for col_off in range(0, width, block_size):
+            yield rasterio.windows.Window(col_off, row_off,
+                                          min(block_size, width - col_off),
+                                          min(block_size, row_stop - row_off))
+
+def accumulate(clumps_path, image_path, stats, block_size=1024, bands=None, row_range=None):
+    """Streams blocks of the clumps raster and the image and accumulates per-segment stats."""
+    with rasterio.open(clumps_path) as clumps, rasterio.open(image_path) as image:
+        bands = bands or list(range(1, image.count + 1))
+        acc = ZonalAccumulator(len(bands), stats)
+        for window in block_windows(clumps.width, clumps.height, block_size, row_range):
+            segments = clumps.read(1, window=window)
+            data = image.read(bands, window=window, masked=True)
+            acc.update(segments, data, clumps.nodata)
+    return acc
+
+def band_labels(image_path, bands=None):
+    """Band numbers to name output columns by, or None for a single-band image."""
+    with rasterio.open(image_path) as image:
+        if image.count == 1:
+            return None
+        return bands or list(range(1, image.count + 1))
+
+def row_partitions(height, n_parts, block_size):
+    """Splits [0, height) into up to `n_parts` row ranges aligned to `block_size`."""
+    n_blocks = -(-height // block_size)
+    n_parts = max(1, min(n_parts, n_blocks))
+    bounds = [round(i * n_blocks / n_parts) * block_size for i in range(n_parts + 1)]
+    return [(start, min(stop, height)) for start, stop in zip(bounds[:-1], bounds[1:]) if start < height]
+
+def zonal_stats(clumps_path, image_path, stats, block_size=1024, bands=None):
+    """Computes per-segment stats of an image on the same grid as the clumps raster."""
+    acc = accumulate(clumps_path, image_path, stats, block_size=block_size, bands=bands)
+    return acc.finalize(band_labels(image_path, bands))
@@ -0,0 +1,75 @@
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+from data_download import downloader
+
+BODY = b'x' * 4096
+
+class _TileHandler(BaseHTTPRequestHandler):
+    """Serves BODY, misbehaving on the first request to each path as the path asks."""
+    hits = {}
+
+    def do_GET(self):
+        n = self.hits[self.path] = self.hits.get(self.path, 0) + 1
+        if self.path == '/missing':
+            self.send_error(404)
+        elif self.path == '/throttled' and n == 1:
+            self.send_response(429)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif self.path == '/truncated' and n == 1:
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(BODY)))
+            self.end_headers()
+            self.wfile.write(BODY[:100])
+            self.close_connection = True
+        else:
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(BODY)))
+            self.end_headers()
+            self.wfile.write(BODY)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server():
+    _TileHandler.hits = {}
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), _TileHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+def _download(server, tmp_path, paths):
+    tasks = [(f"{server}/{p}", str(tmp_path / f"{p}.tif")) for p in paths]
+    return downloader.download_tiles(tasks, max_workers=2, max_retries=3, backoff_base=0.01, backoff_max=0.05, timeout=10)
+
+def test_backs_off_and_retries_throttled_tile(server, tmp_path):
+    results = _download(server, tmp_path, ['throttled'])
+    assert results == {str(tmp_path / 'throttled.tif'): True}
+    assert _TileHandler.hits['/throttled'] == 2
+    assert (tmp_path / 'throttled.tif').read_bytes() == BODY
+
+def test_retries_truncated_response(server, tmp_path):
+    results = _download(server, tmp_path, ['truncated'])
+    assert results == {str(tmp_path / 'truncated.tif'): True}
+    assert _TileHandler.hits['/truncated'] == 2
+    assert (tmp_path / 'truncated.tif').read_bytes() == BODY
+    assert not (tmp_path / 'truncated.tif.part').exists()
+
+def test_does_not_retry_client_errors(server, tmp_path):
+    results = _download(server, tmp_path, ['missing'])
+    assert results == {str(tmp_path / 'missing.tif'): False}
+    assert _TileHandler.hits['/missing'] == 1
+    assert not (tmp_path / 'missing.tif').exists()